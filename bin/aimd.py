@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+# vim: set fileencoding=utf-8
+# (c) © 2016-2017 Xavier Lüthi xavier@luthi.eu
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See LICENSE.txt for the full license text.
+
+"""
+Adaptive number of modems queried at the same time (see poller, option
+'--adaptive'), with the AIMD algorithm of TCP congestion control: additive
+increase as long as the modems answer in time, multiplicative decrease as soon
+as they time out or slow down.
+
+The controller only sees the modems given to the engine and the modems it gives
+back, so that it works with any engine: dispatch() holds the modems back as
+long as the window is full, completed() is called for every polled modem.
+"""
+
+from collections import deque
+import logging
+import statistics
+import threading
+import time
+
+class aimd(object):
+    """
+    Window of modems queried at the same time, adapted at the end of every
+    round: a round lasts up to the completion of as many modems as the window
+    held at its start, i.e. about the duration of one query.
+
+    At the end of a round, the window is multiplied by *decrease* if more than
+    *max_timeout_ratio* of the modems timed out, or if their median query time
+    exceeds *max_rtt_ratio* times the base query time (the lowest median of
+    the recent rounds).  Otherwise it grows by *increase*, or doubles during
+    the slow start (up to the first decrease).
+
+    :param minimum: lowest window
+    :param maximum: highest window
+    :param window: current window
+    :param in_flight: number of modems dispatched and not yet completed
+    :param started: dict hostname -> time the modem was dispatched
+    :param history: list of tuples (time, window), one per change
+    :param running: False once stop() is called: dispatch() gives up
+    """
+    def __init__(self, minimum, maximum, increase = 1, decrease = 0.5,
+                 max_timeout_ratio = 0.05, max_rtt_ratio = 2.0, rounds = 20):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.increase = increase
+        self.decrease = decrease
+        self.max_timeout_ratio = max_timeout_ratio
+        self.max_rtt_ratio = max_rtt_ratio
+        self.window = self.minimum
+        self.slow_start = True
+        self.in_flight = 0
+        self.started = {}
+        self.round_size = self.window
+        self.round_times = []
+        self.round_timeouts = 0
+        self.medians = deque(maxlen = rounds)
+        self.history = [(time.time(), self.window)]
+        self.running = True
+        self.condition = threading.Condition()
+        self.traces = logging.getLogger('traces')
+
+    def start(self):
+        """
+        Reset the modems in flight, at the beginning of a sweep.  The window
+        is kept from the previous sweep.
+        """
+        with self.condition:
+            self.in_flight = 0
+            self.started = {}
+            self._new_round()
+            self.running = True
+
+    def stop(self):
+        """
+        Release dispatch(), e.g. when the sweep is interrupted.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def dispatch(self, entities):
+        """
+        Generator giving the modems one at a time, as soon as the window has
+        room for them.  It may block: it is meant to be consumed by the task
+        handler thread of a pool.
+
+        :param entities: iterable of modems (dict), see poller.load_modems()
+        """
+        for entity in entities:
+            with self.condition:
+                while self.running and self.in_flight >= self.window:
+                    self.condition.wait(1)
+                if not self.running:
+                    return
+                self.begin(entity['ip'])
+            yield entity
+
+    def begin(self, hostname):
+        """
+        Record the dispatch of a modem, for callers which check the window
+        themselves instead of using dispatch().
+
+        :param hostname: IP address of the modem (entity['ip'])
+        """
+        with self.condition:
+            self.in_flight += 1
+            self.started[hostname] = time.time()
+
+    def completed(self, hostname, timeout):
+        """
+        Record the completion of a modem, and adapt the window at the end of
+        the round.
+
+        :param hostname: IP address of the modem (entity['ip'])
+        :param timeout: True if the modem did not answer, None if it was not
+               queried (only its room in the window is released)
+        """
+        with self.condition:
+            started = self.started.pop(hostname, None)
+            self.in_flight = max(0, self.in_flight - 1)
+            if timeout is None:
+                self.condition.notify_all()
+                return
+            if timeout:
+                self.round_timeouts += 1
+            elif started is not None:
+                self.round_times.append(time.time() - started)
+            if len(self.round_times) + self.round_timeouts >= self.round_size:
+                self._end_of_round()
+            self.condition.notify_all()
+
+    def _new_round(self):
+        self.round_size = self.window
+        self.round_times = []
+        self.round_timeouts = 0
+
+    def _end_of_round(self):
+        count = len(self.round_times) + self.round_timeouts
+        timeout_ratio = self.round_timeouts / count
+        median = statistics.median(self.round_times) if self.round_times else None
+        if median is not None:
+            self.medians.append(median)
+        base = min(self.medians) if self.medians else None
+        window = self.window
+        if timeout_ratio > self.max_timeout_ratio or (median is not None and median > base * self.max_rtt_ratio):
+            window = max(self.minimum, int(window * self.decrease))
+            self.slow_start = False
+        elif self.slow_start:
+            window = min(self.maximum, window * 2)
+        else:
+            window = min(self.maximum, window + self.increase)
+        if window != self.window:
+            # Decreases are the events worth noticing, increases are routine.
+            log = self.traces.info if window < self.window else self.traces.debug
+            log("Concurrency window {} -> {} (timeouts: {}/{}, median query time: {}, base: {})".format(
+                self.window, window, self.round_timeouts, count,
+                'n/a' if median is None else '{:.3f}s'.format(median),
+                'n/a' if base is None else '{:.3f}s'.format(base)))
+            self.window = window
+            self.history.append((time.time(), window))
+        self._new_round()
+
+    def summary(self, since = 0):
+        """
+        :param since: only consider the changes after this time
+        :return: a tuple (lowest, highest, current window) since *since*
+        """
+        windows = [window for (when, window) in self.history if when >= since] + [self.window]
+        earlier = [window for (when, window) in self.history if when < since]
+        if earlier:
+            windows.append(earlier[-1])
+        return (min(windows), max(windows), self.window)
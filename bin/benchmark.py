@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+# vim: set fileencoding=utf-8
+# (c) © 2016-2017 Xavier Lüthi xavier@luthi.eu
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See LICENSE.txt for the full license text.
+
+"""
+Benchmarks of the poller.
+
+    startup: time to run 'launch_poller.py --help', and time needed by a new
+             process to import the modules used by the workers.
+    csv:     time to format the CSV lines, with ch6643e.get_csv_line() and with
+             the reference implementation get_legacy_csv_line().  Both must
+             give exactly the same lines.
+    transport: CPU time of the parent process to receive the polled modems
+             from the batch and hybrid engines, through the pipes of the pool
+             or through a resultring (shared memory).
+    engines: throughput (modems/s) and peak memory (PSS of all processes) of
+             launch_poller.py with several engines, against simulator.py.
+
+For command line argument, use the "--help" option.
+"""
+
+from ch6643e import ch6643e
+from datetime import datetime, timedelta
+from resultring import resultring
+import argparse
+import os
+import pickle
+import poller
+import json
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def run_time(command, runs):
+    """
+    :param command: command line (list), run in a temporary directory (for the
+           log files of launch_poller.py), with the modules of this directory
+           in the Python path
+    :param runs: number of runs
+    :return: the median wall clock time of the command, in seconds
+    """
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join(filter(None, [BIN_DIR, os.environ.get('PYTHONPATH')])))
+    times = []
+    with tempfile.TemporaryDirectory() as directory:
+        for i in range(runs):
+            start = time.perf_counter()
+            subprocess.run(command, cwd = directory, env = env, stdout = subprocess.DEVNULL, check = True)
+            times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def benchmark_startup(runs):
+    """
+    Print the startup times, in milliseconds.  Import times are given on top
+    of the startup of the interpreter itself.
+    """
+    interpreter = run_time([sys.executable, '-c', 'pass'], runs)
+    print("Python interpreter:         {:7.1f} ms".format(interpreter * 1000))
+    help_time = run_time([sys.executable, os.path.join(BIN_DIR, 'launch_poller.py'), '--help'], runs)
+    print("launch_poller.py --help:    {:7.1f} ms".format(help_time * 1000))
+    for modules in ('ch6643e', 'ch6643e, snmp, poller', 'ipaddress'):
+        import_time = run_time([sys.executable, '-c', 'import ' + modules], runs) - interpreter
+        print("import {:20s} {:7.1f} ms".format(modules + ':', import_time * 1000))
+
+def sample_modems(count):
+    """
+    :return: a list of *count* modems with random values, in all states, with
+             signal levels as integers (pure Python SNMP) or strings (easysnmp)
+    """
+    rand = random.Random(0)
+    start = datetime.today()
+    modems = []
+    for i in range(count):
+        modem = ch6643e(hostname = '10.{}.{}.{}'.format(i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff),
+                        bpid = rand.choice(['', str(1000000 + i)]), mac = '')
+        modem.timestamp = start + timedelta(seconds = i / 100)
+        modem.state = rand.choice(['completed', 'completed', 'completed', 'nocounter', 'partial', 'timeout', 'error'])
+        modem.hfc_mac = '{:012x}'.format(i)
+        modem.config_file = 'CH6643E-{}.cfg'.format(i % 4)
+        modem.oper_status = modem.boot_status = '3'
+        modem.fw_version = 'CH6643E-5.01.01'
+        modem.fw_filename = 'CH6643E-5.01.01.bin'
+        modem.wan_address = '81.240.{}.{}'.format(i >> 8 & 0xff, i & 0xff)
+        modem.wan_gateway = '81.240.{}.1'.format(i >> 8 & 0xff)
+        modem.uptime = rand.randrange(100000000)
+        modem.wan_dl = rand.randrange(10 ** 12) if modem.state == 'completed' else ''
+        modem.wan_ul = rand.randrange(10 ** 11) if modem.state == 'completed' else ''
+        convert = rand.choice([int, str])
+        level = lambda low, high: convert(rand.randrange(low, high))
+        modem.ds_power = [(str(c), level(-1200, 1200)) for c in range(1, rand.choice([9, 17, 33]))]
+        modem.ds_snr = [(str(c), level(0, 500)) for c in range(1, len(modem.ds_power) + 1)]
+        modem.us_power = [(str(c), level(300, 1100)) for c in range(1, rand.choice([3, 5, 9]))]
+        if modem.state == 'partial':
+            modem.polled_groups = rand.sample(ch6643e.GROUPS, rand.randrange(1, len(ch6643e.GROUPS)))
+        modems.append(modem)
+    return modems
+
+def benchmark_csv(runs, count):
+    """
+    Print the time needed to format one CSV line, in microseconds.
+    """
+    modems = sample_modems(count)
+    for modem in modems:
+        assert modem.get_csv_line() == modem.get_legacy_csv_line(), modem.get_legacy_csv_line()
+    print("{} lines identical".format(count))
+    for method in ('get_legacy_csv_line', 'get_csv_line'):
+        times = []
+        for i in range(runs):
+            start = time.perf_counter()
+            for modem in modems:
+                getattr(modem, method)()
+            times.append(time.perf_counter() - start)
+        print("{:20s} {:7.2f} us/line".format(method + ':', statistics.median(times) / count * 1000000))
+
+def process_tree(pid):
+    """
+    :return: the list of the process *pid* and of all its descendants
+    """
+    pids = [pid]
+    for pid in pids:
+        try:
+            for task in os.listdir('/proc/{}/task'.format(pid)):
+                with open('/proc/{}/task/{}/children'.format(pid, task)) as f:
+                    pids.extend([int(child) for child in f.read().split()])
+        except OSError:
+            pass
+    return pids
+
+def memory_usage(pid):
+    """
+    :return: the proportional set size (PSS, in kB) of the process *pid* and
+             of all its descendants.  Unlike the RSS, the pages shared by the
+             processes of a pool after fork are counted once.
+    """
+    total = 0
+    for pid in process_tree(pid):
+        try:
+            with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+                for line in f:
+                    if line.startswith('Pss:'):
+                        total += int(line.split()[1])
+                        break
+        except OSError:
+            pass
+    return total
+
+def benchmark_engines(runs, count, engines, parallel, delay, base_port):
+    """
+    Start simulator.py with *count* modems, and print the throughput and peak
+    memory of one sweep of launch_poller.py with every engine.  The pool,
+    thread and batch engines need easysnmp.
+    """
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join(filter(None, [BIN_DIR, os.environ.get('PYTHONPATH')])))
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, 'conf.json'), 'w') as f:
+            json.dump({'read_community': 'public'}, f)
+        simulator = subprocess.Popen([sys.executable, os.path.join(BIN_DIR, 'simulator.py'), '--modems', str(count),
+                                      '--delay', str(delay), '--base-port', str(base_port),
+                                      '--ipfile', 'ip.txt'], cwd = directory, env = env)
+        try:
+            while not os.path.exists(os.path.join(directory, 'ip.txt')):
+                time.sleep(0.1)
+            time.sleep(1)
+            if simulator.poll() is not None:
+                raise RuntimeError("simulator.py failed (UDP ports {}-{} in use?)".format(base_port, base_port + count - 1))
+            for engine in engines:
+                command = [sys.executable, os.path.join(BIN_DIR, 'launch_poller.py'), '--config', 'conf.json',
+                           '--no-usage', '--engine', engine, '--parallel', str(parallel),
+                           '--output', 'out.txt', 'ip.txt']
+                durations = []
+                peaks = []
+                for i in range(runs):
+                    start = time.perf_counter()
+                    process = subprocess.Popen(command, cwd = directory, env = env, stdout = subprocess.DEVNULL)
+                    peak = 0
+                    while process.poll() is None:
+                        peak = max(peak, memory_usage(process.pid))
+                        time.sleep(0.05)
+                    durations.append(time.perf_counter() - start)
+                    peaks.append(peak)
+                    if process.returncode:
+                        raise subprocess.CalledProcessError(process.returncode, command)
+                with open(os.path.join(directory, 'out.txt')) as f:
+                    lines = len(f.readlines())
+                print("{:7s} {:8.1f} modems/s, peak memory {:8.1f} MB, {} lines".format(
+                    engine + ':', lines / statistics.median(durations), statistics.median(peaks) / 1024, lines))
+        finally:
+            simulator.terminate()
+            simulator.wait()
+
+def benchmark_transport(runs, count):
+    """
+    Print the CPU time of the parent per modem, in microseconds, for the
+    records of one batch: unpickling and decoding with the 'pipe' transport,
+    decoding of the slots with the 'shm' one.
+    """
+    modems = sample_modems(count)
+    for modem in modems:
+        modem.polled_groups = list(ch6643e.GROUPS)
+    parent = poller.poller(processes = 1)
+    parent.result_ring = resultring(1, count)
+    try:
+        for transport in ('pipe', 'shm'):
+            if transport == 'shm':
+                poller._result_ring = resultring(1, count, parent.result_ring.name)
+                poller._result_ring.attach(0)
+            times = []
+            for i in range(runs):
+                data = pickle.dumps(poller.encode_records(modems))
+                start = time.process_time()
+                records = parent._decode_records(pickle.loads(data))
+                times.append(time.process_time() - start)
+            assert len(records) == count
+            print("{:5s} {:7.2f} us/modem, {:6.0f} bytes/modem through the pipe".format(
+                transport + ':', statistics.median(times) / count * 1000000, len(data) / count))
+    finally:
+        if poller._result_ring is not None:
+            poller._result_ring.close()
+            poller._result_ring = None
+        parent.result_ring.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of the poller.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--runs', '-r', type=int, default=10, help="Number of runs of every measure (the median is kept)")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    subparsers.add_parser('startup', help="Startup time of the poller and of its worker processes")
+    csv_parser = subparsers.add_parser('csv', help="Formatting of the CSV lines",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    csv_parser.add_argument('--modems', '-n', type=int, default=10000, help="Number of sample modems")
+    transport_parser = subparsers.add_parser('transport', help="Transport of the polled modems to the parent",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    transport_parser.add_argument('--modems', '-n', type=int, default=10000, help="Number of sample modems")
+    engines_parser = subparsers.add_parser('engines', help="Throughput and memory of the engines, against simulator.py",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    engines_parser.add_argument('--modems', '-n', type=int, default=1000, help="Number of simulated modems")
+    engines_parser.add_argument('--engine', action='append', choices=['pool', 'batch', 'hybrid', 'thread'],
+        help="Engine to measure, can be repeated (default: pool and thread)")
+    engines_parser.add_argument('--parallel', '-p', type=int, default=100, help="--parallel option of launch_poller.py")
+    engines_parser.add_argument('--delay', type=float, default=0.05, help="Mean response time of the simulated modems")
+    engines_parser.add_argument('--base-port', type=int, default=30000, help="UDP port of the first simulated modem")
+    args = parser.parse_args()
+
+    if args.benchmark == 'startup':
+        benchmark_startup(args.runs)
+    elif args.benchmark == 'csv':
+        benchmark_csv(args.runs, args.modems)
+    elif args.benchmark == 'transport':
+        benchmark_transport(args.runs, args.modems)
+    elif args.benchmark == 'engines':
+        benchmark_engines(args.runs, args.modems, args.engine or ['pool', 'thread'], args.parallel, args.delay, args.base_port)
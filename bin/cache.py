@@ -13,9 +13,10 @@
 #
 # See LICENSE.txt for the full license text.
 
-from ch6643e import ch6643e
+from ch6643e import ch6643e, normalize_mac
 import sqlite3
 import logging
+import json
 import os # getpid() for debug traces
 
 class cachedb(object):
@@ -29,6 +30,14 @@ class cachedb(object):
     wan_dl and wan_ul are absolute values as fetched from the modem. In order to
     calculate the relative consumption, it calculates the delta between the
     current value and the one in database.
+
+    It also keeps the latest values of every metric group of the modems (see
+    ch6643e.GROUPS), so that groups which are not queried at every sweep can
+    be completed with their last known values.  They are keyed by the MAC
+    address of the modem, see ch6643e.normalize_mac().
+
+    :param pending_groups: dict (hfc_mac, group) -> row of the metric groups
+           stored since the latest commit_groups()
     """
     def __init__(self, file_name = 'docsispy.db'):
         """
@@ -46,7 +55,14 @@ class cachedb(object):
                                  wan_ul     INTEGER NOT NULL,
                                  timestamp  INTEGER NOT NULL,
                                  boot_time  INTEGER NOT NULL)""")
+        self.cursor.execute("""CREATE TABLE IF NOT EXISTS groups
+                                (hfc_mac    TEXT NOT NULL,
+                                 grp        TEXT NOT NULL,
+                                 timestamp  INTEGER NOT NULL,
+                                 data       TEXT NOT NULL,
+                                 PRIMARY KEY (hfc_mac, grp))""")
         self.connection.commit()
+        self.pending_groups = {}
         self.traces = logging.getLogger('traces')
 
     def __debug(self,msg):
@@ -106,3 +122,101 @@ class cachedb(object):
             {'hfc_mac': modem.hfc_mac, 'wan_dl': modem.wan_dl, 'wan_ul': modem.wan_ul,
              'timestamp': modem.timestamp, 'boot_time': modem.boot_time})
         self.connection.commit()
+
+    def get_group_timestamps(self):
+        """
+        :return: a dict hfc_mac -> dict group -> timestamp (seconds since epoch)
+                 of the latest query of every metric group of every modem.
+        """
+        timestamps = {}
+        for (hfc_mac, grp, timestamp) in self.cursor.execute('SELECT hfc_mac, grp, timestamp FROM groups'):
+            timestamps.setdefault(hfc_mac, {})[grp] = timestamp
+        return timestamps
+
+    def get_uptimes(self):
+        """
+        :return: a dict hfc_mac -> uptime, as stored with the latest counters
+                 metric group of every modem.
+        """
+        return dict(self.cursor.execute(
+            "SELECT hfc_mac, json_extract(data, '$.uptime') FROM groups WHERE grp = 'counters'"))
+
+    def store_groups(self, modem, groups, timestamp):
+        """
+        Store the values of the given metric groups of the modem.  They are
+        written in the database by commit_groups(), for all modems at once.
+
+        :param modem: modem object with SNMP values already polled (ch6643e)
+        :param groups: list of groups to store (see ch6643e.GROUPS)
+        :param timestamp: time of the query (seconds since epoch)
+        """
+        hfc_mac = normalize_mac(modem.hfc_mac)
+        for grp in groups:
+            self.pending_groups[(hfc_mac, grp)] = {'hfc_mac': hfc_mac, 'grp': grp, 'timestamp': timestamp,
+                                                   'data': json.dumps(modem.get_group(grp))}
+
+    def commit_groups(self):
+        """
+        Write the metric groups stored since the previous call, in one single
+        transaction (typically once per sweep).
+        """
+        if not self.pending_groups:
+            return
+        self.cursor.executemany('INSERT OR REPLACE INTO groups VALUES (:hfc_mac, :grp, :timestamp, :data)',
+            list(self.pending_groups.values()))
+        self.connection.commit()
+        self.__debug("{} metric groups committed".format(len(self.pending_groups)))
+        self.pending_groups = {}
+
+    def load_groups(self, modem, groups):
+        """
+        Restore in the modem object the latest known values of the given metric
+        groups.
+
+        :param modem: modem object (ch6643e)
+        :param groups: list of groups to restore (see ch6643e.GROUPS)
+        :return: the list of groups actually found in the database
+        """
+        found = []
+        hfc_mac = normalize_mac(modem.hfc_mac)
+        for grp in groups:
+            pending = self.pending_groups.get((hfc_mac, grp))
+            if pending is not None:
+                row = (pending['data'],)
+            else:
+                self.cursor.execute('SELECT data FROM groups WHERE hfc_mac = :hfc_mac AND grp = :grp',
+                    {'hfc_mac': hfc_mac, 'grp': grp})
+                row = self.cursor.fetchone()
+            if row is not None:
+                modem.set_group(grp, json.loads(row[0]))
+                found.append(grp)
+        return found
+
+    def merge(self, file_name):
+        """
+        Import the content of another cache database (typically the one of
+        another shard, see merge_shards.py).  For every modem and metric group,
+        the most recent row of both databases is kept.
+
+        :param file_name: the other SQLite3 database file
+        :return: the number of rows imported
+        """
+        self.cursor.execute('ATTACH DATABASE :file_name AS other', {'file_name': file_name})
+        try:
+            tables = [row[0] for row in self.cursor.execute("SELECT name FROM other.sqlite_master WHERE type = 'table'")]
+            imported = 0
+            if 'modems' in tables:
+                self.cursor.execute("""INSERT OR REPLACE INTO modems
+                    SELECT o.* FROM other.modems o LEFT JOIN modems m ON m.hfc_mac = o.hfc_mac
+                    WHERE m.hfc_mac IS NULL OR o.timestamp > m.timestamp""")
+                imported += self.cursor.rowcount
+            if 'groups' in tables:
+                self.cursor.execute("""INSERT OR REPLACE INTO groups
+                    SELECT o.* FROM other.groups o LEFT JOIN groups g ON g.hfc_mac = o.hfc_mac AND g.grp = o.grp
+                    WHERE g.hfc_mac IS NULL OR o.timestamp > g.timestamp""")
+                imported += self.cursor.rowcount
+            self.connection.commit()
+        finally:
+            self.cursor.execute('DETACH DATABASE other')
+        self.__debug("{} rows imported from {}".format(imported, file_name))
+        return imported
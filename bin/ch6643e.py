@@ -13,11 +13,10 @@
 #
 # See LICENSE.txt for the full license text.
 
-from easysnmp import Session, exceptions
 from datetime import datetime
+import snmp
+import snmptrace
 import logging
-from binascii import hexlify
-import ipaddress
 import json
 import os # getpid() for debug traces
 
@@ -35,7 +34,9 @@ class ch6643e(object):
     :param timeout: SNMP query timeout - seconds before retry
     :param hostname: IP address of the modem (private one - aka HFC IP)
     :param retries: SNMP retries before failure
-    :param state: status of the query: init, completed, nocounter, timeout, error
+    :param state: status of the query: init, completed, nocounter, timeout,
+           error, or partial (timeout after some metric groups were fetched:
+           see polled_groups)
     :param hfc_mac: HFC mac address of the modem
     :param uptime: seconds since the last reboot of the modem
     :param boot_time: /not used anymore/ (but still present in cache.py)
@@ -54,7 +55,65 @@ class ch6643e(object):
     :param timestamp: date & time at the creation of the object
     :param dl_delta: WAN download traffic counter (calculated with the cache)
     :param ul_delta: WAN upload traffic counter (calculated with the cache)
+    :param polled_groups: metric groups (see GROUPS) actually fetched by the
+           latest query_all()
+    :param restored_groups: metric groups not fetched, but restored from the
+           cache database by the poller (see poller._merge_groups())
+    :param trace: snmptrace.modemtrace recording the SNMP exchanges of the
+           next query, logged at its end, or None
     """
+
+    # Metric groups that can be queried independently, and the attributes
+    # filled by each of them.
+    GROUPS = ('counters', 'configdata', 'signals')
+    GROUP_FIELDS = {
+        'counters':   ('hfc_mac', 'uptime', 'wan_dl', 'wan_ul'),
+        'configdata': ('config_file', 'oper_status', 'boot_status', 'fw_version',
+                       'fw_filename', 'wan_address', 'wan_gateway'),
+        'signals':    ('ds_power', 'ds_snr', 'us_power'),
+    }
+
+    # Positions of the fields of every metric group in the CSV line (see
+    # get_csv_line()), left empty in a 'partial' line when the group is
+    # missing.  The MAC address comes from the IP file as well.
+    CSV_GROUP_FIELDS = {
+        'counters':   (18, 19, 20, 21, 22),
+        'configdata': (4, 5, 6, 14, 15, 16, 17),
+        'signals':    (7, 8, 9, 10, 11, 12, 13),
+    }
+
+    # Attributes transmitted in a compact record (see to_record()): everything
+    # but the query parameters and the values computed by the cache.
+    RECORD_FIELDS = ('bpid', 'hostname', 'state', 'hfc_mac', 'uptime', 'wan_dl',
+                     'wan_ul', 'ds_power', 'ds_snr', 'us_power', 'config_file',
+                     'oper_status', 'boot_status', 'fw_version', 'fw_filename',
+                     'wan_address', 'wan_gateway', 'timestamp', 'polled_groups')
+
+    # Fields of the records with only a handful of distinct values over the
+    # whole plant: they are sent as small integer codes (see
+    # poller.encode_records()).
+    CODED_FIELDS = ('config_file', 'oper_status', 'boot_status', 'fw_version',
+                    'fw_filename', 'wan_gateway')
+
+    # OIDs of the SNMP queries (see get_counters, get_configdata, get_signals)
+    COUNTERS_OIDS   = [".1.3.6.1.2.1.2.2.1.6.2",
+                       ".1.3.6.1.2.1.1.3.0",
+                       ".1.3.6.1.2.1.31.1.1.1.6.2",
+                       ".1.3.6.1.2.1.31.1.1.1.10.2"]
+    CONFIGDATA_OIDS = [".1.3.6.1.2.1.69.1.4.5.0",
+                       ".1.3.6.1.2.1.69.1.3.4.0",
+                       ".1.3.6.1.2.1.69.1.4.1.0",
+                       ".1.3.6.1.2.1.69.1.3.5.0",
+                       ".1.3.6.1.2.1.69.1.3.2.0",
+                       ".1.3.6.1.4.1.35604.1.19.52.1.1.5.0",
+                       ".1.3.6.1.4.1.35604.1.19.52.1.1.10.0"]
+    DS_POWER_OID    = ".1.3.6.1.2.1.10.127.1.1.1.1.6"
+    DS_SNR_OID      = ".1.3.6.1.2.1.10.127.1.1.4.1.5"
+    US_POWER_OID    = ".1.3.6.1.4.1.4491.2.1.20.1.2.1.1"
+
+    # Encoded form of the walked OIDs, computed once (see _walk_values)
+    ENCODED_OIDS = {oid: snmp.oid_body(oid) for oid in (DS_POWER_OID, DS_SNR_OID, US_POWER_OID)}
+
     def __init__(self, hostname='localhost', community='public', timeout=7,
         retries=1, bpid = '', mac = ''):
 
@@ -89,6 +148,11 @@ class ch6643e(object):
         self.dl_delta = 0
         self.ul_delta = 0
 
+        self.polled_groups = []
+        self.restored_groups = []
+
+        # Only a sample of the modems are traced (see poller.trace_sample)
+        self.trace = None
 
     def __debug(self,msg):
         """
@@ -98,27 +162,99 @@ class ch6643e(object):
         """
         logging.getLogger('traces').debug("PID {} - {}".format(os.getpid(),msg))
 
-    def query_all(self):
+    def query_all(self, groups = None, last_uptime = None):
         """
         Query the modem and get all information available.
         This is the main method to be used to activate SNMP query.
+
+        param: groups (list): metric groups to query (see GROUPS). By default,
+               all groups are queried.
+        param: last_uptime (int): uptime of the modem at the previous query.  If
+               the modem rebooted since then (current uptime is lower), the
+               configuration data are queried even if not in *groups*.
         """
+        # easysnmp is only required by this method: query_all_async() doesn't
+        # use it.
+        from easysnmp import Session, exceptions
+        if groups is None:
+            groups = self.GROUPS
+        self.polled_groups = []
         session =  Session(hostname=self.hostname, version=2,
                            community=self.community, timeout=self.timeout,
                            retries=self.retries, use_numeric=True)
+        if self.trace is not None:
+            session = snmptrace.tracedsession(session, self.trace)
         try:
             self.state = 'completed'
-            self.get_counters(session)
-            self.get_configdata(session)
-            self.get_signals(session)
+            if 'counters' in groups:
+                self.get_counters(session)
+                self.polled_groups.append('counters')
+            if 'configdata' in groups or self._rebooted_since(last_uptime):
+                self.get_configdata(session)
+                self.polled_groups.append('configdata')
+            if 'signals' in groups:
+                self.get_signals(session)
+                self.polled_groups.append('signals')
         except exceptions.EasySNMPTimeoutError as e:
             self.__debug("SNMP timeout (ip: {}, mac: {})".format(self.hostname, self.hfc_mac))
-            self.state = 'timeout'
+            self.state = 'partial' if self.polled_groups else 'timeout'
         except:
             logging.getLogger('traces').critical("Generic exception catched! (ip: {}, mac: {})".format(self.hostname, self.hfc_mac), exc_info=True)
             self.state = "error"
+        if self.trace is not None:
+            self.trace.write(self)
         self.__debug("query_all for IP {} completed with status '{}'".format(self.hostname, self.state))
 
+    async def query_all_async(self, engine, groups = None, last_uptime = None):
+        """
+        Same as query_all(), but as a coroutine using the pure Python SNMP
+        implementation (see snmp.py), so that one event loop can query
+        thousands of modems at the same time.
+
+        param: engine (snmp.asyncengine): UDP socket of the running event loop
+        param: groups (list): metric groups to query (see GROUPS)
+        param: last_uptime (int): see query_all()
+        """
+        if groups is None:
+            groups = self.GROUPS
+        self.polled_groups = []
+        session = snmp.asyncsession(engine, hostname=self.hostname,
+                                    community=self.community, timeout=self.timeout,
+                                    retries=self.retries)
+        if self.trace is not None:
+            session = snmptrace.tracedsession(session, self.trace)
+        try:
+            self.state = 'completed'
+            if 'counters' in groups:
+                self._set_counters_values(await session.get_values(self.COUNTERS_OIDS))
+                self.polled_groups.append('counters')
+            if 'configdata' in groups or self._rebooted_since(last_uptime):
+                self._set_configdata_values(await session.get_values(self.CONFIGDATA_OIDS))
+                self.polled_groups.append('configdata')
+            if 'signals' in groups:
+                self.ds_power = await self._get_bulk_async(session, self.DS_POWER_OID, 9)
+                self.ds_snr   = await self._get_bulk_async(session, self.DS_SNR_OID, len(self.ds_power) + 1)
+                self.us_power = await self._get_bulk_async(session, self.US_POWER_OID, 5)
+                self.polled_groups.append('signals')
+        except snmp.SNMPTimeoutError as e:
+            self.__debug("SNMP timeout (ip: {}, mac: {})".format(self.hostname, self.hfc_mac))
+            self.state = 'partial' if self.polled_groups else 'timeout'
+        except:
+            logging.getLogger('traces').critical("Generic exception catched! (ip: {}, mac: {})".format(self.hostname, self.hfc_mac), exc_info=True)
+            self.state = "error"
+        if self.trace is not None:
+            self.trace.write(self)
+        self.__debug("query_all_async for IP {} completed with status '{}'".format(self.hostname, self.state))
+
+    def _rebooted_since(self, last_uptime):
+        """
+        :param last_uptime: uptime of the modem at the previous query, or None
+        :return: True if the counters have just been fetched and show that the
+                 modem rebooted since the previous query.
+        """
+        return (last_uptime is not None and 'counters' in self.polled_groups
+                and self.uptime < last_uptime)
+
     def get_counters(self, session):
         """
         Query with one single SNMP GET operation the following OID:
@@ -129,14 +265,15 @@ class ch6643e(object):
 
         param: session (easysnmp.Session): SNMP session used for the query.
         """
-        oid = [".1.3.6.1.2.1.2.2.1.6.2",
-               ".1.3.6.1.2.1.1.3.0",
-               ".1.3.6.1.2.1.31.1.1.1.6.2",
-               ".1.3.6.1.2.1.31.1.1.1.10.2"]
+        self._set_counters(session.get(self.COUNTERS_OIDS))
 
-        res = session.get(oid)
+    def _set_counters(self, res):
+        """
+        Parse the response of the get_counters query.
 
-        self.hfc_mac = hexlify(res[0].value.encode('latin-1')).decode()
+        param: res (list): SNMPVariable objects, in the order of COUNTERS_OIDS
+        """
+        self.hfc_mac = res[0].value.encode('latin-1').hex()
         self.uptime  = int(res[1].value)
         try:
             self.wan_dl  = int(res[2].value)
@@ -147,6 +284,24 @@ class ch6643e(object):
             self.wan_dl = ''
             self.wan_ul = ''
 
+    def _set_counters_values(self, values):
+        """
+        Same as _set_counters(), with the typed values returned by
+        snmp.asyncsession.get_values(): no conversion from strings is needed.
+
+        param: values (list): int, bytes or None, in the order of COUNTERS_OIDS
+        """
+        self.hfc_mac = values[0].hex()
+        self.uptime  = int(values[1])
+        if isinstance(values[2], int) and isinstance(values[3], int):
+            self.wan_dl  = values[2]
+            self.wan_ul  = values[3]
+        else:
+            logging.getLogger('traces').error("Error converting traffic counters (ip: {}, mac: {})".format(self.hostname, self.hfc_mac))
+            self.state = 'nocounter'
+            self.wan_dl = ''
+            self.wan_ul = ''
+
     def get_configdata(self, session):
         """
         Query with one single SNMP GET operation the following OID:
@@ -160,25 +315,41 @@ class ch6643e(object):
 
         param: session (easysnmp.Session): SNMP session used for the query.
         """
-        oid = [".1.3.6.1.2.1.69.1.4.5.0",
-               ".1.3.6.1.2.1.69.1.3.4.0",
-               ".1.3.6.1.2.1.69.1.4.1.0",
-               ".1.3.6.1.2.1.69.1.3.5.0",
-               ".1.3.6.1.2.1.69.1.3.2.0",
-               ".1.3.6.1.4.1.35604.1.19.52.1.1.5.0",
-               ".1.3.6.1.4.1.35604.1.19.52.1.1.10.0"]
+        self._set_configdata(session.get(self.CONFIGDATA_OIDS))
 
-        res = session.get(oid)
+    def _set_configdata(self, res):
+        """
+        Parse the response of the get_configdata query.
 
+        param: res (list): SNMPVariable objects, in the order of CONFIGDATA_OIDS
+        """
         self.config_file = res[0].value
         self.oper_status = res[1].value
         self.boot_status = res[2].value
         self.fw_version  = res[3].value
         self.fw_filename = res[4].value
-        try:
-            self.wan_address = str(ipaddress.IPv4Address(res[5].value.encode('latin-1')))
-            self.wan_gateway = str(ipaddress.IPv4Address(res[6].value.encode('latin-1')))
-        except ipaddress.AddressValueError:
+        self._set_wan(res[5].value.encode('latin-1'), res[6].value.encode('latin-1'))
+
+    def _set_configdata_values(self, values):
+        """
+        Same as _set_configdata(), with the typed values returned by
+        snmp.asyncsession.get_values().
+
+        param: values (list): int, bytes or None, in the order of CONFIGDATA_OIDS
+        """
+        (self.config_file, self.oper_status, self.boot_status, self.fw_version,
+         self.fw_filename) = [value.decode('latin-1') if isinstance(value, bytes) else
+                              '' if value is None else str(value) for value in values[:5]]
+        self._set_wan(values[5], values[6])
+
+    def _set_wan(self, address, gateway):
+        """
+        param: address (bytes): packed WAN address, as received
+        param: gateway (bytes): packed WAN gateway, as received
+        """
+        self.wan_address = ipv4_to_string(address)
+        self.wan_gateway = gateway_to_string(gateway)
+        if self.wan_address is None or self.wan_gateway is None:
             # No wan received
             self.wan_address = 'no_WAN'
             self.wan_gateway = 'no_WAN'
@@ -194,9 +365,9 @@ class ch6643e(object):
         """
 
         # list of tuple (id, value)
-        self.ds_power = self._get_bulk(session, ".1.3.6.1.2.1.10.127.1.1.1.1.6", 9)
-        self.ds_snr   = self._get_bulk(session, ".1.3.6.1.2.1.10.127.1.1.4.1.5", len(self.ds_power) + 1)
-        self.us_power = self._get_bulk(session, ".1.3.6.1.4.1.4491.2.1.20.1.2.1.1", 5)
+        self.ds_power = self._get_bulk(session, self.DS_POWER_OID, 9)
+        self.ds_snr   = self._get_bulk(session, self.DS_SNR_OID, len(self.ds_power) + 1)
+        self.us_power = self._get_bulk(session, self.US_POWER_OID, 5)
 
     def _get_bulk(self, session, oid, max_repetitions = 9):
         """
@@ -227,37 +398,163 @@ class ch6643e(object):
         """
 
         this_tree = oid
-        in_this_tree = True
         var_list = []
-        while ( in_this_tree ):
+        iterations = 0
+        while this_tree:
             res = session.get_bulk(oids=this_tree, non_repeaters=0, max_repetitions=max_repetitions)
+            iterations += 1
+            this_tree = self._walk_results(oid, res, var_list)
+        if self.trace is not None:
+            self.trace.walk(oid, iterations, len(var_list))
+        return var_list
 
-            for s in res:
-                # self.__debug(s)
-                if s.oid == oid:
-                    var_list.append( (s.oid_index, s.value) )
-                else:
-                    # self.__debug("Did not match this_tree. End of get_bulk.")
-                    in_this_tree = False
-                    break
-                if s.snmp_type == 'ENDOFMIBVIEW':
-                    in_this_tree = False
-                    break
+    async def _get_bulk_async(self, session, oid, max_repetitions = 9):
+        """
+        Same as _get_bulk(), with a snmp.asyncsession and its typed values.
+        OIDs are kept encoded all along the walk.
+        """
+        this_tree = root = self.ENCODED_OIDS[oid]
+        var_list = []
+        iterations = 0
+        while this_tree:
+            res = await session.get_bulk_values(this_tree, max_repetitions)
+            iterations += 1
+            this_tree = self._walk_values(root, res, var_list)
+        if self.trace is not None:
+            self.trace.walk(oid, iterations, len(var_list))
+        return var_list
 
-            this_tree = res[-1].oid
+    def _walk_results(self, oid, res, var_list):
+        """
+        Steps 2 and 3 of _get_bulk(): store in *var_list* the values of *res*
+        which are still descendant of *oid*.
 
-        return var_list
+        :return: the OID to start the next GET BULK operation with, or None if
+                 the end of the *oid* tree has been reached.
+        """
+        for s in res:
+            if s.oid != oid or s.snmp_type == 'ENDOFMIBVIEW':
+                return None
+            var_list.append( (s.oid_index, s.value) )
+        if not res:
+            return None
+        return res[-1].oid + '.' + res[-1].oid_index
+
+    def _walk_values(self, root, res, var_list):
+        """
+        Same as _walk_results(), with the tuples (encoded OID, tag, value)
+        returned by snmp.asyncsession.get_bulk_values(): the end of the tree is
+        detected by comparing the encoded OIDs with the encoded *root* (see
+        snmp.oid_body), and only the index is decoded.
+        """
+        length = len(root)
+        for (value_oid, tag, value) in res:
+            if tag == snmp.END_OF_MIB_VIEW or not value_oid.startswith(root):
+                return None
+            var_list.append( (snmp.decode_index(value_oid[length:]), value) )
+        if not res:
+            return None
+        return res[-1][0]
+
+    def get_group(self, group):
+        """
+        :param group: name of a metric group (see GROUPS)
+        :return: a dict with the values of the attributes of this group
+        """
+        return {field: getattr(self, field) for field in self.GROUP_FIELDS[group]}
+
+    def set_group(self, group, values):
+        """
+        Restore the attributes of a metric group, typically from a cache.
+
+        :param group: name of a metric group (see GROUPS)
+        :param values: dict as returned by get_group()
+        """
+        for field in self.GROUP_FIELDS[group]:
+            setattr(self, field, values[field])
+
+    def merge(self, other, groups):
+        """
+        Complete a modem in 'partial' state with the metric groups fetched by
+        a later query of the same modem.
+
+        :param other: ch6643e object, result of the later query
+        :param groups: metric groups expected from the first query
+        :return: self, in 'completed' (or 'nocounter') state if all *groups*
+                 are now fetched
+        """
+        for group in other.polled_groups:
+            if group not in self.polled_groups:
+                self.set_group(group, other.get_group(group))
+                self.polled_groups.append(group)
+        if all([group in self.polled_groups for group in groups]):
+            self.state = 'nocounter' if self.wan_dl == '' else 'completed'
+        return self
+
+    def to_record(self):
+        """
+        :return: a tuple with the values of RECORD_FIELDS.  It is much smaller
+                 than the pickled object, as the attribute names are not part
+                 of it.
+        """
+        return tuple([getattr(self, field) for field in self.RECORD_FIELDS])
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        Build a modem object from a record returned by to_record().  The query
+        parameters (community, timeout, retries) are not restored.
+
+        :param record: tuple of values of RECORD_FIELDS
+        :return: a ch6643e object
+        """
+        modem = cls.__new__(cls)
+        modem.__dict__.update(zip(cls.RECORD_FIELDS, record))
+        modem.boot_time = 0
+        modem.dl_delta = 0
+        modem.ul_delta = 0
+        modem.restored_groups = []
+        return modem
+
+    def get_csv_line(self):
+        """
+        Same as get_legacy_csv_line(), but faster: the timestamp is formatted
+        once per second, and signal levels are taken from a table of strings.
+        The output is exactly the same (see 'benchmark.py csv').
+
+        :return: a CSV line with the same format as the legacy SNMP pollbot.
+        """
+        if self.bpid == '':
+            self.bpid = self.hfc_mac
+        if self.state in ('completed', 'nocounter', 'partial'):
+            ds = str(len(self.ds_power))
+            us = str(len(self.us_power))
+            fields = [_format_timestamp(self.timestamp), self.bpid, self.hfc_mac,
+                      self.hostname, self.config_file, self.oper_status, self.boot_status,
+                      ds, _format_tenths(self.ds_power),
+                      ds, _format_tenths(self.ds_snr),
+                      us, _format_tenths(self.us_power),
+                      ds + '-' + us, self.fw_version, self.fw_filename,
+                      self.wan_gateway, self.wan_address, str(self.uptime),
+                      str(self.wan_ul), str(self.ul_delta), str(self.wan_dl), str(self.dl_delta)]
+            if self.state == 'partial':
+                self._clear_missing_groups(fields)
+            return ';'.join(fields)
+        return ';'.join([_format_timestamp(self.timestamp), self.bpid, self.hfc_mac,
+                         self.hostname, 'timeout;;;;;;;;;;;;;;;'])
 
     def get_legacy_csv_line(self):
         """
+        Reference implementation of the CSV line, see get_csv_line().
+
         :return: a CSV line with the same format as the legacy SNMP pollbot.
         """
         if self.bpid == '':
             self.bpid = self.hfc_mac
-        if self.state in ('completed', 'nocounter'):
+        if self.state in ('completed', 'nocounter', 'partial'):
             ds = len(self.ds_power)
             us = len(self.us_power)
-            result = ';'.join ([self.timestamp.strftime('%Y%m%d-%H%M%S'),
+            fields = [self.timestamp.strftime('%Y%m%d-%H%M%S'),
                         self.bpid,
                         self.hfc_mac,
                         self.hostname,
@@ -279,7 +576,10 @@ class ch6643e(object):
                         str(self.wan_ul),
                         str(self.ul_delta),
                         str(self.wan_dl),
-                        str(self.dl_delta)])
+                        str(self.dl_delta)]
+            if self.state == 'partial':
+                self._clear_missing_groups(fields)
+            result = ';'.join(fields)
         else:
             result = ';'.join([self.timestamp.strftime('%Y%m%d-%H%M%S'),
                         self.bpid,
@@ -288,6 +588,94 @@ class ch6643e(object):
                         'timeout;;;;;;;;;;;;;;;'])
         return result
 
+    def _clear_missing_groups(self, fields):
+        """
+        Turn the fields of a CSV line into the ones of a 'partial' line: the
+        fields of the metric groups neither polled nor restored from the cache
+        are emptied, and the state replaces the configuration file, as in a
+        'timeout' line.
+
+        :param fields: list of the fields of the line, modified in place
+        """
+        for group in self.GROUPS:
+            if group not in self.polled_groups and group not in self.restored_groups:
+                for i in self.CSV_GROUP_FIELDS[group]:
+                    fields[i] = ''
+        fields[4] = 'partial'
+
+def normalize_mac(mac):
+    """
+    Common form of the MAC addresses, as returned by the modems: the key of
+    the modems in the cache database, whatever the format of the IP file.
+
+    :return: *mac* with lowercase hex digits only ('5C:35:3B:EF:61:06' ->
+             '5c353bef6106')
+    """
+    return ''.join([c for c in mac.lower() if c in '0123456789abcdef'])
+
+# Decimal string of every byte value, to format IPv4 addresses
+_DECIMAL = [str(i) for i in range(256)]
+
+# Cache of the formatted WAN gateways: there are only a few of them (one per
+# CMTS interface), shared by thousands of modems.
+_gateways = {}
+MAX_GATEWAYS = 4096
+
+def ipv4_to_string(packed):
+    """
+    Lean replacement of str(ipaddress.IPv4Address(packed)): the ipaddress
+    module is not needed to format a 4 bytes address.
+
+    :param packed: IPv4 address, as 4 bytes
+    :return: the dotted quad string, or None if *packed* is not a valid packed
+             IPv4 address
+    """
+    if not isinstance(packed, bytes) or len(packed) != 4:
+        return None
+    return _DECIMAL[packed[0]] + '.' + _DECIMAL[packed[1]] + '.' + _DECIMAL[packed[2]] + '.' + _DECIMAL[packed[3]]
+
+def gateway_to_string(packed):
+    """
+    Same as ipv4_to_string(), with a cache: the same string object is returned
+    for all modems behind the same gateway.
+    """
+    string = _gateways.get(packed)
+    if string is None:
+        string = ipv4_to_string(packed)
+        if string is not None:
+            if len(_gateways) >= MAX_GATEWAYS:
+                _gateways.clear()
+            _gateways[packed] = string
+    return string
+
+# Signal levels are in tenths of dB(mV): their string representation, as
+# written by get_legacy_csv_line(), for the usual range of values.  Both the
+# integer values (pure Python SNMP) and their string form (easysnmp) are keys.
+_TENTHS = {}
+for _value in range(-1000, 1001):
+    _TENTHS[_value] = _TENTHS[str(_value)] = str(_value / 10)
+del _value
+
+def _format_tenths(values):
+    """
+    :param values: list of tuples (index, level in tenths of dB)
+    :return: the levels in dB, separated by ':'
+    """
+    return ':'.join([_TENTHS.get(x[1]) or str(int(x[1])/10) for x in values])
+
+# Latest formatted timestamp: modems polled within the same second share it.
+_last_timestamp = (None, None)
+
+def _format_timestamp(timestamp):
+    """
+    :return: timestamp.strftime('%Y%m%d-%H%M%S'), computed once per second
+    """
+    global _last_timestamp
+    key = timestamp.replace(microsecond = 0)
+    if _last_timestamp[0] != key:
+        _last_timestamp = (key, timestamp.strftime('%Y%m%d-%H%M%S'))
+    return _last_timestamp[1]
+
 # The following is only to test the class itself. Could be seen as an example too.
 if __name__ == '__main__':
     import argparse
@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+# vim: set fileencoding=utf-8
+# (c) © 2016-2017 Xavier Lüthi xavier@luthi.eu
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See LICENSE.txt for the full license text.
+
+"""
+Multi-nodes polling with work stealing: a coordinator splits every sweep in
+batches of modems, stored in a shared workqueue.  Poller nodes take batches
+as long as they have free processes, and give back the polled modems.  The
+coordinator is the only one updating the cache database and writing the
+output file.
+
+A node dying in the middle of a sweep stops renewing the leases of its
+batches: they are queued again and taken by another node.
+"""
+
+from poller import poller, query_one_modem, failed_modem
+import queue
+import socket
+import time
+import os
+
+# Seconds after which a sweep without deadline gives up the batches which are
+# not completed yet (e.g. no node running): their modems are written as
+# timeouts.
+SWEEP_TIMEOUT = 3600
+
+class coordinator(poller):
+    """
+    Poller dispatching the modems to poller nodes (see pollernode) instead of
+    querying them with its own pool of processes.
+
+    :param workqueue: the workqueue shared with the nodes
+    :param batch_size: number of modems per batch
+    """
+    def __init__(self, workqueue, batch_size = 100, **kwargs):
+        super().__init__(**kwargs)
+        self.workqueue = workqueue
+        self.batch_size = batch_size
+
+    def _run_sweep(self):
+        self.query_all_ip_coordinated()
+
+    def query_all_ip_coordinated(self):
+        """
+        Open output file, queue all modems of the IP input file, and wait for
+        the nodes to poll them.  The modems of a batch which failed too many
+        times are written with the 'timeout' format, as well as the modems not
+        polled yet at the deadline of the sweep (or after SWEEP_TIMEOUT
+        seconds without deadline).
+        """
+        self._open_output_file()
+        now = time.time()
+        entities = [self._select_groups(entity, now) for entity in self.load_modems()]
+        sweep = '{}-{}'.format(self.timestamp.strftime('%Y%m%d-%H%M%S'), os.getpid())
+        remaining = self.workqueue.create_sweep(sweep, entities, self.batch_size)
+        self.traces.info("Sweep {}: {} modems queued in {} batches".format(sweep, len(entities), remaining))
+        deadline_time = self.deadline_time or now + SWEEP_TIMEOUT
+        written = set()
+        try:
+            while remaining and time.time() < deadline_time:
+                results = self.workqueue.fetch_results(sweep)
+                if not results:
+                    time.sleep(1)
+                    continue
+                for (state, items) in results:
+                    remaining -= 1
+                    if state == 'failed':
+                        self.stats['failed_batches'] += 1
+                        items = [failed_modem(entity) for entity in items]
+                    for modem in items:
+                        written.add(modem.hostname)
+                        self._write_result(modem)
+            if remaining:
+                # The batches still queued are deleted below: late results of
+                # the nodes are dropped.
+                for entity in entities:
+                    if entity['ip'] not in written:
+                        self.stats['cut'] += 1
+                        self._write_result(failed_modem(entity))
+                self.traces.warning("Sweep {}: {} batches not completed after {}s, {} modems cut".format(
+                    sweep, remaining, self.deadline or SWEEP_TIMEOUT, self.stats['cut']))
+        finally:
+            self.workqueue.delete_sweep(sweep)
+        self._close_output_file()
+
+class pollernode(poller):
+    """
+    Poller taking batches of modems from a workqueue, and querying them with
+    its local pool of processes.  New batches are taken as soon as processes
+    are free, so that fast nodes poll more modems than slow ones.
+
+    :param workqueue: the workqueue shared with the coordinator
+    :param name: name of the node, as recorded in the workqueue
+    """
+    def __init__(self, workqueue, **kwargs):
+        super().__init__(**kwargs)
+        self.workqueue = workqueue
+        self.name = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def _failed(self, entity, error):
+        """
+        Called by the pool when the query of a modem raised an exception: the
+        modem is given back to the coordinator in 'timeout' state, so that its
+        batch is completed anyway.
+
+        :return: the ch6643e object of the modem, see failed_modem()
+        """
+        self.traces.error("Query of modem {} failed: {!r}".format(entity['ip'], error))
+        return failed_modem(entity)
+
+    def serve_forever(self, idle_delay = 5):
+        """
+        Take and poll batches forever.
+
+        :param idle_delay: seconds to wait when the workqueue is empty
+        """
+        worker_pool = self._get_worker_pool()
+        done = queue.Queue()
+        batches = {}        # batch id -> [number of pending modems, list of polled modems]
+        in_flight = 0
+        last_renew = time.time()
+        try:
+            while True:
+                # Keep all processes busy, as long as there are batches to take.
+                while in_flight < self.processes:
+                    batch = self.workqueue.lease(self.name)
+                    if batch is None:
+                        break
+                    (batch_id, entities) = batch
+                    batches[batch_id] = [len(entities), []]
+                    in_flight += len(entities)
+                    for entity in entities:
+                        worker_pool.apply_async(query_one_modem, (entity,),
+                            callback = lambda modem, batch_id = batch_id: done.put((batch_id, modem)),
+                            error_callback = lambda error, batch_id = batch_id, entity = entity:
+                                done.put((batch_id, self._failed(entity, error))))
+                if not batches:
+                    time.sleep(idle_delay)
+                    continue
+
+                try:
+                    (batch_id, modem) = done.get(timeout = 1)
+                    in_flight -= 1
+                    batches[batch_id][0] -= 1
+                    batches[batch_id][1].append(modem)
+                    if batches[batch_id][0] == 0:
+                        self.workqueue.complete(batch_id, self.name, batches.pop(batch_id)[1])
+                except queue.Empty:
+                    pass
+
+                if time.time() - last_renew > self.workqueue.lease_time / 3:
+                    for batch_id in batches:
+                        if not self.workqueue.renew(batch_id, self.name):
+                            self.traces.warning("Lease of batch {} lost by {}".format(batch_id, self.name))
+                    last_renew = time.time()
+        finally:
+            self.close(terminate = True)
@@ -20,10 +20,15 @@ For command line argument, use the "--help" option.
 """
 
 from poller import poller
+from rollingpoller import rollingpoller
+from ch6643e import ch6643e
+from coordinator import coordinator, pollernode
+from workqueue import workqueue
 from cache  import cachedb
-import argparse, json, multiprocessing
+from logpipeline import logpipeline
+import snmptrace
+import argparse, json, multiprocessing, signal, sys
 import logging, logging.handlers
-from datetime import datetime
 from os.path import expanduser
 
 def init_traces(level):
@@ -52,6 +57,22 @@ def activate_log_file(level, filename):
     fh.setFormatter(formatter)
     traces.addHandler(fh)
 
+def activate_trace_file(filename):
+    """
+    Attach a file Handler to the 'snmptrace' logger: one JSON object per
+    line (see snmptrace).
+
+    :param filename: filename to be used.
+    """
+    trace = logging.getLogger(snmptrace.TRACE_LOGGER)
+    trace.setLevel(logging.INFO)
+    trace.propagate = False
+    fh = logging.handlers.RotatingFileHandler(filename,
+         mode='a', maxBytes=1024*1024*10, backupCount=10, encoding='utf-8')
+    fh.setLevel(logging.INFO)
+    fh.setFormatter(logging.Formatter('%(message)s'))
+    trace.addHandler(fh)
+
 def load_json_config(filename):
     """
     Load the JSON configuration file
@@ -84,9 +105,131 @@ def manage_cli_arguments():
     parser.add_argument('--config',  '-c', dest="config_file", help="""
         configuration file to use.""")
     parser.add_argument('--parallel', '-p', type=int, help="Number of queries to run in parallel. The default is the number of available CPU")
+    parser.add_argument('--engine', choices=['pool', 'batch', 'hybrid', 'thread'], help="""
+        pool: every process of the pool queries one modem at a time. batch:
+        every process receives batches of modems, queries --concurrency modems
+        simultaneously with threads, and sends back compact results. hybrid:
+        same as batch, but every process runs an asyncio event loop, with a
+        pure Python SNMP implementation (no easysnmp); --parallel should then
+        be about the number of CPU cores. thread: no process, --parallel
+        threads of the poller query one modem at a time, sharing its memory:
+        much less RAM than pool for the same --parallel value.""")
+    parser.add_argument('--adaptive', type=int, metavar='MIN', help="""
+        Adapt the number of modems queried at the same time between MIN and
+        --parallel: it grows as long as the modems answer quickly, and is
+        halved as soon as they time out or slow down. The window is logged at
+        every change. Only with the pool and thread engines.""")
+    parser.add_argument('--transport', choices=['pipe', 'shm'], help="""
+        How the batch and hybrid engines send the polled modems to the parent
+        process: pickled through pipes, or written in shared memory ring
+        buffers (one per process), which costs much less CPU to the parent.
+        The rings are not reused by new processes: shm can't be used with
+        --max-tasks.""")
+    parser.add_argument('--start-method', choices=['fork', 'forkserver', 'spawn'], help="""
+        How the processes of the pool are started. With forkserver, they are
+        forked from a server process which already imported the SNMP modules,
+        and do not inherit the cache database connection nor the open files of
+        the poller. The default is the one of the platform (fork on Linux).""")
+    parser.add_argument('--concurrency', type=int, help="""
+        Number of simultaneous queries per process with the batch and hybrid
+        engines. The default is 10 with batch, 1000 with hybrid.""")
     parser.add_argument('--cachedb', '-s', help="file to be used for the cache database. It is an sqlite3 database")
-    parser.add_argument('--output', '-o', help="Output file")
-    parser.add_argument('ipfile', help="""file containing modem to be queried. Format is one modem per line:
+    parser.add_argument('--output', '-o', help="""Output file. The default is
+        results_<timestamp>.txt. In daemon mode, it is a strftime pattern used
+        for the output file of every sweep.""")
+    parser.add_argument('--daemon', action="store_true", help="""
+        Keep running and query all modems every --interval seconds, instead of
+        one single sweep. The pool of processes, the cache database and the IP
+        file are kept in memory between sweeps (the IP file is read again only
+        when it is modified).""")
+    parser.add_argument('--interval', '-i', type=int, help="Seconds between two sweeps in daemon mode.")
+    parser.add_argument('--schedule', action='append', metavar='GROUP=SECONDS', help="""
+        Query the metric group GROUP (counters, configdata or signals) at most
+        every SECONDS seconds. The latest values of the skipped groups are taken
+        from the cache database. Can be repeated. By default, all groups are
+        queried at every sweep.""")
+    parser.add_argument('--config-refresh', type=int, metavar='MAXAGE', help="""
+        Query the configuration data (firmware, configuration file, boot state,
+        WAN address...) only when the modem rebooted since the previous query
+        (its uptime decreased), or when the cached values are older than MAXAGE
+        seconds. The number of skipped configuration queries is logged at the end
+        of every sweep.""")
+    parser.add_argument('--deadline', type=int, metavar='SECONDS', help="""
+        Maximal duration of a sweep. No new modem is queried shortly before
+        the deadline; at the deadline, the modems not polled yet are written
+        with the 'timeout' format, so that the output file is renamed on time.
+        The processes still querying modems are stopped. The number of
+        modems cut is logged. Typically a bit less than --interval (or than the period of
+        the cron job).""")
+    parser.add_argument('--retries', type=int, help="""
+        SNMP retries of every request during the sweep. The default is 1;
+        with --retry-pass, 0 frees the workers sooner.""")
+    parser.add_argument('--retry-pass', type=float, metavar='TIMEOUT', help="""
+        Second chance for the modems which timed out: they are queried again
+        at the end of the sweep, with a TIMEOUT seconds SNMP timeout and no
+        retry, as long as --deadline allows it. Their line is written once,
+        with the result of the second chance. The number of modems retried and
+        recovered is logged.""")
+    parser.add_argument('--retry-concurrency', type=int, help="""
+        Number of modems queried at the same time during the second chance (by
+        every process with the batch and hybrid engines). The default is the
+        same as during the sweep.""")
+    parser.add_argument('--resume', action="store_true", help="""
+        Checkpoint the sweep every 30 seconds, and resume the previous sweep
+        if it was interrupted (crash, kill, reboot...): only the modems
+        missing in its '.ongoing' output file are queried, and appended to
+        it. Every polled modem is written at once in the '.ongoing' file, the
+        checkpoints sync it to disk. Requires --output, as the output file identifies the sweep.""")
+    parser.add_argument('--watchdog', type=int, metavar='SECONDS', help="""
+        Kill a process of the pool stuck for more than SECONDS seconds on one
+        modem (hung SNMP library...): the pool starts a new process, and the
+        modem is given to another process once (then written with the
+        'timeout' format). Typically a few times the SNMP timeout. Only with
+        the pool engine.""")
+    parser.add_argument('--max-rss', type=int, metavar='MB', help="""
+        Replace a process of the pool once its memory (maximal RSS) exceeds
+        MB megabytes, e.g. because of a leak in the SNMP library. Only with
+        the pool engine.""")
+    parser.add_argument('--max-tasks', type=int, metavar='N', help="""
+        Replace every process of the pool after N tasks (modems with the pool
+        engine, batches with the batch and hybrid engines). The number of
+        processes started, the processes killed and replaced and their
+        highest memory usage are logged at the end of every sweep.""")
+    parser.add_argument('--trace-sample', type=float, metavar='FRACTION', help="""
+        Trace the SNMP exchanges of this fraction of the modems (e.g. 0.001),
+        always the same ones: OIDs, start and duration of every request, size
+        of the responses, GET BULK requests per walk. One JSON line per modem
+        and query is written in --trace-file.""")
+    parser.add_argument('--trace-mac', action='append', metavar='MAC', help="""
+        Trace the SNMP exchanges of the modems with these MAC addresses
+        (comma separated, any format). Can be repeated.""")
+    parser.add_argument('--trace-file', help="File of the SNMP traces, rotated every 10 MB.")
+    parser.add_argument('--shard', metavar='I/N', help="""
+        Only query the shard I (from 0 to N-1) of the modems, out of N shards.
+        Modems are dispatched among shards with a hash of their MAC (or IP, see
+        --shard-key), so that N poller nodes can share the same IP file
+        without polling a modem twice. The outputs and cache databases of all
+        shards can be combined with merge_shards.py.""")
+    parser.add_argument('--shard-key', choices=['mac', 'ip'], help="Field used to dispatch the modems among the shards.")
+    parser.add_argument('--rolling', action="store_true", help="""
+        Daemon mode with a continuous scheduler: every modem is queried every
+        --interval seconds, at its own due time, so that queries are spread
+        evenly over the interval instead of being fired all at once. Results
+        are written in one output file per --slice seconds.""")
+    parser.add_argument('--slice', type=int, help="""
+        Duration in seconds covered by one output file in rolling mode. The
+        default is --interval.""")
+    parser.add_argument('--coordinator', metavar='QUEUE', help="""
+        Do not query the modems locally, but queue them in batches in the
+        QUEUE SQLite database file, for the poller nodes (see --node). The
+        coordinator collects the results, updates the cache and writes the
+        output file. Batches of dead nodes are queued again.""")
+    parser.add_argument('--batch-size', type=int, help="Number of modems per batch in coordinator mode.")
+    parser.add_argument('--node', metavar='QUEUE', help="""
+        Poller node: take batches of modems from the QUEUE SQLite database
+        file filled by a coordinator, query them with the local pool of
+        processes and give back the results. Runs forever, no IP file needed.""")
+    parser.add_argument('ipfile', nargs='?', help="""file containing modem to be queried. Format is one modem per line:
           bpid;mac;private_ip.
           Example: 0091000060;5c353bef6106;10.133.28.103""")
 
@@ -95,9 +238,69 @@ def manage_cli_arguments():
     parser.set_defaults(config_file= "{}/.docsispy/docsispy.secret".format(expanduser("~")))
     parser.set_defaults(parallel = multiprocessing.cpu_count())
     parser.set_defaults(cachedb = "{}/.docsispy/docsispy.db".format(expanduser("~")))
-    parser.set_defaults(output = 'results_{}.txt'.format(datetime.today().strftime('%Y%m%d-%H%M%S')) )
+    parser.set_defaults(interval = 300)
+    parser.set_defaults(shard_key = 'mac')
+    parser.set_defaults(batch_size = 100)
+    parser.set_defaults(engine = 'pool')
+    parser.set_defaults(transport = 'pipe')
+    parser.set_defaults(trace_file = 'launch_poller-trace.jsonl')
     args = parser.parse_args()
+    if not args.ipfile and not args.node:
+        parser.error("the ipfile argument is required")
+    if args.engine in ('batch', 'hybrid') and (args.rolling or args.node):
+        parser.error("--rolling and --node require the pool or thread engine")
+    if args.transport == 'shm' and args.engine in ('pool', 'thread'):
+        parser.error("--transport shm requires the batch or hybrid engine")
+    if args.deadline is not None and (args.rolling or args.node):
+        parser.error("--deadline can't be used with --rolling nor --node")
+    if args.retry_pass is not None and (args.rolling or args.coordinator or args.node):
+        parser.error("--retry-pass can't be used with --rolling, --coordinator nor --node")
+    if args.resume and (args.daemon or args.rolling or args.coordinator or args.node):
+        parser.error("--resume can't be used with --daemon, --rolling, --coordinator nor --node")
+    if args.resume and not args.output:
+        parser.error("--resume requires --output")
+    if (args.watchdog or args.max_rss) and args.engine != 'pool':
+        parser.error("--watchdog and --max-rss require the pool engine")
+    if (args.watchdog or args.max_rss) and (args.rolling or args.coordinator or args.node):
+        parser.error("--watchdog and --max-rss can't be used with --rolling, --coordinator nor --node")
+    if args.max_tasks is not None and args.engine == 'thread':
+        parser.error("--max-tasks can't be used with the thread engine")
+    if args.max_tasks is not None and args.transport == 'shm':
+        parser.error("--max-tasks can't be used with --transport shm")
+    if args.adaptive is not None and args.engine not in ('pool', 'thread'):
+        parser.error("--adaptive requires the pool or thread engine")
+    if args.trace_sample is not None and not 0 <= args.trace_sample <= 1:
+        parser.error("--trace-sample must be between 0 and 1")
+    args.trace_mac = [mac for macs in args.trace_mac or [] for mac in macs.split(',') if mac.strip()]
+    if args.concurrency is None:
+        args.concurrency = 1000 if args.engine == 'hybrid' else 10
+
+    schedules = {}
+    for schedule in args.schedule or []:
+        try:
+            (group, seconds) = schedule.split('=')
+            schedules[group] = int(seconds)
+        except ValueError:
+            parser.error("invalid --schedule value: '{}'".format(schedule))
+        if group not in ch6643e.GROUPS:
+            parser.error("invalid group in --schedule: '{}' (choose from {})".format(group, ', '.join(ch6643e.GROUPS)))
+    if args.config_refresh:
+        schedules['configdata'] = args.config_refresh
+    if schedules and not args.usage:
+        parser.error("--schedule and --config-refresh require the cache database, they can't be used with --no-usage")
+    args.schedule = schedules
+
+    if args.shard:
+        try:
+            (index, count) = [int(x) for x in args.shard.split('/')]
+        except ValueError:
+            parser.error("invalid --shard value: '{}' (expected I/N)".format(args.shard))
+        if not 0 <= index < count:
+            parser.error("invalid --shard value: '{}' (I must be between 0 and N-1)".format(args.shard))
+        args.shard = (index, count)
 
+    if args.trace_sample or args.trace_mac:
+        activate_trace_file(args.trace_file)
     if args.debug:
         activate_log_file(logging.DEBUG, "launch_poller.log")
     if args.verbose:
@@ -116,16 +319,53 @@ if __name__ == '__main__':
     activate_log_file(logging.ERROR, "launch_poller-error.log")
     traces = logging.getLogger('traces')
     args = manage_cli_arguments()
+    # From now on, the log files are written by one thread, for the poller
+    # and all its processes.
+    log_pipeline = logpipeline(args.start_method, loggers = ('traces', snmptrace.TRACE_LOGGER))
+    log_pipeline.start()
     traces.info("Start of the program")
-    config = load_json_config(args.config_file)
+    if args.node:
+        # Nodes get the community string with every modem from the coordinator.
+        config = {'read_community': None}
+    else:
+        config = load_json_config(args.config_file)
 
-    poller = poller(ip_file = args.ipfile, processes = args.parallel,
-                read_community = config['read_community'], output_file = args.output)
+    options = dict(ip_file = args.ipfile, processes = args.parallel,
+                read_community = config['read_community'], output_file = args.output,
+                schedules = args.schedule, config_on_reboot = bool(args.config_refresh),
+                shard = args.shard, shard_key = args.shard_key,
+                engine = args.engine, concurrency = args.concurrency,
+                start_method = args.start_method, transport = args.transport,
+                min_parallel = args.adaptive, deadline = args.deadline, retries = args.retries,
+                retry_timeout = args.retry_pass, retry_concurrency = args.retry_concurrency,
+                resume = args.resume, watchdog = args.watchdog, max_tasks = args.max_tasks,
+                max_rss = args.max_rss, log_pipeline = log_pipeline,
+                trace_sample = args.trace_sample, trace_macs = args.trace_mac)
+    if args.node:
+        poller = pollernode(workqueue(file_name = args.node), **options)
+    elif args.coordinator:
+        poller = coordinator(workqueue(file_name = args.coordinator), batch_size = args.batch_size, **options)
+    elif args.rolling:
+        poller = rollingpoller(slice_length = args.slice, **options)
+    else:
+        poller = poller(**options)
 
-    if args.usage:
+    if args.usage and not args.node:
         cache = cachedb(file_name = args.cachedb)
         poller.cachedb = cache
 
     traces.debug("Config: %s", config)
 
-    poller.query_all()
+    # Let SIGTERM stop the pool of processes (see poller.close()), and flush
+    # the log files.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if args.node:
+            poller.serve_forever()
+        elif args.daemon or args.rolling:
+            poller.serve_forever(interval = args.interval,
+                output_pattern = args.output or 'results_%Y%m%d-%H%M%S.txt')
+        else:
+            poller.query_all()
+    finally:
+        log_pipeline.stop()
@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+# vim: set fileencoding=utf-8
+# (c) © 2016-2017 Xavier Lüthi xavier@luthi.eu
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See LICENSE.txt for the full license text.
+
+"""
+Logging of the poller and of its worker processes through one queue.
+
+The handlers of the 'traces' logger (log files, console), and of the
+'snmptrace' one with --trace-sample (see snmptrace), are moved to one
+listener thread of the poller, which does all the file I/O and the rotation
+of the log files.  The poller and the processes of the pool only put their
+records in a multiprocessing queue: no process waits for a log file, and a
+log file is never rotated by several processes at the same time.  A record is
+written in the pipe of the queue by the logging thread itself: it only waits
+if the listener is late by a full pipe buffer.
+
+Repeated warnings and errors (same line of code) are rate limited by the
+listener, so that an outage of the plant does not fill the disk.
+"""
+
+import logging
+import logging.handlers
+import multiprocessing
+import signal
+import time
+
+# At most RATE_BURST records per line of code (warnings and errors) every
+# RATE_PERIOD seconds
+RATE_BURST = 10
+RATE_PERIOD = 60
+
+class ratelimit(logging.Filter):
+    """
+    Filter of the listener dropping the records of a line of code beyond
+    *burst* per *period* seconds (warnings and errors only).  The number of
+    records dropped is added to the next record let through, and logged by
+    flush().
+
+    :param counters: dict (logger, level, file, line) -> list [start of the
+           period, records in the period, records dropped]
+    """
+    def __init__(self, burst = RATE_BURST, period = RATE_PERIOD):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.counters = {}
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.name, record.levelno, record.pathname, record.lineno)
+        now = time.time()
+        counter = self.counters.get(key)
+        if counter is None or now - counter[0] >= self.period:
+            dropped = counter[2] if counter else 0
+            counter = self.counters[key] = [now, 0, 0]
+            if dropped:
+                record.msg = "{} ({} similar messages dropped)".format(record.getMessage(), dropped)
+                record.args = None
+        counter[1] += 1
+        if counter[1] > self.burst:
+            counter[2] += 1
+            return False
+        return True
+
+    def flush(self):
+        """
+        :return: the number of records dropped since the start of their
+                 current period, logged by the 'traces' logger
+        """
+        dropped = sum([counter[2] for counter in self.counters.values()])
+        if dropped:
+            # At the level of the most severe of them, to reach the same files
+            level = max([key[1] for (key, counter) in self.counters.items() if counter[2]])
+            logging.getLogger('traces').log(level, "{} repeated log messages dropped".format(dropped))
+        self.counters = {}
+        return dropped
+
+class queuehandler(logging.handlers.QueueHandler):
+    """
+    Handler putting the records in the SimpleQueue of a logpipeline.
+
+    The record is written in the pipe by the logging thread itself, under the
+    write lock of the queue (no feeder thread, unlike multiprocessing.Queue),
+    with SIGALRM and SIGTERM blocked: a process killed by its watchdog (see
+    poller.query_one_modem_watched()) or terminated by the poller dies after
+    the record is written and the lock released, never in between.  So such
+    a process only loses the records it had not logged yet.  The poller never
+    sends SIGKILL, which would leave the queue locked.
+    """
+    def enqueue(self, record):
+        mask = signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGALRM, signal.SIGTERM])
+        try:
+            self.queue.put(record)
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+
+class loglistener(logging.handlers.QueueListener):
+    """
+    Listener thread of a logpipeline: the records are rate limited once, and
+    given to the handlers of their logger.
+
+    :param handlers: dict logger name -> list of handlers
+    """
+    def __init__(self, queue, limiter, handlers):
+        super().__init__(queue, *[handler for name in handlers for handler in handlers[name]],
+                         respect_handler_level = True)
+        self.limiter = limiter
+        self.logger_handlers = handlers
+
+    def dequeue(self, block):
+        # SimpleQueue.get() always blocks
+        return self.queue.get()
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+    def handle(self, record):
+        if not self.limiter.filter(record):
+            return
+        record = self.prepare(record)
+        for handler in self.logger_handlers.get(record.name, []):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+class logpipeline(object):
+    """
+    Queue of the records of some loggers ('traces' by default), and listener
+    thread writing them with the handlers of these loggers.
+
+    :param queue: multiprocessing SimpleQueue of the records, shared with
+           the processes of the pool (see attach() and queuehandler)
+    :param levels: dict logger name -> lowest level of its handlers: records
+           below it are not even put in the queue
+    :param limiter: ratelimit filter of the listener
+    :param logger_levels: dict logger name -> level of the logger before
+           start()
+    """
+    def __init__(self, start_method = None, loggers = ('traces',)):
+        """
+        :param start_method: start method of the pool (see
+               poller.start_method): the queue must come from the same context
+        :param loggers: names of the loggers
+        """
+        self.queue = multiprocessing.get_context(start_method).SimpleQueue()
+        self.loggers = loggers
+        self.listener = None
+        self.limiter = ratelimit()
+        self.levels = {}
+        self.logger_levels = {}
+
+    def start(self):
+        """
+        Move the handlers of the loggers to the listener thread, and make the
+        loggers put their records in the queue.
+        """
+        handlers = {}
+        for name in self.loggers:
+            logger = logging.getLogger(name)
+            handlers[name] = list(logger.handlers)
+            self.logger_levels[name] = logger.level
+            self.levels[name] = max(logger.level, min([handler.level for handler in handlers[name]]
+                                                      or [logging.CRITICAL]))
+        self.listener = loglistener(self.queue, self.limiter, handlers)
+        self.listener.start()
+        attach(self.queue, self.levels)
+
+    def stop(self):
+        """
+        Write the records left in the queue, and give the handlers back to
+        their loggers.
+        """
+        if self.listener is None:
+            return
+        detach(self.loggers)
+        self.listener.stop()
+        for (name, handlers) in self.listener.logger_handlers.items():
+            logger = logging.getLogger(name)
+            for handler in handlers:
+                logger.addHandler(handler)
+            logger.setLevel(self.logger_levels[name])
+        self.listener = None
+        self.limiter.flush()
+
+def attach(queue, levels):
+    """
+    Make the loggers of the current process put their records in *queue*.
+    Called in every process of the pool (see poller.init_worker()), which
+    otherwise would inherit the handlers of the poller (fork) or have none at
+    all (forkserver, spawn).
+
+    :param queue: logpipeline.queue
+    :param levels: logpipeline.levels
+    """
+    detach(levels)
+    handler = queuehandler(queue)
+    for (name, level) in levels.items():
+        logger = logging.getLogger(name)
+        logger.addHandler(handler)
+        logger.setLevel(level)
+
+def detach(loggers):
+    """
+    Remove all handlers of the loggers of the current process.
+
+    :param loggers: names of the loggers
+    """
+    for name in loggers:
+        logger = logging.getLogger(name)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+# vim: set fileencoding=utf-8
+# (c) © 2016-2017 Xavier Lüthi xavier@luthi.eu
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See LICENSE.txt for the full license text.
+
+"""
+Combine the results of several poller nodes launched with the "--shard"
+option: the output files are merged in one single results file, and the cache
+databases are reconciled.
+
+For command line argument, use the "--help" option.
+"""
+
+from cache import cachedb
+import argparse
+import logging
+import os
+from datetime import datetime
+
+def merge_outputs(output_file, shard_files):
+    """
+    Concatenate the output files of all shards in one single file.  If a modem
+    is present in several files (e.g. the number of shards changed during the
+    sweep), only its first line is kept.  Modems are identified by their IP
+    address: the MAC address of a modem which timed out may be unknown.
+
+    :param output_file: name of the merged output file
+    :param shard_files: list of output files of the shards
+    :return: a tuple (number of lines written, number of duplicates dropped)
+    """
+    traces = logging.getLogger('traces')
+    seen = set()
+    written = 0
+    duplicates = 0
+    with open(output_file + '.ongoing', 'w') as out:
+        for shard_file in shard_files:
+            with open(shard_file, 'r') as f:
+                for line in f:
+                    # The 4th field of every line is the IP address of the modem
+                    ip = line.split(';', 4)[3]
+                    if ip in seen:
+                        traces.warning("Modem {} present in several shards, line dropped from {}".format(ip, shard_file))
+                        duplicates += 1
+                        continue
+                    seen.add(ip)
+                    out.write(line)
+                    written += 1
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(output_file + '.ongoing', output_file)
+    return (written, duplicates)
+
+def merge_cachedbs(cachedb_file, shard_cachedbs, sync = False):
+    """
+    Import the cache databases of all shards into *cachedb_file*, keeping the
+    most recent values of every modem.
+
+    :param cachedb_file: the cache database receiving the merged content
+    :param shard_cachedbs: list of cache databases of the shards
+    :param sync: if True, the merged content is copied back to every shard
+           database, so that a modem moving to another shard keeps consistent
+           usage deltas.
+    """
+    traces = logging.getLogger('traces')
+    cache = cachedb(file_name = cachedb_file)
+    for shard_cachedb in shard_cachedbs:
+        traces.info("{}: {} rows imported".format(shard_cachedb, cache.merge(shard_cachedb)))
+    if sync:
+        for shard_cachedb in shard_cachedbs:
+            shard_cache = cachedb(file_name = shard_cachedb)
+            shard_cache.merge(cachedb_file)
+            shard_cache.connection.close()
+    cache.connection.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Merge the outputs and cache databases of sharded poller nodes.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--verbose', '-v', action='count', help='Verbose output.')
+    parser.add_argument('--output', '-o', help="Merged output file. The default is results_<timestamp>.txt")
+    parser.add_argument('--cachedb', '-s', help="Cache database receiving the content of all --shard-cachedb")
+    parser.add_argument('--shard-cachedb', action='append', default=[], help="Cache database of one shard. Can be repeated.")
+    parser.add_argument('--sync', action='store_true', help="""
+        Copy the merged cache database back to every shard database.""")
+    parser.add_argument('results', nargs='*', help="Output files of the shards")
+    args = parser.parse_args()
+
+    traces = logging.getLogger('traces')
+    traces.setLevel(logging.INFO)
+    sh = logging.StreamHandler()
+    sh.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    traces.addHandler(sh)
+
+    if args.results:
+        output = args.output or 'results_{}.txt'.format(datetime.today().strftime('%Y%m%d-%H%M%S'))
+        (written, duplicates) = merge_outputs(output, args.results)
+        traces.info("{}: {} modems written, {} duplicates dropped".format(output, written, duplicates))
+    if args.cachedb:
+        merge_cachedbs(args.cachedb, args.shard_cachedb, args.sync)
@@ -13,16 +13,50 @@
 #
 # See LICENSE.txt for the full license text.
 
-from ch6643e import ch6643e
+from ch6643e import ch6643e, normalize_mac
 from cache import cachedb
+from resultring import resultring
+from aimd import aimd
+import snmp
+import snmptrace
+import logpipeline
 from datetime import datetime
+from collections import Counter
 import csv
 import os
 import json
+import time
+import signal
+import zlib
+import itertools
+import contextlib
+import queue
+import resource
+import threading
 import multiprocessing
-from multiprocessing import Pool, Queue
+from multiprocessing.pool import ThreadPool
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 
+# Modules imported once by the fork server (see poller.start_method), and
+# inherited by all processes it forks.  Missing ones (e.g. easysnmp with the
+# hybrid engine) are ignored.  The modules of launch_poller.py are listed too,
+# as the main script is run again in every new process.
+PRELOAD_MODULES = ['__main__', 'poller', 'rollingpoller', 'coordinator', 'workqueue', 'ch6643e',
+                   'logpipeline', 'snmp', 'snmptrace', 'easysnmp', 'argparse']
+
+# Seconds before the deadline of a sweep after which no new modem is queried:
+# about the duration of a query which times out (7s timeout, 1 retry).  It is
+# reduced to 10% of the deadline for very short ones.
+DEADLINE_MARGIN = 15
+
+# Seconds between two checkpoints of a sweep, with resume (see _checkpoint())
+CHECKPOINT_INTERVAL = 30
+
+# Seconds given to the watchdog of a process to kill it, before the parent
+# terminates it and gives its task up (see _lost_tasks())
+WATCHDOG_GRACE = 5
+
 class poller:
     """
     Based on an ip.txt input file, it query all modems and produce a CSV file
@@ -33,9 +67,103 @@ class poller:
     :param read_community: SNMP community string to use for read-only access
     :param cachedb: cachedb object to use for usage computation
     :param output_file: name of the CSV output file
+    :param output_pattern: strftime pattern used to name the output file of
+           every sweep in daemon mode (see serve_forever)
+    :param worker_pool: pool of processes (or of threads with the 'thread'
+           engine), kept alive between sweeps
+    :param entities: list of modems (dict) read from the IP input file
+    :param schedules: dict metric group -> minimal number of seconds between
+           two queries of this group (see ch6643e.GROUPS).  Groups not listed
+           are queried at every sweep.  Requires a cachedb.
+    :param config_on_reboot: if True, the configuration data are also queried
+           as soon as the modem rebooted (uptime lower than at the previous
+           query), regardless of self.schedules['configdata'].
+    :param stats: counters describing the current sweep, logged at its end
+    :param shard: tuple (index, count): only query the modems belonging to the
+           shard *index* out of *count* (see in_shard()), or None for all modems
+    :param shard_key: field of the IP file used to dispatch the modems among the
+           shards: 'mac' or 'ip'
+    :param engine: how modems are given to the pool of processes: 'pool' (one
+           modem per task), 'batch' (batches of modems polled by threads, see
+           query_modem_batch()), 'hybrid' (batches of modems polled by the
+           event loop of every process, see query_modem_batch_async()) or
+           'thread' (no process at all: one modem per task, in a pool of
+           self.processes threads of the poller itself)
+    :param concurrency: number of modems polled simultaneously by every
+           process with the 'batch' and 'hybrid' engines
+    :param transport: how the batch and hybrid engines send the polled modems
+           to the parent: 'pipe' (pickled records through the result queue of
+           the pool) or 'shm' (fixed-size records in shared memory, see
+           resultring.py)
+    :param result_ring: the resultring of the pool, with the 'shm' transport
+    :param result_queue: queue through which the processes of the pool send
+           the polled modems with the batch and hybrid engines, as soon as
+           they are polled (see resultstream)
+    :param code_tables: dict process id -> list of strings, the code tables of
+           the processes of the pool (see encode_records())
+    :param strings: dict used to intern the strings of the code tables: the
+           same string object is shared by all modems
+    :param start_method: multiprocessing start method of the pool of
+           processes: 'fork', 'forkserver' (processes are forked from a server
+           process which preloaded PRELOAD_MODULES, and inherit nothing from
+           the poller itself: no database connection nor open file), 'spawn',
+           or None for the default of the platform
+    :param min_parallel: if not None, the number of modems queried at the same
+           time by the 'pool' and 'thread' engines adapts between min_parallel
+           and processes, according to the timeouts and query times (see
+           aimd.py)
+    :param controller: the aimd object, with min_parallel
+    :param deadline: maximal duration of a sweep in seconds, or None.  No new
+           modem is queried DEADLINE_MARGIN seconds before the deadline, and
+           the modems not polled at the deadline are written as timeouts, so
+           that the output file is complete on time.
+    :param deadline_time: time of the deadline of the current sweep, or None
+    :param retries: SNMP retries of every request, or None for the default of
+           ch6643e
+    :param retry_timeout: if not None, the modems which timed out get a second
+           chance at the end of the sweep: they are queried again with this
+           SNMP timeout (seconds) and no retry (see _write_results())
+    :param retry_concurrency: maximal number of modems queried at the same
+           time during the second chance, or None for the same as the sweep
+    :param resume: if True, the sweep is checkpointed every
+           CHECKPOINT_INTERVAL seconds in the file '<output file>.checkpoint',
+           and a sweep interrupted before its end (crash, kill...) is resumed
+           by the next one writing the same output file: only the modems not
+           written yet in the '.ongoing' file are queried, and appended to it
+    :param resumed: set of the IP addresses of the modems already written by
+           the interrupted sweep, or None
+    :param watchdog: with the 'pool' engine, maximal duration of the query of
+           one modem (seconds), or None: a process stuck longer is killed, and
+           the modem given to another one (see _query_modems_watched())
+    :param max_tasks: number of tasks after which a process of the pool is
+           replaced by a new one, or None
+    :param max_rss: with the 'pool' engine, maximal memory (RSS, in MB) of a
+           process of the pool, or None: a process which exceeds it is
+           replaced by a new one
+    :param watch_slots: shared array with the state of every process of the
+           pool, with watchdog or max_rss (see init_worker())
+    :param worker_starts: shared counter of the processes started
+    :param workers_counted: value of worker_starts at the end of the previous
+           sweep
+    :param task_serials: serial numbers of the tasks given to the watched
+           processes, unique over the life of the poller
+    :param abandoned: AsyncResults of the watched tasks given up (process
+           killed, or deadline of the sweep): the pool never completes some of
+           them, so it is terminated instead of joined by close()
+    :param log_pipeline: logpipeline object started by the caller, through
+           which the processes of the pool log, or None
+    :param trace_sample: fraction of the modems whose SNMP exchanges are
+           traced (see snmptrace), or None
+    :param trace_macs: MAC addresses of modems traced in any case
     """
     def __init__(self, ip_file = 'ip.txt', processes = multiprocessing.cpu_count(),
-                 read_community = 'public', cachedb = None, output_file = None):
+                 read_community = 'public', cachedb = None, output_file = None,
+                 schedules = None, config_on_reboot = False, shard = None, shard_key = 'mac',
+                 engine = 'pool', concurrency = 10, start_method = None, transport = 'pipe',
+                 min_parallel = None, deadline = None, retries = None,
+                 retry_timeout = None, retry_concurrency = None, resume = False,
+                 watchdog = None, max_tasks = None, max_rss = None, log_pipeline = None,
+                 trace_sample = None, trace_macs = None):
         self.ip_file   = ip_file
         self.processes   = processes
         self.timestamp = datetime.today()
@@ -44,20 +172,450 @@ class poller:
         self.read_community     = read_community
         self.cachedb = cachedb
         self.traces = logging.getLogger('traces')
+        self.output_pattern = None
         if output_file:
             self.out_filename = output_file
         else:
             self.out_filename = 'results_{}.txt'.format(self.timestamp.strftime('%Y%m%d-%H%M%S'))
 
+        self.worker_pool = None
+        self.entities = []
+        self.ip_file_mtime = None
+        self.schedules = schedules or {}
+        self.config_on_reboot = config_on_reboot
+        self.group_timestamps = None
+        self.uptimes = None
+        self.stats = Counter()
+        self.shard = shard
+        self.shard_key = shard_key
+        self.engine = engine
+        self.concurrency = concurrency
+        self.start_method = start_method
+        self.transport = transport
+        self.result_ring = None
+        self.result_queue = None
+        self.code_tables = {}
+        self.strings = {}
+        self.controller = None
+        self.deadline = deadline
+        self.deadline_time = None
+        self.retries = retries
+        self.retry_timeout = retry_timeout
+        self.retry_concurrency = retry_concurrency
+        self.resume = resume
+        self.resumed = None
+        self.next_checkpoint = None
+        self.watchdog = watchdog
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.watch_slots = None
+        self.worker_starts = None
+        self.workers_counted = 0
+        self.task_serials = itertools.count(1)
+        self.abandoned = []
+        self.log_pipeline = log_pipeline
+        self.trace_sample = trace_sample
+        self.trace_macs = set([normalize_mac(mac) for mac in trace_macs or []])
+        if min_parallel is not None:
+            self.controller = aimd(min_parallel, processes)
+
     def __debug(self,msg):
         self.traces.debug(msg)
 
     def _open_output_file(self):
-        self.out = open(self.out_filename + '.ongoing' , 'w')
+        if self.resumed is not None:
+            self.out = open(self.out_filename + '.ongoing' , 'a')
+        else:
+            self.out = open(self.out_filename + '.ongoing' , 'w')
+        if self.resume:
+            self._checkpoint()
 
     def _close_output_file(self):
+        """
+        Close the '.ongoing' file and rename it to its final name.  Data are
+        synced to disk before the rename, so that the final file is either
+        absent or complete, never partially written.
+        """
+        self.out.flush()
+        os.fsync(self.out.fileno())
         self.out.close()
-        os.rename(self.out_filename + '.ongoing', self.out_filename)
+        if self.cachedb is not None:
+            self.cachedb.commit_groups()
+        os.replace(self.out_filename + '.ongoing', self.out_filename)
+        if self.resume and os.path.exists(self.out_filename + '.checkpoint'):
+            os.remove(self.out_filename + '.checkpoint')
+        self.resumed = None
+        self.next_checkpoint = None
+
+    def _checkpoint(self):
+        """
+        Sync the '.ongoing' file to disk, and record how far it is valid in
+        the checkpoint file (written atomically).  The cache database commits
+        the usage of every modem by itself, and the metric groups stored since
+        the previous checkpoint here.  The modems written are the lines of
+        the '.ongoing' file: see _load_checkpoint().
+        """
+        self.out.flush()
+        os.fsync(self.out.fileno())
+        if self.cachedb is not None:
+            self.cachedb.commit_groups()
+        checkpoint = {'ip_file': os.path.abspath(self.ip_file), 'offset': self.out.tell(),
+                      'started': self.timestamp.strftime('%Y%m%d-%H%M%S')}
+        with open(self.out_filename + '.checkpoint.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(self.out_filename + '.checkpoint.tmp', self.out_filename + '.checkpoint')
+        self.next_checkpoint = time.time() + CHECKPOINT_INTERVAL
+
+    def _load_checkpoint(self):
+        """
+        Look for a sweep interrupted while writing the same output file, with
+        the same IP file.  Its '.ongoing' file is kept up to its last complete
+        line, which can't be before the offset of the checkpoint.
+
+        :return: the set of the IP addresses of the modems already written in
+                 the '.ongoing' file, or None if there is no sweep to resume
+        """
+        try:
+            with open(self.out_filename + '.checkpoint') as f:
+                checkpoint = json.load(f)
+            ongoing = open(self.out_filename + '.ongoing', 'r+b')
+        except (OSError, ValueError):
+            return None
+        with ongoing:
+            data = ongoing.read()
+            end = data.rfind(b'\n') + 1
+            if checkpoint.get('ip_file') != os.path.abspath(self.ip_file) or end < checkpoint.get('offset', 0):
+                self.traces.warning("Checkpoint of {} ignored: other IP file, or output file truncated".format(self.out_filename))
+                return None
+            ongoing.truncate(end)
+        # The 4th field of every line is the IP address of the modem
+        resumed = set([line.split(';', 4)[3] for line in data[:end].decode('utf-8').splitlines()])
+        self.traces.info("Resuming the sweep started at {}: {} modems already written in {}.ongoing".format(
+            checkpoint.get('started'), len(resumed), self.out_filename))
+        return resumed
+
+    def _new_sweep(self):
+        """
+        Reset the timestamp of the poller, and compute the output file name in
+        daemon mode.
+        """
+        self.timestamp = datetime.today()
+        self.stats = Counter()
+        self.deadline_time = time.time() + self.deadline if self.deadline else None
+        if self.output_pattern:
+            self.out_filename = self.timestamp.strftime(self.output_pattern)
+        if self.resume:
+            self.resumed = self._load_checkpoint()
+
+    def load_modems(self):
+        """
+        Read the IP input file and build the list of modems to be queried.
+        The file is parsed again only if its modification time changed since
+        the previous call.
+
+        A modem listed several times (same MAC address, see modem_key()) is
+        only kept once.
+
+        :return: a list of entities (dict), as expected by query_one_modem()
+        """
+        mtime = os.stat(self.ip_file).st_mtime
+        if mtime != self.ip_file_mtime:
+            entities = []
+            keys = set()
+            duplicates = 0
+            with open(self.ip_file, 'r') as csvfile:
+                csvreader = csv.DictReader(csvfile, fieldnames = self.ip_fieldnames, delimiter = ';')
+                for line in csvreader:
+                    if self.shard and not self.in_shard(line[self.shard_key]):
+                        continue
+                    key = modem_key(line)
+                    if key in keys:
+                        duplicates += 1
+                        continue
+                    keys.add(key)
+                    entity = { 'read_community': self.read_community, 'ip': line['ip'], 'bpid': line['bpid'], 'mac': line['mac']}
+                    if self.retries is not None:
+                        entity['retries'] = self.retries
+                    if (self.trace_sample or self.trace_macs) and snmptrace.selected(
+                            line['mac'] or line['ip'], self.trace_sample, self.trace_macs):
+                        entity['trace'] = True
+                    entities.append(entity)
+            self.entities = entities
+            self.ip_file_mtime = mtime
+            if duplicates:
+                self.traces.warning("IP file {}: {} duplicate modems ignored".format(self.ip_file, duplicates))
+            self.__debug("IP file {} loaded: {} modems (shard: {})".format(self.ip_file, len(entities), self.shard))
+        return self.entities
+
+    def in_shard(self, key):
+        """
+        Deterministic dispatching of the modems among the shards: a modem
+        belongs to the shard CRC32(key) modulo the number of shards.  Every
+        poller node using the same IP file and number of shards gets a disjoint
+        part of it.
+
+        :param key: MAC or IP address of the modem (see self.shard_key)
+        :return: True if the modem belongs to the shard of this poller
+        """
+        (index, count) = self.shard
+        return zlib.crc32(key.strip().lower().encode()) % count == index
+
+    def _load_group_timestamps(self):
+        """
+        Load from the cache the time of the latest query of every metric group
+        and the uptimes, once.  The cache database may only be used by the
+        thread which opened it: call it from the main thread before giving
+        _select_groups() to another one.
+        """
+        if self.schedules and self.cachedb and self.group_timestamps is None:
+            self.group_timestamps = self.cachedb.get_group_timestamps()
+            self.uptimes = self.cachedb.get_uptimes()
+
+    def _select_groups(self, entity, now):
+        """
+        Decide which metric groups of the modem must be queried, according to
+        self.schedules and the time of the previous queries.  A group is
+        queried when at least 90% of its schedule has elapsed, to absorb the
+        jitter of the sweeps.
+
+        :param entity: the modem (dict) as returned by load_modems()
+        :param now: current time (seconds since epoch)
+        :return: the entity to give to query_one_modem().  It is a copy with a
+                 'groups' key if some groups must be skipped.
+        """
+        if not self.schedules or not self.cachedb:
+            return entity
+        self._load_group_timestamps()
+        mac = normalize_mac(entity['mac'])
+        last = self.group_timestamps.get(mac, {})
+        groups = [g for g in ch6643e.GROUPS
+                  if now - last.get(g, 0) >= self.schedules.get(g, 0) * 0.9]
+        if len(groups) == len(ch6643e.GROUPS):
+            return entity
+        entity = dict(entity)
+        if self.config_on_reboot and 'configdata' not in groups:
+            # The counters give the uptime, required to detect a reboot.
+            if 'counters' not in groups:
+                groups.insert(0, 'counters')
+            entity['last_uptime'] = self.uptimes.get(mac)
+        entity['groups'] = groups
+        return entity
+
+    def _merge_groups(self, modem):
+        """
+        Store in cache the metric groups the modem just returned, and complete
+        the skipped groups with their last known values.
+
+        :param modem: the modem object returned by query_one_modem()
+        """
+        timestamp = int(modem.timestamp.timestamp())
+        self.cachedb.store_groups(modem, modem.polled_groups, timestamp)
+        mac = normalize_mac(modem.hfc_mac)
+        last = self.group_timestamps.setdefault(mac, {})
+        for grp in modem.polled_groups:
+            last[grp] = timestamp
+        if 'counters' in modem.polled_groups:
+            self.uptimes[mac] = modem.uptime
+        skipped = [g for g in ch6643e.GROUPS if g not in modem.polled_groups]
+        for grp in skipped:
+            self.stats['skipped_' + grp] += 1
+        if skipped:
+            found = self.cachedb.load_groups(modem, skipped)
+            modem.restored_groups = found
+            self.traces.debug('Groups {} restored from cache for modem {} (mac: {})'.format(
+                found, modem.hostname, modem.hfc_mac))
+
+    def _get_worker_pool(self):
+        """
+        :return: the pool of processes (or of threads), created at first call
+                 and then reused for all subsequent sweeps.
+        """
+        if self.worker_pool is None and self.engine == 'thread':
+            # The threads share the memory of the poller: the modems they
+            # return are written, and the cache updated, by the calling
+            # thread only (see query_all_ip_multiprocesses()), so that the
+            # cachedb connection and the output file are never used
+            # concurrently.  No init_worker(): signals are for the main thread.
+            self.worker_pool = ThreadPool(processes = self.processes)
+            self.traces.info("Pool of {} threads started".format(self.processes))
+        elif self.worker_pool is None:
+            start = time.time()
+            context = multiprocessing.get_context(self.start_method)
+            if context.get_start_method() == 'forkserver':
+                # The fork server is a new interpreter: it must find the
+                # modules of this directory to preload them.
+                path = os.path.dirname(os.path.abspath(__file__))
+                os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, [path, os.environ.get('PYTHONPATH')]))
+                context.set_forkserver_preload(PRELOAD_MODULES)
+            initargs = [None, 0, 0, None]
+            if self.transport == 'shm':
+                self.result_ring = resultring(self.processes)
+                initargs = [self.result_ring.name, self.processes, self.result_ring.slots, context.Value('i', 0)]
+            if self.worker_starts is None:
+                self.worker_starts = context.Value('i', 0)
+            if self.engine == 'pool' and (self.watchdog or self.max_rss):
+                # Replaced processes may still be alive for a while: spare slots
+                self.watch_slots = context.Array('d', 2 * self.processes * WATCH_FIELDS)
+            if self.engine in ('batch', 'hybrid'):
+                self.result_queue = context.Queue()
+            initargs += [self.worker_starts, self.watch_slots, self.watchdog, self.max_rss, self.result_queue]
+            if self.log_pipeline is not None:
+                initargs += [self.log_pipeline.queue, self.log_pipeline.levels]
+            self.worker_pool = context.Pool(processes = self.processes, initializer = init_worker,
+                                            initargs = initargs, maxtasksperchild = self.max_tasks)
+            started = time.time()
+            self.worker_pool.apply(os.getpid)
+            self.traces.info("Pool of {} processes ({}) started in {:.3f}s, first process ready after {:.3f}s".format(
+                self.processes, context.get_start_method(), started - start, time.time() - start))
+        return self.worker_pool
+
+    def close(self, terminate = False):
+        """
+        Release the pool of processes, if any.
+
+        :param terminate: if True, the processes are stopped at once (SIGTERM)
+               instead of finishing the queued modems: the poller is exiting
+               on an error or a signal
+        """
+        if self.worker_pool is not None:
+            if any(not result.ready() for result in self.abandoned):
+                # Pool.join() would wait for them forever
+                terminate = True
+            if terminate:
+                self.__debug("Terminate worker_pool...")
+                self.worker_pool.terminate()
+            else:
+                self.__debug("Wait for worker_pool to close...")
+                self.worker_pool.close()
+            self.__debug("Closed. Waiting for all processes to finish...")
+            self.worker_pool.join()
+            self.__debug("Worker_pool finished")
+            self.worker_pool = None
+            self.abandoned = []
+        if self.result_ring is not None:
+            self.result_ring.close()
+            self.result_ring = None
+        self.result_queue = None
+
+    def _retire_pool(self):
+        """
+        Give up the pool at the deadline of a sweep, without waiting for the
+        queries in progress: its processes are stopped at once (SIGTERM, see
+        init_worker()), and a new pool is created for the next sweep, with new
+        code tables.  The threads of the 'thread' engine can't be stopped: the
+        pool is only closed, and its threads end with their current query in
+        the background.  Their results are dropped.
+        """
+        if self.worker_pool is None:
+            return
+        (pool, ring) = (self.worker_pool, self.result_ring)
+        self.worker_pool = self.result_ring = self.result_queue = None
+        self.abandoned = []
+        if self.engine == 'thread':
+            pool.close()
+            return
+        self.__debug("Terminate the pool at the deadline of the sweep...")
+        pool.terminate()
+        if ring is not None:
+            ring.close()
+
+    def _sweep_entities(self, now):
+        """
+        :return: the list of modems (dict) to query during this sweep, see
+                 _select_groups().  With a deadline, every modem gets the time
+                 after which it must not be queried anymore ('dispatch_until').
+        """
+        entities = self.load_modems()
+        if self.resumed:
+            entities = [entity for entity in entities if entity['ip'] not in self.resumed]
+            self.stats['resumed'] = len(self.load_modems()) - len(entities)
+        entities = [self._select_groups(entity, now) for entity in entities]
+        if self.deadline_time:
+            dispatch_until = self.deadline_time - min(DEADLINE_MARGIN, self.deadline / 10)
+            entities = [dict(entity, dispatch_until = dispatch_until) for entity in entities]
+        return entities
+
+    def _write_results(self, entities, modems):
+        """
+        Write the polled modems, up to the deadline of the sweep (if any).
+        Modems which were not queried because of the deadline, or not polled
+        yet at the deadline, are written as timeouts.
+
+        With a second chance (see self.retry_timeout), the modems which timed
+        out are queried again once all others are polled, if the deadline
+        allows it: their line is written only once, with the latest result.
+        Modems in 'partial' state are only queried for their missing metric
+        groups.
+
+        :param entities: the modems (dict) given to the engine
+        :param modems: iterator over the polled modems, see query_modems()
+        """
+        timeouts = self._write_pass(entities, modems, self.retry_timeout is not None)
+        if timeouts and time.time() < timeouts[0][0].get('dispatch_until', float('inf')):
+            retry = []
+            partials = {}
+            for (entity, modem) in timeouts:
+                entity = dict(entity, timeout = self.retry_timeout, retries = 0)
+                if modem.state == 'partial':
+                    groups = entity.get('groups', ch6643e.GROUPS)
+                    partials[modem.hostname] = (modem, groups)
+                    entity['groups'] = [g for g in groups if g not in modem.polled_groups]
+                retry.append(entity)
+            self.traces.info("Second chance for {} modems which timed out ({} of them partially)".format(
+                len(retry), len(partials)))
+            self.stats['retried'] += len(retry)
+            before = self.stats['completed'] + self.stats['nocounter']
+            self._write_pass(retry, self.query_modems(retry, self.retry_concurrency), False, partials)
+            self.stats['recovered'] += self.stats['completed'] + self.stats['nocounter'] - before
+        else:
+            for (entity, modem) in timeouts:
+                self._write_result(modem)
+        if self.stats['cut']:
+            self.traces.warning("Deadline of the sweep ({}s) reached: {} modems cut".format(
+                self.deadline, self.stats['cut']))
+
+    def _write_pass(self, entities, modems, hold_timeouts, partials = None):
+        """
+        Write the modems polled by one pass of the sweep, see _write_results().
+
+        :param hold_timeouts: if True, the modems which timed out (entirely or
+               partially) are not written but returned
+        :param partials: dict IP address -> tuple (modem in 'partial' state,
+               metric groups expected) of the previous pass, completed with
+               the modems of this pass (see ch6643e.merge())
+        :return: a list of tuples (entity, modem) of the modems which timed
+                 out, if hold_timeouts is True
+        """
+        partials = partials or {}
+        polled = set()
+        held = []
+        by_ip = {entity['ip']: entity for entity in entities} if hold_timeouts else None
+        for modem in modems:
+            if modem.hostname in partials:
+                (partial, groups) = partials.pop(modem.hostname)
+                modem = partial.merge(modem, groups)
+            if modem.state == 'init':
+                # Not queried: the deadline was too close.
+                self.stats['cut'] += 1
+                modem.state = 'timeout'
+            elif modem.state in ('timeout', 'partial') and hold_timeouts:
+                held.append((by_ip[modem.hostname], modem))
+                continue
+            if self.deadline_time:
+                polled.add(modem.hostname)
+            self._write_result(modem)
+        if self.deadline_time and len(polled) + len(held) < len(entities):
+            polled.update([modem.hostname for (entity, modem) in held])
+            cut = [entity for entity in entities if entity['ip'] not in polled]
+            if cut:
+                self._retire_pool()
+                for entity in cut:
+                    self.stats['cut'] += 1
+                    if entity['ip'] in partials:
+                        self._write_result(partials.pop(entity['ip'])[0])
+                    else:
+                        self._write_result(failed_modem(entity))
+        return held
 
     def query_all_ip(self):
         """
@@ -69,13 +627,8 @@ class poller:
         self.__debug("Start of poller.query_all_ip - mono-process")
         self._open_output_file()
 
-        with open(self.ip_file, 'r') as csvfile:
-            csvreader = csv.DictReader(csvfile, fieldnames = self.ip_fieldnames, delimiter = ';')
-            for line in csvreader:
-                entity = { 'read_community': self.read_community, 'ip': line['ip'], 'bpid': line['bpid'], 'mac': line['mac']}
-                if (self.cachedb):
-                    entity['do_cache'] = self.cachedb.file_name
-                self.out.write(query_one_modem(entity))
+        entities = self._sweep_entities(time.time())
+        self._write_results(entities, map(query_one_modem, entities))
         self._close_output_file()
 
     def query_all_ip_multiprocesses(self):
@@ -91,45 +644,569 @@ class poller:
         """
         self.__debug("Start of poller.query_all_ip_multiprocesses with {} processes".format(self.processes))
         self._open_output_file()
-        in_q= []
-        worker_pool = Pool(processes = self.processes)
-        with open(self.ip_file, 'r') as csvfile:
-            csvreader = csv.DictReader(csvfile, fieldnames = self.ip_fieldnames, delimiter = ';')
-            for line in csvreader:
-                entity = { 'read_community': self.read_community, 'ip': line['ip'], 'bpid': line['bpid'], 'mac': line['mac']}
-                in_q.append(entity)
+        in_q = self._sweep_entities(time.time())
 
         self.__debug("Starting multoprocessing for {} length queue...".format(len(in_q)))
-        for modem in worker_pool.imap_unordered(func=query_one_modem, iterable=in_q, chunksize=1):
-            if self.cachedb and modem.state == 'completed':
-                self.traces.debug('Start do cache'.format(modem.hostname, modem.hfc_mac))
-                self.cachedb.compute_usage(modem)
-                self.traces.debug('Cache UPDATED for modem {} (mac: {}). '.format(modem.hostname, modem.hfc_mac))
-            else:
-                self.traces.debug('Cache NOT UPDATED for modem {} (mac: {}). '.format(modem.hostname, modem.hfc_mac))
-
-            line = modem.get_legacy_csv_line() + '\n'
-            self.out.write(line)
-            self.out.flush()
+        self._write_results(in_q, self.query_modems(in_q))
 
-        self.__debug("Wait for worker_pool to close...")
-        worker_pool.close()
-        self.__debug("Closed. Waiting for all processes to finish...")
-        worker_pool.join()
-        self.__debug("Worker_pool finished")
         self._close_output_file()
 
+    def query_modems(self, entities, concurrency = None):
+        """
+        Query a list of modems with the local pool of processes (or of
+        threads), or within this process if self.processes is 1.
+
+        :param entities: list of modems (dict) to give to query_one_modem()
+        :param concurrency: if not None, maximal number of modems queried at
+               the same time (by every process with the batch and hybrid
+               engines), instead of self.processes (or self.concurrency)
+        :return: an iterator over the polled modems, in completion order
+        """
+        if self.engine == 'hybrid':
+            return self._query_modems_batch(entities, query_modem_batch_async, concurrency)
+        if self.processes > 1 and self.engine == 'batch':
+            return self._query_modems_batch(entities, query_modem_batch, concurrency)
+        if self.processes > 1 and self.engine == 'pool' and (self.watchdog or self.max_rss):
+            if concurrency and concurrency < self.processes:
+                return self._query_modems_watched(entities, aimd(concurrency, concurrency))
+            return self._query_modems_watched(entities, self.controller)
+        if self.processes > 1 and concurrency and concurrency < self.processes:
+            return self._query_modems_adaptive(entities, aimd(concurrency, concurrency))
+        if self.processes > 1 and self.controller:
+            return self._query_modems_adaptive(entities, self.controller)
+        if self.processes > 1:
+            return self._until_deadline(self._get_worker_pool().imap_unordered(func=query_one_modem, iterable=entities, chunksize=1))
+        return map(query_one_modem, entities)
+
+    def _until_deadline(self, results):
+        """
+        :param results: iterator returned by the imap_unordered() method of
+               the pool
+        :return: a generator over *results*, ending at the deadline of the
+                 sweep (if any) even if results are still expected
+        """
+        while True:
+            timeout = None if self.deadline_time is None else max(0, self.deadline_time - time.time())
+            try:
+                result = results.next(timeout)
+            except StopIteration:
+                return
+            except multiprocessing.TimeoutError:
+                return
+            yield result
+
+    def _query_modems_adaptive(self, entities, controller):
+        """
+        Same as query_modems(), with at most controller.window modems given to
+        the pool at the same time.
+
+        :param controller: self.controller, or an aimd object with a fixed
+               window
+        :return: a generator of polled modems, in completion order
+        """
+        controller.start()
+        start = time.time()
+        try:
+            for modem in self._until_deadline(self._get_worker_pool().imap_unordered(func=query_one_modem,
+                    iterable=controller.dispatch(entities), chunksize=1)):
+                controller.completed(modem.hostname, _timed_out(modem))
+                yield modem
+        finally:
+            controller.stop()
+            if controller is self.controller:
+                self.traces.info("Concurrency window during the sweep: min {}, max {}, final {}".format(
+                    *controller.summary(start)))
+
+    def _query_modems_watched(self, entities, controller = None):
+        """
+        Same as query_modems(), with the processes of the pool watched through
+        self.watch_slots (see query_one_modem_watched()).  A modem is given to
+        another process (once) when its process was killed by its watchdog, or
+        when it was replaced because of its memory usage before starting it.
+
+        The tasks given up are recorded in self.abandoned: see close().
+
+        :param controller: aimd object limiting the modems in flight, or None
+        :return: a generator of polled modems, in completion order
+        """
+        pool = self._get_worker_pool()
+        self.abandoned = [result for result in self.abandoned if not result.ready()]
+        done = queue.Queue()
+        tasks = {}          # serial -> (entity, AsyncResult, attempts)
+        waiting = iter(entities)
+        def dispatch(entity, attempts):
+            serial = next(self.task_serials)
+            if controller:
+                controller.begin(entity['ip'])
+            result = pool.apply_async(query_one_modem_watched, ((serial, entity),),
+                callback = lambda modem, serial = serial: done.put((serial, modem)),
+                error_callback = lambda error, serial = serial: done.put((serial, error)))
+            tasks[serial] = (entity, result, attempts)
+        if controller:
+            controller.start()
+        start = time.time()
+        # The slots are scanned at most once per second: not per result
+        next_scan = start + 1
+        try:
+            while True:
+                while not controller or controller.in_flight < controller.window:
+                    entity = next(waiting, None)
+                    if entity is None:
+                        break
+                    dispatch(entity, 0)
+                if not tasks:
+                    return
+                if self.deadline_time and time.time() > self.deadline_time:
+                    return
+                try:
+                    (serial, modem) = done.get(timeout = 1)
+                except queue.Empty:
+                    serial = None
+                if serial in tasks:
+                    (entity, result, attempts) = tasks.pop(serial)
+                    if isinstance(modem, Exception):
+                        self.traces.error("Query of {} failed: {!r}".format(entity['ip'], modem))
+                        modem = failed_modem(entity)
+                    if controller:
+                        controller.completed(modem.hostname, _timed_out(modem))
+                    yield modem
+                if serial is not None and time.time() < next_scan:
+                    continue
+                next_scan = time.time() + 1
+                for (serial, lost) in self._lost_tasks(tasks):
+                    (entity, result, attempts) = tasks.pop(serial)
+                    # A late result is ignored.
+                    self.abandoned.append(result)
+                    if controller:
+                        controller.completed(entity['ip'], lost == 'watchdog')
+                    if attempts == 0 or lost == 'rss':
+                        self.stats['redispatched'] += 1
+                        dispatch(entity, attempts + 1)
+                    else:
+                        yield failed_modem(entity)
+        finally:
+            self.abandoned.extend([result for (entity, result, attempts) in tasks.values()])
+            if controller:
+                controller.stop()
+            if controller and controller is self.controller:
+                self.traces.info("Concurrency window during the sweep: min {}, max {}, final {}".format(
+                    *controller.summary(start)))
+
+    def _lost_tasks(self, tasks):
+        """
+        :param tasks: tasks in progress, see _query_modems_watched()
+        :return: a list of tuples (serial, reason) of the lost tasks: reason
+                 is 'watchdog' (process dead while running the task, normally
+                 killed by its watchdog, or still running it WATCHDOG_GRACE
+                 seconds after the watchdog) or 'rss' (process replaced before
+                 starting the task)
+        """
+        now = time.time()
+        lost = []
+        slots = self.watch_slots
+        # A process killed by its watchdog is dead after self.watchdog seconds
+        # at least: younger tasks are not worth a system call.
+        suspect = self.watchdog or 1
+        with slots.get_lock():
+            values = slots.get_obj()[:]
+            for base in range(0, len(values), WATCH_FIELDS):
+                serial = int(values[base + WATCH_TASK])
+                if serial not in tasks:
+                    continue
+                started = values[base + WATCH_START]
+                pid = int(values[base + WATCH_PID])
+                if started < 0:
+                    lost.append((serial, 'rss'))
+                    self.stats['recycled_rss'] += 1
+                else:
+                    if now - started < suspect:
+                        continue
+                    alive = _process_alive(pid)
+                    if alive and not (self.watchdog and now - started > self.watchdog + WATCHDOG_GRACE):
+                        continue
+                    lost.append((serial, 'watchdog'))
+                    self.stats['watchdog_kills'] += 1
+                    self.stats['watchdog_seconds_lost'] += int(now - started)
+                    if alive:
+                        # The alarm did not work (signal blocked by the SNMP
+                        # library...).  SIGTERM is deferred like the alarm
+                        # (never SIGKILL): the process never dies holding a
+                        # lock shared with the others.
+                        os.kill(pid, signal.SIGTERM)
+                        self.traces.warning("Process {} stuck for {:.1f}s while querying {}: terminated, task given up".format(
+                            pid, now - started, tasks[serial][0]['ip']))
+                    else:
+                        self.traces.warning("Process {} killed after {:.1f}s while querying {}".format(
+                            pid, now - started, tasks[serial][0]['ip']))
+                # The slot can now be taken by a new process
+                slots.get_obj()[base + WATCH_TASK] = 0
+        self.stats['max_worker_rss_mb'] = max([self.stats['max_worker_rss_mb']] +
+            [int(rss) // 1024 for rss in values[WATCH_RSS::WATCH_FIELDS]])
+        return lost
+
+    def _batches(self, entities, concurrency = None):
+        """
+        Split the modems in batches of decreasing size (guided self-scheduling):
+        every batch gets a share of the remaining modems, bounded by
+        self.concurrency and 20 times this value.  Big batches at the beginning
+        reduce the number of messages exchanged with the processes, small ones
+        at the end keep all processes busy up to the end of the sweep.
+
+        :param concurrency: number of modems queried at the same time by every
+               process, or None for self.concurrency
+        :return: a generator of tuples (concurrency, list of entities)
+        """
+        concurrency = concurrency or self.concurrency
+        i = 0
+        while i < len(entities):
+            remaining = len(entities) - i
+            size = max(concurrency, min(20 * concurrency, remaining // (2 * self.processes)))
+            yield (concurrency, entities[i:i + size])
+            i += size
+
+    def _query_modems_batch(self, entities, func, concurrency = None):
+        """
+        Query the modems by batches with the pool of processes, or within this
+        process if self.processes is 1.  The processes send the polled modems
+        through self.result_queue while polling their batch (see
+        resultstream), so that they are written, and checkpointed, without
+        waiting for the end of the batch.
+
+        :param func: query_modem_batch or query_modem_batch_async
+        :param concurrency: see _batches()
+        :return: a generator of polled modems, in completion order
+        """
+        if self.processes == 1:
+            for result in map(func, self._batches(entities, concurrency)):
+                for record in self._decode_records(result):
+                    yield ch6643e.from_record(record)
+            return
+        pool = self._get_worker_pool()
+        results = self.result_queue
+        batches = pool.map_async(func, self._batches(entities, concurrency), chunksize = 1)
+        expected = len(entities)
+        while expected:
+            timeout = 1 if self.deadline_time is None else max(0, min(1, self.deadline_time - time.time()))
+            try:
+                result = results.get(timeout = timeout)
+            except queue.Empty:
+                if self.deadline_time and time.time() >= self.deadline_time:
+                    return
+                if batches.ready() and not batches.successful():
+                    # Exception raised by a batch
+                    batches.get()
+                continue
+            records = self._decode_records(result)
+            expected -= len(records)
+            for record in records:
+                yield ch6643e.from_record(record)
+
+    def _decode_records(self, result):
+        """
+        Update the code table of the process which sent *result*, and replace
+        the codes of the records by their strings.
+
+        :param result: a tuple returned by encode_records()
+        :return: the list of decoded records
+        """
+        (pid, first, new_strings, records, slots) = result
+        table = self.code_tables.setdefault(pid, [])
+        # A new process may reuse the pid of a former one: its codes restart
+        # from 0.
+        del table[first:]
+        table.extend([self.strings.setdefault(string, string) for string in new_strings])
+        decoded = []
+        for record in records:
+            record = list(record)
+            for i in CODED_POSITIONS:
+                if isinstance(record[i], int):
+                    record[i] = table[record[i]]
+            decoded.append(record)
+        if slots is not None:
+            decoded.extend(self.result_ring.read_records(slots, table))
+        return decoded
+
+    def _write_result(self, modem):
+        """
+        Update the cache with the polled modem (if relevant) and write its CSV
+        line in the output file.  The line is flushed at once: a modem written
+        is never lost when the poller is killed (see _load_checkpoint()), the
+        checkpoints only sync the file to disk.
+
+        :param modem: the modem object returned by query_one_modem()
+        """
+        self.stats[modem.state] += 1
+        if self.schedules and self.cachedb and modem.state in ('completed', 'nocounter', 'partial'):
+            self._merge_groups(modem)
+
+        # The counters of a modem in 'partial' state are valid if fetched.
+        if (self.cachedb and modem.state in ('completed', 'partial') and 'counters' in modem.polled_groups
+            and modem.wan_dl != ''):
+            self.traces.debug('Start do cache'.format(modem.hostname, modem.hfc_mac))
+            self.cachedb.compute_usage(modem)
+            self.traces.debug('Cache UPDATED for modem {} (mac: {}). '.format(modem.hostname, modem.hfc_mac))
+        else:
+            self.traces.debug('Cache NOT UPDATED for modem {} (mac: {}). '.format(modem.hostname, modem.hfc_mac))
+
+        self.out.write(modem.get_csv_line())
+        self.out.write('\n')
+        self.out.flush()
+        if self.next_checkpoint is not None and time.time() >= self.next_checkpoint:
+            self._checkpoint()
+
+    def sweep(self):
+        """
+        Query all modems once.  Based on the number of desired processes, it
+        will launch the correct child method.  The pool of processes (if any)
+        is kept alive for the next sweep: call close() when done.
+        """
+        self._new_sweep()
+        cpu = time.process_time()
+        self._run_sweep()
+        if self.worker_starts is not None and (self.max_tasks or self.watch_slots is not None):
+            self.stats['workers_started'] = self.worker_starts.value - self.workers_counted
+            self.workers_counted = self.worker_starts.value
+        self.traces.info("Sweep statistics: {}".format(dict(self.stats)))
+        self.traces.info("CPU time of the main process: {:.3f}s".format(time.process_time() - cpu))
+
+    def _run_sweep(self):
+        """
+        Launch the relevant query method, depending on the number of processes.
+        """
+        if self.processes > 1 or self.engine == 'hybrid':
+            self.query_all_ip_multiprocesses()
+        else:
+            self.query_all_ip()
+
     def query_all(self):
         """
         This is the method to call in order to query all modems.  Based on the
         number of desired processes, it will launch the correct child method.
         """
-        if self.processes > 1:
-            return self.query_all_ip_multiprocesses()
-        else:
-            return self.query_all_ip()
+        try:
+            return self.sweep()
+        except BaseException:
+            self.close(terminate = True)
+            raise
+        finally:
+            self.close()
+
+    def serve_forever(self, interval = 300, output_pattern = 'results_%Y%m%d-%H%M%S.txt'):
+        """
+        Daemon mode: query all modems every *interval* seconds, keeping the
+        pool of processes, the cache database and the IP file content in memory
+        between sweeps.
+
+        Sweeps are aligned on multiples of *interval* (like cron would do).  If a
+        sweep lasts longer than *interval*, the missed slots are skipped: two
+        sweeps never overlap.
+
+        :param interval: number of seconds between the start of two sweeps
+        :param output_pattern: strftime pattern for the name of the output
+               file of every sweep
+        """
+        self.output_pattern = output_pattern
+        try:
+            while True:
+                start = time.time()
+                self.sweep()
+                duration = time.time() - start
+                self.traces.info("Sweep done in {:.1f}s: {} modems written in {}".format(
+                    duration, len(self.entities), self.out_filename))
+                if duration > interval:
+                    self.traces.warning("Sweep lasted {:.1f}s, longer than interval ({}s)".format(duration, interval))
+                next_run = (time.time() // interval + 1) * interval
+                time.sleep(max(0, next_run - time.time()))
+        finally:
+            self.close(terminate = True)
 
 # Functions for multiprocessing
+# Ring of the current process, with the 'shm' transport (see encode_records())
+_result_ring = None
+
+# Queue of the polled modems, with the batch and hybrid engines (see
+# resultstream)
+_result_queue = None
+
+# Fields of the slot of every process in poller.watch_slots
+WATCH_PID, WATCH_TASK, WATCH_START, WATCH_RSS = range(4)
+WATCH_FIELDS = 4
+
+# Watch slot of the current process: shared array, index of the slot, watchdog
+# (seconds) and memory limit (kB).  _recycle is set once the limit is reached.
+_watch_slots = None
+_watch_base = None
+_watchdog = None
+_max_rss = None
+_recycle = False
+
+def init_worker(ring_name = None, rings = 0, ring_slots = 0, ring_counter = None,
+                worker_starts = None, watch_slots = None, watchdog = None, max_rss = None,
+                result_queue = None, log_queue = None, log_levels = None):
+    """
+    Initialization of every process of the pool.
+
+    SIGTERM keeps its default action, so that Pool.terminate() stops the
+    processes even within C code.  The locks shared with the processes of
+    the next pools (watch slots, counters) are only taken with SIGTERM
+    deferred (see _signals_deferred()).  A process exits by itself once its
+    parent is gone (see _exit_with_parent()): killing the poller leaves no
+    orphan process.
+
+    :param ring_name: name of the resultring segment, with the 'shm' transport
+    :param rings: number of rings of the segment
+    :param ring_slots: number of slots per ring
+    :param ring_counter: shared counter giving its ring number to every
+           process.  The ring of a process is not reused after its end:
+           processes started after the first ones (a process died) get no
+           ring, and pickle their modems (a warning is logged).
+    :param worker_starts: shared counter of the processes started
+    :param watch_slots: shared array of the slots of the processes, see
+           query_one_modem_watched().  A process takes the first slot which is
+           free, or whose process is dead and whose task was handled by the
+           parent.
+    :param watchdog: see poller.watchdog
+    :param max_rss: see poller.max_rss
+    :param result_queue: see poller.result_queue
+    :param log_queue: queue of the logpipeline of the poller, or None to keep
+           the logging inherited from the poller
+    :param log_levels: dict logger name -> level of the records put in
+           *log_queue*
+    """
+    # The handlers of the poller (fork) would only run between two Python
+    # instructions.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    with _signals_deferred():
+        # The thread inherits the mask: signals are for the main thread.
+        threading.Thread(target = _exit_with_parent, args = (os.getppid(),), daemon = True).start()
+        _init_worker(ring_name, rings, ring_slots, ring_counter, worker_starts,
+                     watch_slots, watchdog, max_rss, result_queue, log_queue, log_levels)
+
+def _init_worker(ring_name, rings, ring_slots, ring_counter, worker_starts,
+                 watch_slots, watchdog, max_rss, result_queue, log_queue, log_levels):
+    """
+    See init_worker(): called with SIGTERM and SIGALRM deferred.
+    """
+    global _result_ring, _result_queue, _watch_slots, _watch_base, _watchdog, _max_rss
+    _result_queue = result_queue
+    if log_queue is not None:
+        logpipeline.attach(log_queue, log_levels)
+    if ring_name is not None:
+        with ring_counter.get_lock():
+            ring = ring_counter.value
+            ring_counter.value += 1
+        if ring < rings:
+            _result_ring = resultring(rings, ring_slots, ring_name)
+            _result_ring.attach(ring)
+        else:
+            logging.getLogger('traces').warning("No result ring left for process {}: its modems are pickled".format(
+                os.getpid()))
+    if worker_starts is not None:
+        with worker_starts.get_lock():
+            worker_starts.value += 1
+    if watch_slots is not None:
+        with watch_slots.get_lock():
+            for base in range(0, len(watch_slots), WATCH_FIELDS):
+                if watch_slots[base + WATCH_TASK] == 0 and not _process_alive(int(watch_slots[base + WATCH_PID])):
+                    watch_slots[base + WATCH_PID] = os.getpid()
+                    watch_slots[base + WATCH_START] = 0
+                    _watch_base = base
+                    break
+            else:
+                logging.getLogger('traces').warning("No watch slot left for process {}".format(os.getpid()))
+        _watch_slots = watch_slots
+        _watchdog = watchdog
+        _max_rss = max_rss * 1024 if max_rss else None
+        # Killed by the kernel when the watchdog expires, even within C code
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+
+@contextlib.contextmanager
+def _signals_deferred():
+    """
+    Block the signals which kill a process of the pool (SIGALRM of the
+    watchdog, SIGTERM of Pool.terminate()) in the calling thread: the process
+    never dies while holding a lock shared with other processes.  A signal
+    received in the meantime is delivered at the end of the block.
+    """
+    mask = signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGALRM, signal.SIGTERM])
+    try:
+        yield
+    finally:
+        signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+
+def _exit_with_parent(parent):
+    """
+    Thread of every process of the pool: exit as soon as the process
+    *parent* is gone (poller killed, fork server stopped...), instead of
+    waiting for tasks forever.
+    """
+    while os.getppid() == parent:
+        time.sleep(1)
+    os._exit(1)
+
+def _process_alive(pid):
+    """
+    :return: True if the process *pid* exists (0 is never alive)
+    """
+    if pid == 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def query_one_modem_watched(task):
+    """
+    Same as query_one_modem(), under the watch of the parent: the process
+    records in its slot the task it is running and since when, and its memory
+    usage (maximal RSS) after every task.
+
+    The watchdog is an alarm signal with its default action: the kernel kills
+    the process if the query lasts too long.  As the alarm is cancelled before
+    returning, the process is never killed while exchanging messages with the
+    pool (it would leave a lock of the pool held forever).  The log records
+    are written synchronously, with the alarm deferred (see
+    logpipeline.queuehandler): a killed process loses only the records of the
+    query which it had not logged yet.
+
+    A process which exceeded its memory limit exits at the start of its next
+    task, which the parent gives to another process.
+
+    :param task: a tuple (serial number, entity)
+    """
+    (serial, entity) = task
+    if _watch_base is None:
+        return query_one_modem(entity)
+    slots = _watch_slots
+    with _signals_deferred():
+        slots[_watch_base + WATCH_TASK] = serial
+        if _recycle:
+            slots[_watch_base + WATCH_START] = -1
+            os._exit(0)
+        slots[_watch_base + WATCH_START] = time.time()
+    if _watchdog:
+        signal.alarm(_watchdog)
+    try:
+        return query_one_modem(entity)
+    finally:
+        signal.alarm(0)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        with _signals_deferred():
+            slots[_watch_base + WATCH_TASK] = 0
+            slots[_watch_base + WATCH_RSS] = rss
+        _check_memory(rss)
+
+def _check_memory(rss):
+    """
+    :param rss: maximal RSS of the current process (kB)
+    """
+    global _recycle
+    if _max_rss and rss > _max_rss:
+        logging.getLogger('traces').info("Process {} uses {} MB: replaced before its next task".format(
+            os.getpid(), rss // 1024))
+        _recycle = True
+
 def query_one_modem(entity):
     """
     This is the function to be called in every process.  It should be efficient
@@ -143,9 +1220,15 @@ def query_one_modem(entity):
 
     traces = logging.getLogger('traces')
     traces.debug('query_one_modem (PID {}): for modem {} (mac: {}) start'.format(os.getpid(), ip, mac))
-    modem = ch6643e(hostname = ip, community = community, bpid = bpid, mac = mac)
+    modem = ch6643e(hostname = ip, community = community, bpid = bpid, mac = mac,
+                    **{key: entity[key] for key in ('timeout', 'retries') if key in entity})
+    if time.time() > entity.get('dispatch_until', float('inf')):
+        # Too close to the deadline of the sweep: left in 'init' state
+        return modem
+    if entity.get('trace'):
+        modem.trace = snmptrace.modemtrace()
     try:
-        modem.query_all()
+        modem.query_all(groups = entity.get('groups'), last_uptime = entity.get('last_uptime'))
         if modem.state == 'error':
             traces.debug('query_one_modem (PID {}): for modem {} (mac: {}). ERROR'.format(os.getpid(), ip, mac))
         else:
@@ -155,3 +1238,194 @@ def query_one_modem(entity):
         logging.getLogger('traces').critical("query_one_modem (PID {}): Generic exception catched! (ip: {}, mac: {})".format(os.getpid(), ip, mac), exc_info=True)
         modem.state = 'error'
         return modem
+
+def query_modem_batch(batch):
+    """
+    Query a batch of modems within one process of the pool, with several
+    threads.  It saves one message between the parent and the worker per modem,
+    and the modems are sent back as compact records (see ch6643e.to_record()).
+
+    :param batch: a tuple (number of threads, list of entities)
+    :return: see resultstream.finish()
+    """
+    (concurrency, entities) = batch
+    stream = resultstream(concurrency)
+    with ThreadPoolExecutor(max_workers = concurrency) as executor:
+        for future in as_completed([executor.submit(query_one_modem, entity) for entity in entities]):
+            stream.add(future.result())
+    return stream.finish()
+
+# Code table of the current process: string -> code (see encode_records())
+_codes = {}
+MAX_CODES = 65536
+CODED_POSITIONS = [ch6643e.RECORD_FIELDS.index(field) for field in ch6643e.CODED_FIELDS]
+
+def encode_records(modems):
+    """
+    Convert modems to compact records, with dictionary encoding: the strings
+    of the fields listed in ch6643e.CODED_FIELDS are replaced by integer codes.
+    Every string is sent once to the parent, with the first records using it;
+    the parent keeps a copy of the code table of every process (see
+    poller._decode_records()).  Once the table is full, strings are sent as is.
+
+    :param modems: list of ch6643e objects
+    :return: a tuple (process id, code of the first new string, list of new
+             strings, list of records, slots of the resultring holding the
+             other records or None)
+    """
+    first = len(_codes)
+    new_strings = []
+    records = []
+    for modem in modems:
+        record = list(modem.to_record())
+        for i in CODED_POSITIONS:
+            code = _codes.get(record[i])
+            if code is None and len(_codes) < MAX_CODES:
+                code = _codes[record[i]] = len(_codes)
+                new_strings.append(record[i])
+            if code is not None:
+                record[i] = code
+        records.append(record)
+    slots = None
+    if _result_ring is not None:
+        (slots, records) = _result_ring.write_records(records)
+    return (os.getpid(), first, new_strings, records, slots)
+
+# Maximal number of seconds a polled modem waits in a resultstream
+STREAM_INTERVAL = 1
+
+class resultstream(object):
+    """
+    Modems polled by a batch, sent to the parent through the result queue of
+    the pool by groups of *size* modems, or as soon as the oldest one waited
+    STREAM_INTERVAL seconds.  All the results of a process go through this
+    queue: the parent decodes them in order (see encode_records()).  Within
+    the parent itself (no queue), the modems are returned at the end of the
+    batch.
+
+    :param size: number of modems per group
+    :param modems: modems not sent yet
+    :param sent: number of modems sent
+    :param since: time of the oldest modem not sent yet
+    """
+    def __init__(self, size):
+        self.size = size
+        self.modems = []
+        self.sent = 0
+        self.since = None
+
+    def add(self, modem):
+        if not self.modems:
+            self.since = time.time()
+        self.modems.append(modem)
+        if _result_queue is not None and (len(self.modems) >= self.size or
+                                          time.time() - self.since >= STREAM_INTERVAL):
+            self.flush()
+
+    def flush(self):
+        _result_queue.put(encode_records(self.modems))
+        self.sent += len(self.modems)
+        self.modems = []
+
+    def finish(self):
+        """
+        :return: the number of modems sent, or the records of all modems of
+                 the batch (see encode_records()) without result queue
+        """
+        if _result_queue is None:
+            return encode_records(self.modems)
+        if self.modems:
+            self.flush()
+        return self.sent
+
+# Event loop and UDP socket of the current process, for the 'hybrid' engine.
+# They are created at the first batch, and then reused.
+_event_loop = None
+_snmp_engine = None
+
+def query_modem_batch_async(batch):
+    """
+    Query a batch of modems with the event loop of the current process: up to
+    *concurrency* modems are queried at the same time, all through one single
+    UDP socket.  The parent receives the modems as compact records, as with
+    query_modem_batch().
+
+    :param batch: a tuple (concurrency, list of entities)
+    :return: see resultstream.finish()
+    """
+    global _event_loop, _snmp_engine
+    # asyncio is only needed by this engine (see snmp.asyncengine)
+    import asyncio
+    if _event_loop is None:
+        _event_loop = asyncio.new_event_loop()
+        _snmp_engine = snmp.asyncengine()
+        _event_loop.run_until_complete(_snmp_engine.start())
+    (concurrency, entities) = batch
+    return _event_loop.run_until_complete(_query_batch_async(_snmp_engine, concurrency, entities))
+
+async def _query_batch_async(engine, concurrency, entities):
+    """
+    Poll the modems of the batch with at most *concurrency* modems at the
+    same time.
+
+    :return: see resultstream.finish()
+    """
+    import asyncio
+    semaphore = asyncio.Semaphore(concurrency)
+    async def query(entity):
+        async with semaphore:
+            return await query_one_modem_async(engine, entity)
+    stream = resultstream(concurrency)
+    for polled in asyncio.as_completed([query(entity) for entity in entities]):
+        stream.add(await polled)
+    return stream.finish()
+
+async def query_one_modem_async(engine, entity):
+    """
+    Same as query_one_modem(), as a coroutine (see ch6643e.query_all_async()).
+
+    :param engine: snmp.asyncengine of the running event loop
+    """
+    traces = logging.getLogger('traces')
+    modem = ch6643e(hostname = entity['ip'], community = entity['read_community'],
+                    bpid = entity['bpid'], mac = entity['mac'],
+                    **{key: entity[key] for key in ('timeout', 'retries') if key in entity})
+    if time.time() > entity.get('dispatch_until', float('inf')):
+        return modem
+    if entity.get('trace'):
+        modem.trace = snmptrace.modemtrace()
+    try:
+        await modem.query_all_async(engine, groups = entity.get('groups'), last_uptime = entity.get('last_uptime'))
+    except:
+        traces.critical("query_one_modem_async (PID {}): Generic exception catched! (ip: {}, mac: {})".format(os.getpid(), entity['ip'], entity['mac']), exc_info=True)
+        modem.state = 'error'
+    return modem
+
+def modem_key(entity):
+    """
+    :param entity: a modem (dict) of the IP file
+    :return: the key identifying the modem: its MAC address with lowercase
+             hex digits only, or its IP address if it has no MAC
+    """
+    return normalize_mac(entity['mac']) or entity['ip']
+
+def _timed_out(modem):
+    """
+    :return: the outcome of the query of *modem* for an aimd controller: True
+             if it timed out, or None if it was not queried at all (skipped
+             because of the deadline of the sweep): its duration means nothing
+    """
+    if modem.state == 'init':
+        return None
+    return modem.state in ('timeout', 'partial')
+
+def failed_modem(entity):
+    """
+    :param entity: a modem (dict) which could not be polled (by any node, or
+           before the deadline of the sweep)
+    :return: a ch6643e object in 'timeout' state for this modem
+    """
+    modem = ch6643e(hostname = entity['ip'], community = entity['read_community'],
+                    bpid = entity['bpid'], mac = entity['mac'])
+    modem.state = 'timeout'
+    return modem
@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+# vim: set fileencoding=utf-8
+# (c) © 2016-2017 Xavier Lüthi xavier@luthi.eu
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See LICENSE.txt for the full license text.
+
+"""
+Shared memory transport of the polled modems, from the processes of the pool
+to the parent (see poller, option '--transport shm').
+
+The parent creates one shared memory segment, split in one ring buffer per
+process.  Every ring has one single writer (its process) and one single reader
+(the parent).  A process writes the records of a batch in fixed-size slots of
+its ring, and only tells the parent which slots to read, through the result
+queue of the pool.  The parent decodes the slots in place, and releases them by
+moving the tail of the ring.
+
+Records which don't fit in a slot (unusual values, too many channels...) and
+the ones which don't fit in the ring (parent late) are sent through the queue
+as usual: a process never waits for the parent.
+
+Layout of a ring: the tail (8 bytes, written by the parent only), then the
+slots.  Layout of a slot: see SLOT_HEADER, followed by the strings (one byte
+of length, then the UTF-8 string), and the signal levels (channel index and
+level in tenths of dB, see LEVEL).
+"""
+
+from ch6643e import ch6643e
+from datetime import datetime
+from multiprocessing import shared_memory
+import struct
+
+SLOT_SIZE = 512
+
+# State, polled groups (bit mask over ch6643e.GROUPS), uptime, wan_dl, wan_ul,
+# timestamp (year, month, day, hour, minute, second, microsecond), codes of
+# ch6643e.CODED_FIELDS, number of ds_power, ds_snr and us_power levels.
+SLOT_HEADER = struct.Struct('<BBqqqHBBBBBI6HBBB')
+STRINGS_OFFSET = SLOT_HEADER.size
+STRINGS_SIZE = 96
+LEVELS_OFFSET = STRINGS_OFFSET + STRINGS_SIZE
+LEVEL = struct.Struct('<Hh')
+MAX_LEVELS = (SLOT_SIZE - LEVELS_OFFSET) // LEVEL.size
+
+# Strings of the slot, in this order
+STRING_FIELDS = ('bpid', 'hostname', 'hfc_mac', 'wan_address')
+
+STATES = ('init', 'completed', 'nocounter', 'timeout', 'error', 'partial')
+STATE_CODES = {state: code for (code, state) in enumerate(STATES)}
+
+# wan_dl and wan_ul of a modem in 'nocounter' state
+NO_COUNTER = -2 ** 63
+
+TAIL = struct.Struct('<Q')
+
+_level_structs = {}
+
+# String of every channel index, created by the parent at first read
+_index_strings = None
+
+def _levels_struct(count):
+    """
+    :return: a Struct for *count* levels, created at first call
+    """
+    levels = _level_structs.get(count)
+    if levels is None:
+        levels = _level_structs[count] = struct.Struct('<' + 'Hh' * count)
+    return levels
+
+class resultring(object):
+    """
+    One shared memory segment holding the rings of all processes of a pool.
+
+    :param rings: number of rings (processes)
+    :param slots: number of slots per ring
+    :param name: name of the segment to attach to (processes), or None to
+           create a new one (parent)
+    :param owner: True in the parent, which creates and finally removes the
+           segment
+    :param head: next slot to write (process side)
+    :param tail: next slot to read (parent side), for every ring
+    """
+    def __init__(self, rings, slots = 4096, name = None):
+        self.rings = rings
+        self.slots = slots
+        self.ring_size = TAIL.size + slots * SLOT_SIZE
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create = True, size = rings * self.ring_size)
+        else:
+            self.shm = shared_memory.SharedMemory(name = name)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.ring = None
+        self.head = 0
+        self.tail = [0] * rings
+
+    def attach(self, ring):
+        """
+        Process side: use the ring number *ring* for write_records().
+        """
+        self.ring = ring
+
+    def _slot_offset(self, ring, position):
+        return ring * self.ring_size + TAIL.size + (position % self.slots) * SLOT_SIZE
+
+    def write_records(self, records):
+        """
+        Process side: write the records in the free slots of the ring.
+
+        :param records: list of records (see ch6643e.to_record()), with the
+               fields of ch6643e.CODED_FIELDS already replaced by their codes
+        :return: a tuple (tuple (ring, first slot, number of slots), list of
+                 the records not written)
+        """
+        (tail,) = TAIL.unpack_from(self.buf, self.ring * self.ring_size)
+        first = self.head
+        left = []
+        for record in records:
+            if self.head - tail >= self.slots or not self._write_slot(self._slot_offset(self.ring, self.head), record):
+                left.append(record)
+            else:
+                self.head += 1
+        return ((self.ring, first, self.head - first), left)
+
+    def _write_slot(self, offset, record):
+        """
+        :return: False if the record doesn't fit in a slot
+        """
+        modem = dict(zip(ch6643e.RECORD_FIELDS, record))
+        try:
+            codes = [modem[field] for field in ch6643e.CODED_FIELDS]
+            levels = [(int(index), int(level)) for signal in ('ds_power', 'ds_snr', 'us_power')
+                                                for (index, level) in modem[signal]]
+            strings = [modem[field].encode() for field in STRING_FIELDS]
+            if (len(levels) > MAX_LEVELS or sum([len(s) + 1 for s in strings]) > STRINGS_SIZE
+                or not all([isinstance(code, int) for code in codes])):
+                return False
+            timestamp = modem['timestamp']
+            counters = [NO_COUNTER if modem[field] == '' else modem[field] for field in ('wan_dl', 'wan_ul')]
+            groups = sum([1 << i for (i, group) in enumerate(ch6643e.GROUPS) if group in modem['polled_groups']])
+            SLOT_HEADER.pack_into(self.buf, offset, STATE_CODES[modem['state']], groups,
+                modem['uptime'], counters[0], counters[1],
+                timestamp.year, timestamp.month, timestamp.day, timestamp.hour,
+                timestamp.minute, timestamp.second, timestamp.microsecond,
+                *codes, len(modem['ds_power']), len(modem['ds_snr']), len(modem['us_power']))
+            pos = offset + STRINGS_OFFSET
+            for string in strings:
+                self.buf[pos] = len(string)
+                self.buf[pos + 1:pos + 1 + len(string)] = string
+                pos += 1 + len(string)
+            _levels_struct(len(levels)).pack_into(self.buf, offset + LEVELS_OFFSET,
+                                                  *[x for level in levels for x in level])
+        except (KeyError, ValueError, TypeError, struct.error):
+            return False
+        return True
+
+    def read_records(self, slots, table):
+        """
+        Parent side: decode the slots written by write_records(), and release
+        them.
+
+        :param slots: tuple (ring, first slot, number of slots)
+        :param table: code table of the process (list of strings)
+        :return: list of records (see ch6643e.from_record())
+        """
+        global _index_strings
+        if _index_strings is None:
+            _index_strings = [str(i) for i in range(65536)]
+        (ring, first, count) = slots
+        records = []
+        for position in range(first, first + count):
+            records.append(self._read_slot(self._slot_offset(ring, position), table))
+        self.tail[ring] = first + count
+        TAIL.pack_into(self.buf, ring * self.ring_size, self.tail[ring])
+        return records
+
+    def _read_slot(self, offset, table):
+        buf = self.buf
+        (state, groups, uptime, wan_dl, wan_ul, year, month, day, hour, minute, second,
+         microsecond, config_file, oper_status, boot_status, fw_version, fw_filename,
+         wan_gateway, ds, snr, us) = SLOT_HEADER.unpack_from(buf, offset)
+        strings = []
+        pos = offset + STRINGS_OFFSET
+        for i in range(len(STRING_FIELDS)):
+            length = buf[pos]
+            strings.append(str(buf[pos + 1:pos + 1 + length], 'utf-8'))
+            pos += 1 + length
+        values = _levels_struct(ds + snr + us).unpack_from(buf, offset + LEVELS_OFFSET)
+        levels = list(zip(map(_index_strings.__getitem__, values[0::2]), values[1::2]))
+        (bpid, hostname, hfc_mac, wan_address) = strings
+        return (bpid, hostname, STATES[state], hfc_mac, uptime,
+                '' if wan_dl == NO_COUNTER else wan_dl, '' if wan_ul == NO_COUNTER else wan_ul,
+                levels[:ds], levels[ds:ds + snr], levels[ds + snr:],
+                table[config_file], table[oper_status], table[boot_status],
+                table[fw_version], table[fw_filename], wan_address, table[wan_gateway],
+                datetime(year, month, day, hour, minute, second, microsecond),
+                [group for (i, group) in enumerate(ch6643e.GROUPS) if groups & (1 << i)])
+
+    def close(self):
+        """
+        Release the segment, and remove it in the parent.
+        """
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+# vim: set fileencoding=utf-8
+# (c) © 2016-2017 Xavier Lüthi xavier@luthi.eu
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See LICENSE.txt for the full license text.
+
+from poller import poller, query_one_modem, modem_key
+from datetime import datetime
+import heapq
+import multiprocessing
+import time
+import zlib
+
+class rollingpoller(poller):
+    """
+    Continuous poller: instead of querying all modems at once every interval,
+    every modem has its own next due time, and modems are dispatched one by one
+    when they are due.  Polling is then spread evenly over the interval, at a
+    constant rate of len(modems) / interval queries per second.
+
+    The output is rotated in time-sliced files: every result is written in the
+    file of the slice during which it was received.  The file name is computed
+    with output_pattern and the start time of the slice, so the default pattern
+    produces the usual results_*.txt files.
+
+    :param interval: seconds between two queries of the same modem
+    :param slice_length: duration (seconds) covered by one output file
+    :param heap: list of (due time, sequence, key) ordered as a heap
+    :param due: dict key -> entity of all modems currently scheduled (see
+           poller.modem_key())
+    :param running: False to stop the dispatching of modems
+    """
+    def __init__(self, slice_length = None, **kwargs):
+        super().__init__(**kwargs)
+        self.interval = 300
+        self.slice_length = slice_length
+        self.output_pattern = 'results_%Y%m%d-%H%M%S.txt'
+        self.heap = []
+        self.due = {}
+        self.sequence = 0
+        self.running = False
+        self.scheduled_entities = None
+        self.slice_start = None
+
+    def _schedule_modems(self):
+        """
+        Load the IP file (if modified) and (re)build the heap of due times.
+
+        Modems already scheduled keep their due time.  New modems are spread
+        evenly over the next interval, ordered by a hash of their MAC address
+        (see poller.modem_key()) so that the order is stable from one run to
+        another.
+        """
+        entities = self.load_modems()
+        if entities is self.scheduled_entities:
+            return
+        self.scheduled_entities = entities
+        now = time.time()
+        old_heap = {key: due for (due, seq, key) in self.heap}
+        new_modems = sorted((modem_key(e) for e in entities if modem_key(e) not in old_heap),
+                            key = lambda key: zlib.crc32(key.encode()))
+        for (i, key) in enumerate(new_modems):
+            old_heap[key] = now + i * self.interval / len(new_modems)
+        self.due = {}
+        self.heap = []
+        for entity in entities:
+            key = modem_key(entity)
+            self.due[key] = entity
+            self.sequence += 1
+            self.heap.append((old_heap[key], self.sequence, key))
+        heapq.heapify(self.heap)
+        self.traces.info("Rolling schedule: {} modems, {:.1f} queries/s".format(
+            len(self.heap), len(self.heap) / self.interval))
+
+    def _due_modems(self):
+        """
+        Generator yielding every modem when it is due, forever (or up to when
+        self.running is False).  It is consumed by the task handler thread of
+        the pool of processes: it can block without slowing down the writing
+        of the results by the main thread.  It never uses the cache database,
+        which belongs to the main thread (see _load_group_timestamps()).
+        """
+        last_check = 0
+        while self.running:
+            now = time.time()
+            if now - last_check > 10:
+                self._schedule_modems()
+                last_check = now
+            if not self.heap:
+                time.sleep(1)
+                continue
+            (due, seq, key) = self.heap[0]
+            if due > now:
+                time.sleep(min(due - now, 1))
+                continue
+            heapq.heapreplace(self.heap, (due + self.interval, seq, key))
+            yield self._select_groups(self.due[key], now)
+
+    def _rotate_output_file(self, now):
+        """
+        Close the output file of the previous slice (if any) and open the one
+        of the slice *now* belongs to, if not already done.
+
+        :return: the start time of the current slice
+        """
+        slice_start = now // self.slice_length * self.slice_length
+        if slice_start != self.slice_start:
+            if self.slice_start is not None:
+                self._close_output_file()
+                self.traces.info("Output file {} closed. Statistics: {}".format(self.out_filename, dict(self.stats)))
+                self.stats.clear()
+            self.slice_start = slice_start
+            self.timestamp = datetime.fromtimestamp(slice_start)
+            self.out_filename = self.timestamp.strftime(self.output_pattern)
+            self._open_output_file()
+        return slice_start
+
+    def serve_forever(self, interval = 300, output_pattern = 'results_%Y%m%d-%H%M%S.txt'):
+        """
+        Query all modems continuously, each one every *interval* seconds.
+        This method never returns (except on exception, e.g. SystemExit).
+
+        :param interval: seconds between two queries of the same modem
+        :param output_pattern: strftime pattern for the name of the output
+               file of every time slice (slice_length defaults to *interval*)
+        """
+        self.interval = interval
+        self.slice_length = self.slice_length or interval
+        self.output_pattern = output_pattern
+        self.running = True
+        worker_pool = self._get_worker_pool()
+        try:
+            self._rotate_output_file(time.time())
+            # _due_modems() runs in the task handler thread of the pool: it
+            # must not use the cache database.
+            self._load_group_timestamps()
+            results = worker_pool.imap_unordered(func=query_one_modem, iterable=self._due_modems(), chunksize=1)
+            while True:
+                try:
+                    modem = results.next(timeout = 1)
+                except multiprocessing.TimeoutError:
+                    modem = None
+                self._rotate_output_file(time.time())
+                if modem is not None:
+                    self._write_result(modem)
+        finally:
+            self.running = False
+            self.close(terminate = True)
+            if self.slice_start is not None:
+                self._close_output_file()
@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+# vim: set fileencoding=utf-8
+# (c) © 2016-2017 Xavier Lüthi xavier@luthi.eu
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See LICENSE.txt for the full license text.
+
+"""
+SNMP agent simulating a population of CH6643e cable modems, to test and
+benchmark the poller without a real plant.
+
+Every simulated modem listens on its own UDP port of 127.0.0.1, and the IP
+file to give to launch_poller.py is generated with the '--ipfile' option (IP
+addresses are then written as '127.0.0.1:port').
+
+For command line argument, use the "--help" option.
+"""
+
+from ch6643e import ch6643e
+import snmp
+import argparse
+import asyncio
+import bisect
+import random
+import resource
+import time
+
+def oid_tuple(oid):
+    return tuple(int(x) for x in oid.strip('.').split('.'))
+
+class simulatedmodem(asyncio.DatagramProtocol):
+    """
+    One simulated modem, answering GET and GET BULK requests for the OIDs
+    queried by ch6643e.
+
+    :param index: number of the modem, used to derive its MAC and values
+    :param community: accepted community string
+    :param delay: mean response time (seconds)
+    :param loss: ratio of requests left without response
+    :param ds_channels: number of downstream channels
+    :param us_channels: number of upstream channels
+    """
+    def __init__(self, index, community = 'public', delay = 0.01, loss = 0.0,
+                 ds_channels = 8, us_channels = 4):
+        self.index = index
+        self.community = community
+        self.delay = delay
+        self.loss = loss
+        self.mac = bytes((0x02, 0x00)) + index.to_bytes(4, 'big')
+        self.boot = time.time() - random.randrange(3600, 3600 * 24 * 30)
+        self.transport = None
+        self.mib = {}
+        self._build_static_mib(ds_channels, us_channels)
+        self.sorted_oids = sorted(list(self.mib) + [oid_tuple(oid) for oid in ch6643e.COUNTERS_OIDS[1:]])
+
+    @property
+    def mac_string(self):
+        return self.mac.hex()
+
+    def _build_static_mib(self, ds_channels, us_channels):
+        """
+        Values which do not change over time: (tag, encoded value) by OID.
+        """
+        octets = lambda value: (snmp.OCTET_STRING, value if isinstance(value, bytes) else value.encode())
+        wan = bytes((81, 240, self.index >> 8 & 0xff, self.index & 0xff))
+        gateway = bytes((81, 240, self.index >> 8 & 0xff, 1))
+        values = [octets(self.mac), None, None, None,
+                  octets('CH6643E-{}.cfg'.format(self.index % 4)),
+                  (snmp.INTEGER, 3), (snmp.INTEGER, 3),
+                  octets('CH6643E-5.01.01'), octets('CH6643E-5.01.01.bin'),
+                  octets(wan), octets(gateway)]
+        for (oid, value) in zip(ch6643e.COUNTERS_OIDS + ch6643e.CONFIGDATA_OIDS, values):
+            if value is not None:
+                self.mib[oid_tuple(oid)] = value
+        rand = random.Random(self.index)
+        for channel in range(1, ds_channels + 1):
+            self.mib[oid_tuple(ch6643e.DS_POWER_OID) + (channel,)] = (snmp.INTEGER, rand.randrange(-100, 150))
+            self.mib[oid_tuple(ch6643e.DS_SNR_OID) + (channel,)] = (snmp.INTEGER, rand.randrange(330, 420))
+        for channel in range(1, us_channels + 1):
+            self.mib[oid_tuple(ch6643e.US_POWER_OID) + (channel,)] = (snmp.INTEGER, rand.randrange(380, 520))
+
+    def get(self, oid):
+        """
+        :return: a tuple (tag, value) for the OID, or None if it doesn't exist
+        """
+        elapsed = time.time() - self.boot
+        if oid == (1, 3, 6, 1, 2, 1, 1, 3, 0):
+            return (snmp.TIMETICKS, int(elapsed * 100))
+        if oid == (1, 3, 6, 1, 2, 1, 31, 1, 1, 1, 6, 2):
+            return (snmp.COUNTER64, int(elapsed * 125000))
+        if oid == (1, 3, 6, 1, 2, 1, 31, 1, 1, 1, 10, 2):
+            return (snmp.COUNTER64, int(elapsed * 12500))
+        return self.mib.get(oid)
+
+    def get_next(self, oid):
+        """
+        :return: a tuple (next OID, tag, value), with tag END_OF_MIB_VIEW at the
+                 end of the MIB
+        """
+        i = bisect.bisect_right(self.sorted_oids, oid)
+        if i == len(self.sorted_oids):
+            return (oid, snmp.END_OF_MIB_VIEW, None)
+        next_oid = self.sorted_oids[i]
+        return (next_oid,) + self.get(next_oid)
+
+    def encode_value(self, tag, value):
+        if tag in (snmp.OCTET_STRING,):
+            return snmp.encode_tlv(tag, value)
+        if value is None:
+            return snmp.encode_tlv(tag, b'')
+        return snmp.encode_integer(value, tag)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.loss and random.random() < self.loss:
+            return
+        try:
+            (community, pdu_tag, request_id, field1, field2, varbinds) = snmp.decode_message(data)
+        except (snmp.SNMPError, IndexError):
+            return
+        if community != self.community:
+            return
+        oids = []
+        values = []
+        if pdu_tag == snmp.GET_REQUEST:
+            for (oid, tag, value) in varbinds:
+                oid = oid_tuple(oid)
+                result = self.get(oid) or (snmp.NO_SUCH_OBJECT, None)
+                oids.append(oid)
+                values.append(self.encode_value(*result))
+        elif pdu_tag == snmp.GET_BULK_REQUEST:
+            for (oid, tag, value) in varbinds[field1:]:
+                oid = oid_tuple(oid)
+                for i in range(field2):
+                    (oid, tag, value) = self.get_next(oid)
+                    oids.append(oid)
+                    values.append(self.encode_value(tag, value))
+                    if tag == snmp.END_OF_MIB_VIEW:
+                        break
+        else:
+            return
+        response = snmp.encode_message(community, snmp.GET_RESPONSE, request_id, oids, 0, 0, values)
+        delay = random.uniform(0.5, 1.5) * self.delay
+        asyncio.get_running_loop().call_later(delay, self.transport.sendto, response, addr)
+
+async def serve(modems, base_port):
+    loop = asyncio.get_running_loop()
+    for modem in modems:
+        await loop.create_datagram_endpoint(lambda modem = modem: modem,
+                                            local_addr = ('127.0.0.1', base_port + modem.index))
+    await asyncio.Event().wait()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Simulate CH6643e cable modems answering SNMP queries.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--modems', '-n', type=int, default=100, help="Number of simulated modems")
+    parser.add_argument('--base-port', type=int, default=20000, help="UDP port of the first modem")
+    parser.add_argument('--community', default='public', help="SNMP community")
+    parser.add_argument('--delay', type=float, default=0.01, help="Mean response time in seconds")
+    parser.add_argument('--loss', type=float, default=0.0, help="Ratio of requests without response")
+    parser.add_argument('--ipfile', help="Write the IP file of the simulated modems in this file")
+    args = parser.parse_args()
+
+    # One socket per modem
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    modems = [simulatedmodem(i, args.community, args.delay, args.loss) for i in range(args.modems)]
+    if args.ipfile:
+        with open(args.ipfile, 'w') as f:
+            for modem in modems:
+                f.write('{};{};127.0.0.1:{}\n'.format(1000000 + modem.index, modem.mac_string, args.base_port + modem.index))
+    asyncio.run(serve(modems, args.base_port))
@@ -0,0 +1,572 @@
+#!/usr/bin/python3
+# vim: set fileencoding=utf-8
+# (c) © 2016-2017 Xavier Lüthi xavier@luthi.eu
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See LICENSE.txt for the full license text.
+
+"""
+Minimal SNMPv2c implementation in pure Python, limited to what ch6643e needs:
+GET and GET BULK requests.
+
+easysnmp is blocking: one query occupies one process (or thread) up to the
+response.  asyncsession sends the requests from an asyncio event loop instead,
+so that one process can wait for thousands of modems at the same time.  All
+sessions of an event loop share one single UDP socket (asyncengine), and the
+responses are dispatched based on their request-id.
+
+The values returned by get() and get_bulk() mimic easysnmp.SNMPVariable (with
+use_numeric=True).  get_values() and get_bulk_values() are the fast path used
+by ch6643e: requests are built from pre-encoded templates (see
+requesttemplate), and responses are decoded directly into Python integers and
+bytes (see decode_response_values).
+"""
+
+import functools
+import logging
+import os # getpid() for debug traces
+import random
+import socket
+
+SNMP_VERSION_2C = 1
+
+# BER tags
+INTEGER        = 0x02
+OCTET_STRING   = 0x04
+NULL           = 0x05
+OBJECT_ID      = 0x06
+SEQUENCE       = 0x30
+IP_ADDRESS     = 0x40
+COUNTER32      = 0x41
+GAUGE32        = 0x42
+TIMETICKS      = 0x43
+OPAQUE         = 0x44
+COUNTER64      = 0x46
+NO_SUCH_OBJECT   = 0x80
+NO_SUCH_INSTANCE = 0x81
+END_OF_MIB_VIEW  = 0x82
+
+# PDU tags
+GET_REQUEST      = 0xa0
+GET_NEXT_REQUEST = 0xa1
+GET_RESPONSE     = 0xa2
+GET_BULK_REQUEST = 0xa5
+
+# Names of the types, as given by easysnmp
+TYPE_NAMES = {
+    INTEGER: 'INTEGER', OCTET_STRING: 'OCTETSTR', NULL: 'NULL', OBJECT_ID: 'OBJECTID',
+    IP_ADDRESS: 'IPADDR', COUNTER32: 'COUNTER', GAUGE32: 'GAUGE', TIMETICKS: 'TICKS',
+    OPAQUE: 'OPAQUE', COUNTER64: 'COUNTER64', NO_SUCH_OBJECT: 'NOSUCHOBJECT',
+    NO_SUCH_INSTANCE: 'NOSUCHINSTANCE', END_OF_MIB_VIEW: 'ENDOFMIBVIEW',
+}
+UNSIGNED_TYPES = (COUNTER32, GAUGE32, TIMETICKS, COUNTER64)
+
+# Request ids are chosen in this range, so that they are always encoded on
+# exactly 4 bytes (see requesttemplate).
+FIRST_REQUEST_ID = 0x01000000
+LAST_REQUEST_ID  = 0x7fffffff
+
+class SNMPError(Exception):
+    """The agent answered with an error status, or sent an invalid message."""
+
+class SNMPTimeoutError(SNMPError):
+    """No response received, after all retries."""
+
+class snmpvariable(object):
+    """
+    One variable binding of a response, equivalent to easysnmp.SNMPVariable.
+
+    :param oid: OID without its last sub-identifier, e.g. '.1.3.6.1.2.1.1.3'
+    :param oid_index: last sub-identifier of the OID, e.g. '0'
+    :param value: value as a string (octet strings are decoded in latin-1)
+    :param snmp_type: type name, e.g. 'INTEGER' (see TYPE_NAMES)
+    """
+    __slots__ = ('oid', 'oid_index', 'value', 'snmp_type')
+
+    def __init__(self, oid, oid_index, value, snmp_type):
+        self.oid = oid
+        self.oid_index = oid_index
+        self.value = value
+        self.snmp_type = snmp_type
+
+    def __repr__(self):
+        return "<snmpvariable oid='{}', oid_index='{}', value='{}', snmp_type='{}'>".format(
+            self.oid, self.oid_index, self.value, self.snmp_type)
+
+# BER encoding
+def encode_length(length):
+    """
+    :return: the BER encoding of a length (short or long form)
+    """
+    if length < 0x80:
+        return bytes((length,))
+    data = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes((0x80 | len(data),)) + data
+
+def encode_tlv(tag, value):
+    """
+    :return: the TLV (tag, length, value) encoding of an already encoded value
+    """
+    return bytes((tag,)) + encode_length(len(value)) + value
+
+def encode_integer(value, tag = INTEGER):
+    """
+    :return: the TLV encoding of an integer: two's complement for INTEGER,
+             unsigned for Counter32, Gauge32, TimeTicks and Counter64.
+    """
+    if tag in UNSIGNED_TYPES:
+        return encode_tlv(tag, value.to_bytes(value.bit_length() // 8 + 1, 'big'))
+    return encode_tlv(tag, value.to_bytes((value + (value < 0)).bit_length() // 8 + 1, 'big', signed=True))
+
+def encode_oid(oid):
+    """
+    :param oid: dotted OID string (e.g. '.1.3.6.1.2.1.1.3.0'), tuple of ints,
+           or OID already encoded by oid_body()
+    """
+    if isinstance(oid, bytes):
+        return encode_tlv(OBJECT_ID, oid)
+    return encode_tlv(OBJECT_ID, oid_body(oid))
+
+def oid_body(oid):
+    """
+    Encoded OID, without tag and length.  As every sub-identifier is
+    self-delimited, an OID is in the subtree of another one if and only if
+    its encoded form starts with the encoded form of the other one.
+
+    :param oid: dotted OID string or tuple of ints
+    :return: the encoded OID (bytes)
+    """
+    if isinstance(oid, str):
+        oid = [int(x) for x in oid.strip('.').split('.')]
+    data = bytearray((40 * oid[0] + oid[1],))
+    for subid in oid[2:]:
+        chunk = bytearray((subid & 0x7f,))
+        subid >>= 7
+        while subid:
+            chunk.insert(0, 0x80 | (subid & 0x7f))
+            subid >>= 7
+        data += chunk
+    return bytes(data)
+
+def encode_message(community, pdu_tag, request_id, oids, field1 = 0, field2 = 0, values = None):
+    """
+    Encode a complete SNMPv2c message.
+
+    :param community: community string
+    :param pdu_tag: GET_REQUEST, GET_BULK_REQUEST, GET_RESPONSE...
+    :param request_id: request identifier
+    :param oids: list of OIDs
+    :param field1: error-status (or non-repeaters for GET BULK)
+    :param field2: error-index (or max-repetitions for GET BULK)
+    :param values: list of encoded values (TLV) matching *oids*.  NULL values
+           are used if not provided (requests).
+    :return: the message (bytes)
+    """
+    if values is None:
+        values = [encode_tlv(NULL, b'')] * len(oids)
+    varbinds = b''.join([encode_tlv(SEQUENCE, encode_oid(oid) + value) for (oid, value) in zip(oids, values)])
+    pdu = encode_integer(request_id) + encode_integer(field1) + encode_integer(field2) + encode_tlv(SEQUENCE, varbinds)
+    return encode_tlv(SEQUENCE, encode_integer(SNMP_VERSION_2C) +
+                      encode_tlv(OCTET_STRING, community.encode('latin-1')) + encode_tlv(pdu_tag, pdu))
+
+# BER decoding
+def decode_tlv(data, pos):
+    """
+    :return: a tuple (tag, start of the value, end of the value)
+    """
+    tag = data[pos]
+    length = data[pos + 1]
+    pos += 2
+    if length & 0x80:
+        n = length & 0x7f
+        length = int.from_bytes(data[pos:pos + n], 'big')
+        pos += n
+    if pos + length > len(data):
+        raise SNMPError("Truncated BER value")
+    return (tag, pos, pos + length)
+
+def decode_oid(data):
+    """
+    :param data: encoded OID, without tag and length
+    :return: the dotted OID string, with a leading dot (like easysnmp)
+    """
+    first = data[0]
+    subids = [first // 40, first % 40] if first < 80 else [2, first - 80]
+    value = 0
+    for byte in data[1:]:
+        value = (value << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            subids.append(value)
+            value = 0
+    return '.' + '.'.join(map(str, subids))
+
+def decode_index(data):
+    """
+    :param data: end of an encoded OID, after the encoded root of its table
+    :return: the dotted index (e.g. '3' or '1.5'), without leading dot
+    """
+    if len(data) == 1:
+        return str(data[0])
+    subids = []
+    value = 0
+    for byte in data:
+        value = (value << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            subids.append(value)
+            value = 0
+    return '.'.join(map(str, subids))
+
+def decode_value(tag, data):
+    """
+    :return: the value as a string, as easysnmp would give it
+    """
+    if tag == INTEGER:
+        return str(int.from_bytes(data, 'big', signed=True))
+    if tag in UNSIGNED_TYPES:
+        return str(int.from_bytes(data, 'big'))
+    if tag == OCTET_STRING or tag == OPAQUE:
+        return data.decode('latin-1')
+    if tag == OBJECT_ID:
+        return decode_oid(data)
+    if tag == IP_ADDRESS:
+        return '.'.join(map(str, data))
+    return ''
+
+def decode_message(data):
+    """
+    Decode a complete SNMPv2c message.
+
+    :return: a tuple (community, pdu tag, request id, field1, field2, list of
+             varbinds), where a varbind is a tuple (OID string, tag, value
+             bytes).
+    """
+    (tag, pos, end) = decode_tlv(data, 0)
+    if tag != SEQUENCE:
+        raise SNMPError("Invalid SNMP message")
+    (tag, start, pos) = decode_tlv(data, pos)            # version
+    (tag, start, pos) = decode_tlv(data, pos)            # community
+    community = data[start:pos].decode('latin-1')
+    (pdu_tag, pos, end) = decode_tlv(data, pos)
+    fields = []
+    for i in range(3):
+        (tag, start, pos) = decode_tlv(data, pos)
+        fields.append(int.from_bytes(data[start:pos], 'big', signed=True))
+    (tag, pos, end) = decode_tlv(data, pos)              # varbind list
+    varbinds = []
+    while pos < end:
+        (tag, pos, vb_end) = decode_tlv(data, pos)
+        (tag, start, pos) = decode_tlv(data, pos)
+        oid = decode_oid(data[start:pos])
+        (tag, start, pos) = decode_tlv(data, pos)
+        varbinds.append((oid, tag, data[start:pos]))
+    return (community, pdu_tag, fields[0], fields[1], fields[2], varbinds)
+
+def peek_request_id(data):
+    """
+    :return: the request id of an encoded message, without decoding the rest
+    """
+    (tag, pos, end) = decode_tlv(data, 0)
+    for i in range(2):                                   # version, community
+        (tag, start, pos) = decode_tlv(data, pos)
+    (tag, pos, end) = decode_tlv(data, pos)              # PDU
+    (tag, start, end) = decode_tlv(data, pos)
+    return int.from_bytes(data[start:end], 'big', signed=True)
+
+def decode_response_values(data, with_oids = True):
+    """
+    Fast decoding of a response: values are converted directly to their Python
+    type, and no object is created per variable binding.
+
+    :param data: the encoded response
+    :param with_oids: if False, the OIDs are not returned (None instead): the
+           values of a GET response are in the order of the request anyway.
+    :return: a tuple (request id, error status, error index, list of tuples
+             (OID, tag, value)).  OIDs are returned encoded (see oid_body()),
+             to be compared with pre-encoded roots instead of strings.  The value is an int for INTEGER,
+             Counter, Gauge and TimeTicks, bytes for OCTET STRING and IpAddress,
+             None otherwise (NULL, noSuchObject, endOfMibView...).
+    """
+    (tag, pos, end) = decode_tlv(data, 0)
+    (tag, start, pos) = decode_tlv(data, pos)            # version
+    (tag, start, pos) = decode_tlv(data, pos)            # community
+    (tag, pos, end) = decode_tlv(data, pos)              # PDU
+    (tag, start, pos) = decode_tlv(data, pos)
+    request_id = int.from_bytes(data[start:pos], 'big', signed=True)
+    (tag, start, pos) = decode_tlv(data, pos)
+    error_status = int.from_bytes(data[start:pos], 'big', signed=True)
+    (tag, start, pos) = decode_tlv(data, pos)
+    error_index = int.from_bytes(data[start:pos], 'big', signed=True)
+    (tag, pos, end) = decode_tlv(data, pos)              # varbind list
+    values = []
+    while pos < end:
+        (tag, pos, vb_end) = decode_tlv(data, pos)
+        (tag, start, pos) = decode_tlv(data, pos)
+        oid = data[start:pos] if with_oids else None
+        (tag, start, pos) = decode_tlv(data, pos)
+        if tag == OCTET_STRING or tag == IP_ADDRESS:
+            value = data[start:pos]
+        elif tag == INTEGER:
+            value = int.from_bytes(data[start:pos], 'big', signed=True)
+        elif tag in UNSIGNED_TYPES:
+            value = int.from_bytes(data[start:pos], 'big')
+        else:
+            value = None
+        values.append((oid, tag, value))
+    return (request_id, error_status, error_index, values)
+
+class requesttemplate(object):
+    """
+    Pre-encoded request: the message is encoded once, and only the request id
+    is patched for every new request.  Request ids are always encoded on 4
+    bytes (see asyncengine.next_request_id), so the lengths of the message never
+    change.
+
+    :param prefix: encoded message up to the request id value
+    :param suffix: encoded message after the request id value
+    """
+    def __init__(self, community, pdu_tag, oids, field1 = 0, field2 = 0):
+        data = encode_message(community, pdu_tag, FIRST_REQUEST_ID, oids, field1, field2)
+        (tag, pos, end) = decode_tlv(data, 0)
+        for i in range(2):                               # version, community
+            (tag, start, pos) = decode_tlv(data, pos)
+        (tag, pos, end) = decode_tlv(data, pos)          # PDU
+        (tag, start, end) = decode_tlv(data, pos)        # request id
+        self.prefix = data[:start]
+        self.suffix = data[end:]
+
+    def encode(self, request_id):
+        """
+        :param request_id: between FIRST_REQUEST_ID and LAST_REQUEST_ID
+        :return: the encoded request
+        """
+        return self.prefix + request_id.to_bytes(4, 'big') + self.suffix
+
+# Templates of the latest requests, by (community, pdu tag, OIDs, field1,
+# field2).  The GETBULK requests continuing a walk have the OID of the last
+# variable received: there are more keys than requests of a modem, hence the
+# bound.
+MAX_TEMPLATES = 1024
+
+@functools.lru_cache(maxsize = MAX_TEMPLATES)
+def _cached_template(community, pdu_tag, oids, field1, field2):
+    return requesttemplate(community, pdu_tag, oids, field1, field2)
+
+def get_template(community, pdu_tag, oids, field1 = 0, field2 = 0):
+    """
+    :return: the requesttemplate for this request, from the cache of the
+             MAX_TEMPLATES latest ones
+    """
+    return _cached_template(community, pdu_tag, tuple(oids), field1, field2)
+
+def to_snmpvariables(varbinds):
+    """
+    :param varbinds: list of varbinds as returned by decode_message()
+    :return: a list of snmpvariable objects
+    """
+    result = []
+    for (oid, tag, value) in varbinds:
+        (oid, oid_index) = oid.rsplit('.', 1)
+        result.append(snmpvariable(oid, oid_index, decode_value(tag, value), TYPE_NAMES.get(tag, 'UNKNOWN')))
+    return result
+
+def split_hostname(hostname, default_port = 161):
+    """
+    :param hostname: 'host' or 'host:port'
+    :return: a tuple (host, port)
+    """
+    if ':' in hostname:
+        (host, port) = hostname.rsplit(':', 1)
+        return (host, int(port))
+    return (hostname, default_port)
+
+class asyncengine(object):
+    """
+    One UDP socket used by all asyncsession objects of an event loop.  The
+    responses are matched with the pending requests by their request-id.
+
+    This is an asyncio datagram protocol.  It doesn't inherit from
+    asyncio.DatagramProtocol, so that asyncio is only imported when an event
+    loop is actually used: importing asyncio takes longer than importing all
+    modules of the poller, for every new process.
+
+    :param transport: asyncio transport of the UDP socket
+    :param pending: dict request id -> (future, peer address)
+    """
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+        self.request_id = random.randrange(FIRST_REQUEST_ID, LAST_REQUEST_ID)
+        self.traces = logging.getLogger('traces')
+
+    async def start(self, receive_buffer = 8 * 1024 * 1024):
+        """
+        Open the UDP socket.  Must be called from the event loop, once.
+
+        :param receive_buffer: size of the socket receive buffer (bytes).  The
+               responses of thousands of simultaneous requests arrive in bursts:
+               with the default size, many of them would be dropped by the
+               kernel (and retried after a timeout).  The effective size is
+               capped by net.core.rmem_max.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=('0.0.0.0', 0))
+        sock = self.transport.get_extra_info('socket')
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        self.traces.debug("PID {} - SNMP socket receive buffer: {} bytes".format(
+            os.getpid(), sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)))
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        pass
+
+    def error_received(self, exc):
+        self.traces.debug("PID {} - Socket error: {}".format(os.getpid(), exc))
+
+    def datagram_received(self, data, addr):
+        try:
+            request_id = peek_request_id(data)
+        except (SNMPError, IndexError):
+            self.traces.debug("PID {} - Invalid datagram received from {}".format(os.getpid(), addr))
+            return
+        (future, peer) = self.pending.get(request_id, (None, None))
+        if future is None or peer[0] != addr[0] or future.done():
+            return
+        future.set_result(data)
+
+    def next_request_id(self):
+        """
+        :return: a new request id, between FIRST_REQUEST_ID and LAST_REQUEST_ID
+        """
+        self.request_id += 1
+        if self.request_id > LAST_REQUEST_ID:
+            self.request_id = FIRST_REQUEST_ID
+        return self.request_id
+
+    async def request(self, peer, build, timeout, retries):
+        """
+        Send a request and wait for its response, with retries.
+
+        :param peer: tuple (host, port)
+        :param build: function request_id -> encoded message
+        :param timeout: seconds to wait for the response of every attempt
+        :param retries: number of attempts after the first one
+        :return: the encoded response
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        for attempt in range(retries + 1):
+            request_id = self.next_request_id()
+            future = loop.create_future()
+            self.pending[request_id] = (future, peer)
+            try:
+                self.transport.sendto(build(request_id), peer)
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                del self.pending[request_id]
+        raise SNMPTimeoutError("Timeout for {}".format(peer[0]))
+
+    def close(self):
+        """
+        Close the UDP socket.
+        """
+        if self.transport is not None:
+            self.transport.close()
+
+class asyncsession(object):
+    """
+    SNMPv2c session with one agent, with the same methods as easysnmp.Session
+    (get, get_bulk), but as coroutines.
+
+    :param engine: the asyncengine of the running event loop
+    :param hostname: IP address of the agent, optionally followed by ':port'
+    :param community: SNMP v2 community string
+    :param timeout: seconds before retry
+    :param retries: SNMP retries before failure
+    :param response_size: bytes of the latest response (see snmptrace)
+    """
+    def __init__(self, engine, hostname, community = 'public', timeout = 7, retries = 1):
+        self.engine = engine
+        self.peer = split_hostname(hostname)
+        self.community = community
+        self.timeout = timeout
+        self.retries = retries
+        self.response_size = None
+
+    async def _request(self, pdu_tag, oids, field1, field2):
+        """
+        Send a request to the agent and decode the response.
+
+        :return: a list of snmpvariable
+        """
+        data = await self.engine.request(self.peer,
+            lambda request_id: encode_message(self.community, pdu_tag, request_id, oids, field1, field2),
+            self.timeout, self.retries)
+        self.response_size = len(data)
+        (community, pdu_tag, request_id, error_status, error_index, varbinds) = decode_message(data)
+        if error_status:
+            raise SNMPError("Error status {} (index {}) from {}".format(error_status, error_index, self.peer[0]))
+        return to_snmpvariables(varbinds)
+
+    async def get(self, oids):
+        """
+        :param oids: list of OIDs (dotted strings)
+        :return: a list of snmpvariable
+        """
+        return await self._request(GET_REQUEST, oids, 0, 0)
+
+    async def get_bulk(self, oids, non_repeaters = 0, max_repetitions = 10):
+        """
+        :param oids: one OID or a list of OIDs (dotted strings)
+        :return: a list of snmpvariable
+        """
+        if isinstance(oids, str):
+            oids = [oids]
+        return await self._request(GET_BULK_REQUEST, oids, non_repeaters, max_repetitions)
+
+    async def _request_values(self, template, with_oids):
+        """
+        Send a request built from a template and decode the response with
+        decode_response_values().
+
+        :return: a list of tuples (encoded OID, tag, value)
+        """
+        data = await self.engine.request(self.peer, template.encode, self.timeout, self.retries)
+        self.response_size = len(data)
+        (request_id, error_status, error_index, values) = decode_response_values(data, with_oids)
+        if error_status:
+            raise SNMPError("Error status {} (index {}) from {}".format(error_status, error_index, self.peer[0]))
+        return values
+
+    async def get_values(self, oids):
+        """
+        Fast GET: see decode_response_values().
+
+        :param oids: list of OIDs (dotted strings)
+        :return: the list of values, in the order of *oids*
+        """
+        template = get_template(self.community, GET_REQUEST, oids)
+        return [value for (oid, tag, value) in await self._request_values(template, False)]
+
+    async def get_bulk_values(self, oid, max_repetitions = 10):
+        """
+        Fast GET BULK of one OID (non-repeaters is 0): see
+        decode_response_values().
+
+        :param oid: OID encoded by oid_body() (or dotted string)
+        :return: a list of tuples (encoded OID, tag, value)
+        """
+        template = get_template(self.community, GET_BULK_REQUEST, (oid,), 0, max_repetitions)
+        return await self._request_values(template, True)
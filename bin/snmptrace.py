@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+# vim: set fileencoding=utf-8
+# (c) © 2016-2017 Xavier Lüthi xavier@luthi.eu
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See LICENSE.txt for the full license text.
+
+"""
+Tracing of the SNMP exchanges of a sample of the modems (see poller, options
+'--trace-sample' and '--trace-mac').
+
+The session of a traced modem is wrapped in a tracedsession, which records
+every request: operation, OIDs, start and duration, size of the response.
+The walks of ch6643e._get_bulk() record their number of GET BULK requests.
+Once the modem is queried, its trace is logged as one JSON line by the
+'snmptrace' logger: with launch_poller.py, the trace file is written by the
+listener thread of the logpipeline, for all processes.
+
+The other modems only cost a test of their 'trace' attribute.
+"""
+
+import json
+import logging
+import os
+import time
+import zlib
+
+import snmp
+# Module only: ch6643e imports this module too
+import ch6643e
+
+TRACE_LOGGER = 'snmptrace'
+
+def selected(key, sample = None, macs = None):
+    """
+    Deterministic sampling: the same modems are traced at every sweep, so
+    that a slow modem can be followed over time.
+
+    :param key: MAC address of the modem (or IP address if it has no MAC)
+    :param sample: fraction of the modems to trace (e.g. 0.001), or None
+    :param macs: set of MAC addresses (see ch6643e.normalize_mac()) to trace
+    :return: True if the modem is traced
+    """
+    key = key.strip().lower()
+    if macs and ch6643e.normalize_mac(key) in macs:
+        return True
+    # Not the CRC32 of the key alone: the traced modems would all belong to
+    # the same shards (see poller.in_shard())
+    return bool(sample) and zlib.crc32(key.encode(), 0x7ace) < sample * 2 ** 32
+
+class modemtrace(object):
+    """
+    SNMP exchanges of one modem.
+
+    :param clock: time.perf_counter() at the start of the query
+    :param exchanges: list of dicts, one per request
+    :param walks: list of dicts, one per walk of ch6643e._get_bulk()
+    """
+    def __init__(self):
+        self.clock = time.perf_counter()
+        self.exchanges = []
+        self.walks = []
+
+    def exchange(self, operation, oids, clock, max_repetitions = None, varbinds = None,
+                 size = None, error = None):
+        """
+        Record one request.
+
+        :param operation: 'get' or 'get_bulk'
+        :param oids: requested OIDs (dotted strings)
+        :param clock: time.perf_counter() when the request was sent
+        :param varbinds: number of values in the response
+        :param size: bytes of the response
+        :param error: name of the exception raised instead of the response
+        """
+        exchange = {'op': operation, 'oids': oids,
+                    'start_ms': round((clock - self.clock) * 1000, 3),
+                    'duration_ms': round((time.perf_counter() - clock) * 1000, 3)}
+        if max_repetitions is not None:
+            exchange['max_repetitions'] = max_repetitions
+        if error is None:
+            exchange['varbinds'] = varbinds
+            exchange['response_bytes'] = size
+        else:
+            exchange['error'] = error
+        self.exchanges.append(exchange)
+
+    def walk(self, oid, iterations, values):
+        """
+        Record one walk of ch6643e._get_bulk().
+
+        :param iterations: number of GET BULK requests
+        :param values: number of values of the table
+        """
+        self.walks.append({'oid': oid, 'iterations': iterations, 'values': values})
+
+    def write(self, modem):
+        """
+        Log the trace of *modem* (ch6643e object), as one JSON line.
+        """
+        logging.getLogger(TRACE_LOGGER).info(json.dumps({
+            'timestamp': modem.timestamp.isoformat(), 'ip': modem.hostname, 'mac': modem.hfc_mac,
+            'bpid': modem.bpid, 'pid': os.getpid(), 'state': modem.state,
+            'groups': modem.polled_groups, 'timeout': modem.timeout, 'retries': modem.retries,
+            'duration_ms': round((time.perf_counter() - self.clock) * 1000, 3),
+            'exchanges': self.exchanges, 'walks': self.walks}))
+
+class tracedsession(object):
+    """
+    Wrapper of an easysnmp.Session or of a snmp.asyncsession, recording its
+    requests in a modemtrace.  The size of a response is the one of the
+    datagram with snmp.asyncsession; easysnmp doesn't give it, so that it is
+    the size of the OIDs and values instead.
+    """
+    def __init__(self, session, trace):
+        self.session = session
+        self.trace = trace
+
+    def _record(self, operation, oids, clock, max_repetitions, result, size = None, error = None):
+        if error is not None:
+            self.trace.exchange(operation, oids, clock, max_repetitions, error = error)
+            return
+        if size is None:
+            size = sum([len(var.oid) + len(var.oid_index) + len(var.value) for var in result])
+        self.trace.exchange(operation, oids, clock, max_repetitions, len(result), size)
+
+    def get(self, oids):
+        clock = time.perf_counter()
+        try:
+            result = self.session.get(oids)
+        except Exception as e:
+            self._record('get', oids, clock, None, None, error = type(e).__name__)
+            raise
+        self._record('get', oids, clock, None, result)
+        return result
+
+    def get_bulk(self, oids, non_repeaters = 0, max_repetitions = 10):
+        clock = time.perf_counter()
+        try:
+            result = self.session.get_bulk(oids = oids, non_repeaters = non_repeaters,
+                                           max_repetitions = max_repetitions)
+        except Exception as e:
+            self._record('get_bulk', oids, clock, max_repetitions, None, error = type(e).__name__)
+            raise
+        self._record('get_bulk', oids, clock, max_repetitions, result)
+        return result
+
+    async def get_values(self, oids):
+        clock = time.perf_counter()
+        try:
+            result = await self.session.get_values(oids)
+        except Exception as e:
+            self._record('get', oids, clock, None, None, error = type(e).__name__)
+            raise
+        self._record('get', oids, clock, None, result, self.session.response_size)
+        return result
+
+    async def get_bulk_values(self, oid, max_repetitions = 10):
+        clock = time.perf_counter()
+        dotted = snmp.decode_oid(oid) if isinstance(oid, bytes) else oid
+        try:
+            result = await self.session.get_bulk_values(oid, max_repetitions)
+        except Exception as e:
+            self._record('get_bulk', dotted, clock, max_repetitions, None, error = type(e).__name__)
+            raise
+        self._record('get_bulk', dotted, clock, max_repetitions, result, self.session.response_size)
+        return result
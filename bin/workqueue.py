@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+# vim: set fileencoding=utf-8
+# (c) © 2016-2017 Xavier Lüthi xavier@luthi.eu
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See LICENSE.txt for the full license text.
+
+from ch6643e import ch6643e
+from datetime import datetime
+import sqlite3
+import json
+import time
+import logging
+import os # getpid() for debug traces
+
+# Position of the timestamp in the records of ch6643e.to_record(): it is
+# stored as an ISO 8601 string in the JSON results.
+_TIMESTAMP = ch6643e.RECORD_FIELDS.index('timestamp')
+
+class workqueue(object):
+    """
+    Queue of batches of modems shared by a coordinator and several poller
+    nodes (see coordinator.py).  It is backed by a SQLite3 database file, which
+    must be reachable by all nodes.
+
+    Life cycle of a batch:
+        - 'pending': created by the coordinator, waiting for a node
+        - 'leased': taken by a node, up to lease_expiry.  The node must renew
+          its lease while polling, otherwise the batch is considered lost
+          (dead node) and put back in 'pending' state.
+        - 'done': the node stored the polled modems in the results table, as
+          JSON records (see ch6643e.to_record()).
+        - 'failed': the batch has been leased too many times without result.
+
+    :param file_name: the SQLite3 database file
+    :param lease_time: seconds a node owns a batch without renewing its lease
+    :param max_attempts: number of leases of a batch before giving up
+    """
+    def __init__(self, file_name = 'docsispy-queue.db', lease_time = 60, max_attempts = 3):
+        self.file_name = file_name
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        # Autocommit mode: transactions are explicitly opened when needed.
+        self.connection = sqlite3.connect(file_name, timeout = 60, isolation_level = None)
+        self.cursor = self.connection.cursor()
+        self.cursor.execute("""CREATE TABLE IF NOT EXISTS batches
+                                (id           INTEGER PRIMARY KEY,
+                                 sweep        TEXT NOT NULL,
+                                 entities     TEXT NOT NULL,
+                                 state        TEXT NOT NULL,
+                                 node         TEXT,
+                                 lease_expiry REAL,
+                                 attempts     INTEGER NOT NULL DEFAULT 0,
+                                 consumed     INTEGER NOT NULL DEFAULT 0,
+                                 result       TEXT)""")
+        self.traces = logging.getLogger('traces')
+
+    def __debug(self,msg):
+        self.traces.debug("PID {} - {}".format(os.getpid(),msg))
+
+    def create_sweep(self, sweep, entities, batch_size = 100):
+        """
+        Split the modems of a sweep in batches and queue them.
+
+        :param sweep: identifier of the sweep
+        :param entities: list of modems (dict) to give to query_one_modem()
+        :param batch_size: number of modems per batch
+        :return: the number of batches created
+        """
+        batches = [entities[i:i + batch_size] for i in range(0, len(entities), batch_size)]
+        self.cursor.execute('BEGIN IMMEDIATE')
+        self.cursor.executemany("INSERT INTO batches (sweep, entities, state) VALUES (:sweep, :entities, 'pending')",
+            [{'sweep': sweep, 'entities': json.dumps(batch)} for batch in batches])
+        self.cursor.execute('COMMIT')
+        self.__debug("Sweep {}: {} batches queued".format(sweep, len(batches)))
+        return len(batches)
+
+    def _requeue_expired(self):
+        """
+        Put back in 'pending' state the batches whose lease expired, or in
+        'failed' state the ones which reached max_attempts.  Must be called
+        within a transaction.
+        """
+        now = time.time()
+        self.cursor.execute("""UPDATE batches SET state = 'failed'
+            WHERE state = 'leased' AND lease_expiry < :now AND attempts >= :max_attempts""",
+            {'now': now, 'max_attempts': self.max_attempts})
+        self.cursor.execute("""UPDATE batches SET state = 'pending', node = NULL
+            WHERE state = 'leased' AND lease_expiry < :now""", {'now': now})
+        if self.cursor.rowcount:
+            self.traces.warning("{} expired batches queued again".format(self.cursor.rowcount))
+
+    def lease(self, node):
+        """
+        Take the oldest pending batch.
+
+        :param node: name of the node taking the batch
+        :return: a tuple (batch id, list of entities), or None if the queue is
+                 empty
+        """
+        self.cursor.execute('BEGIN IMMEDIATE')
+        try:
+            self._requeue_expired()
+            self.cursor.execute("SELECT id, entities FROM batches WHERE state = 'pending' ORDER BY id LIMIT 1")
+            row = self.cursor.fetchone()
+            if row is not None:
+                self.cursor.execute("""UPDATE batches SET state = 'leased', node = :node,
+                    lease_expiry = :expiry, attempts = attempts + 1 WHERE id = :id""",
+                    {'node': node, 'expiry': time.time() + self.lease_time, 'id': row[0]})
+        finally:
+            self.cursor.execute('COMMIT')
+        if row is None:
+            return None
+        self.__debug("Batch {} leased by {}".format(row[0], node))
+        return (row[0], json.loads(row[1]))
+
+    def renew(self, batch_id, node):
+        """
+        Extend the lease of a batch still being polled.
+
+        :return: False if the batch is not leased by this node anymore
+        """
+        self.cursor.execute("""UPDATE batches SET lease_expiry = :expiry
+            WHERE id = :id AND node = :node AND state = 'leased'""",
+            {'expiry': time.time() + self.lease_time, 'id': batch_id, 'node': node})
+        return self.cursor.rowcount == 1
+
+    def complete(self, batch_id, node, modems):
+        """
+        Store the polled modems of a batch.  If the batch has already been
+        completed by another node (lease expired in between), the result is
+        dropped.
+
+        :param modems: list of polled modem objects (ch6643e)
+        :return: True if the result has been stored
+        """
+        self.cursor.execute("""UPDATE batches SET state = 'done', node = :node, result = :result
+            WHERE id = :id AND state IN ('leased', 'pending')""",
+            {'id': batch_id, 'node': node, 'result': json.dumps([_encode(modem) for modem in modems])})
+        if self.cursor.rowcount != 1:
+            self.traces.warning("Result of batch {} from {} dropped: already completed".format(batch_id, node))
+            return False
+        return True
+
+    def fetch_results(self, sweep):
+        """
+        Get the batches of a sweep completed since the previous call, and the
+        failed ones.
+
+        :return: a list of tuples (state, list of modems or entities): polled
+                 modem objects for 'done' batches, entities (dict) for 'failed'
+                 ones.
+        """
+        self.cursor.execute('BEGIN IMMEDIATE')
+        try:
+            self._requeue_expired()
+            rows = self.cursor.execute("""SELECT id, state, entities, result FROM batches
+                WHERE sweep = :sweep AND state IN ('done', 'failed') AND consumed = 0""",
+                {'sweep': sweep}).fetchall()
+            self.cursor.executemany('UPDATE batches SET consumed = 1 WHERE id = :id',
+                [{'id': row[0]} for row in rows])
+        finally:
+            self.cursor.execute('COMMIT')
+        return [(state, [_decode(record) for record in json.loads(result)] if state == 'done'
+                        else json.loads(entities))
+                for (batch_id, state, entities, result) in rows]
+
+    def delete_sweep(self, sweep):
+        """
+        Remove all batches of a sweep from the queue.
+        """
+        self.cursor.execute('DELETE FROM batches WHERE sweep = :sweep', {'sweep': sweep})
+
+def _encode(modem):
+    """
+    :param modem: a ch6643e object
+    :return: its record (see ch6643e.to_record()), as a list of JSON values
+    """
+    record = list(modem.to_record())
+    record[_TIMESTAMP] = record[_TIMESTAMP].isoformat()
+    return record
+
+def _decode(record):
+    """
+    :param record: a list returned by _encode()
+    :return: the ch6643e object, see ch6643e.from_record()
+    """
+    record[_TIMESTAMP] = datetime.fromisoformat(record[_TIMESTAMP])
+    return ch6643e.from_record(record)
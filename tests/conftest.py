@@ -0,0 +1,122 @@
+# vim: set fileencoding=utf-8
+# (c) © 2016-2017 Xavier Lüthi xavier@luthi.eu
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See LICENSE.txt for the full license text.
+
+"""
+Fixtures of the tests: the poller is run as a command (launch_poller.py)
+against modems simulated by simulator.py.  The tests use the hybrid engine,
+which doesn't need easysnmp.
+"""
+
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import pytest
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin')
+sys.path.insert(0, BIN_DIR)
+
+class simulation(object):
+    """
+    Modems simulated by one simulator.py process, and the files of the
+    poller in a temporary directory.
+
+    :param directory: working directory of the poller
+    :param ip_file: IP file of the simulated modems
+    :param ips: IP addresses of the simulated modems
+    """
+    def __init__(self, directory, modems, delay, loss):
+        self.directory = str(directory)
+        self.ip_file = os.path.join(self.directory, 'ip.txt')
+        with open(os.path.join(self.directory, 'conf.json'), 'w') as f:
+            json.dump({'read_community': 'public'}, f)
+        for attempt in range(5):
+            base_port = random.randrange(20000, 60000 - modems)
+            self.process = subprocess.Popen([sys.executable, os.path.join(BIN_DIR, 'simulator.py'),
+                '--modems', str(modems), '--delay', str(delay), '--loss', str(loss),
+                '--base-port', str(base_port), '--ipfile', self.ip_file],
+                stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+            while not os.path.exists(self.ip_file) and self.process.poll() is None:
+                time.sleep(0.1)
+            time.sleep(1)
+            if self.process.poll() is None:
+                break
+            # UDP ports in use: try other ones
+            if os.path.exists(self.ip_file):
+                os.remove(self.ip_file)
+        else:
+            raise RuntimeError("simulator.py failed to start")
+        with open(self.ip_file) as f:
+            self.ips = [line.strip().split(';')[2] for line in f]
+
+    def run(self, *args, timeout = 120, wait = True, usage = False):
+        """
+        Run launch_poller.py with the configuration of the simulation.
+
+        :param args: other arguments of launch_poller.py (the IP file is added)
+        :param usage: if False, '--no-usage' is added
+        :param wait: if False, return the running process (subprocess.Popen)
+        :return: subprocess.CompletedProcess, with the output of '-v' in stderr
+        """
+        command = [sys.executable, os.path.join(BIN_DIR, 'launch_poller.py'), '-v', '--config', 'conf.json']
+        command += list(args) + ([] if usage else ['--no-usage']) + [self.ip_file]
+        if not wait:
+            return subprocess.Popen(command, cwd = self.directory, stdout = subprocess.DEVNULL,
+                                    stderr = subprocess.PIPE, universal_newlines = True)
+        return subprocess.run(command, cwd = self.directory, stdout = subprocess.PIPE,
+                              stderr = subprocess.PIPE, universal_newlines = True, timeout = timeout)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+@pytest.fixture
+def simulator(tmp_path):
+    """
+    :return: a function starting a simulation (see simulation), with
+             arguments modems, delay (seconds) and loss (ratio of requests
+             without response).  The simulators are stopped at the end of the
+             test.
+    """
+    simulations = []
+    def start(modems = 100, delay = 0.01, loss = 0.0):
+        directory = tmp_path / 'sim{}'.format(len(simulations))
+        directory.mkdir()
+        simulations.append(simulation(directory, modems, delay, loss))
+        return simulations[-1]
+    yield start
+    for sim in simulations:
+        sim.stop()
+
+def read_lines(file_name):
+    """
+    :return: the lines of an output file of the poller, as lists of fields
+    """
+    with open(file_name) as f:
+        return [line.rstrip('\n').split(';') for line in f]
+
+def sweep_statistics(output):
+    """
+    :param output: the stderr of launch_poller.py -v
+    :return: the statistics of the last sweep (dict)
+    """
+    lines = [line for line in output.splitlines() if line.startswith('Sweep statistics: ')]
+    assert lines, output
+    return eval(lines[-1][len('Sweep statistics: '):])
@@ -0,0 +1,41 @@
+# vim: set fileencoding=utf-8
+# (c) © 2016-2017 Xavier Lüthi xavier@luthi.eu
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See LICENSE.txt for the full license text.
+
+from datetime import datetime
+
+from ch6643e import ch6643e
+
+def partial_modem():
+    modem = ch6643e(hostname = '10.0.0.1', bpid = '1000000', mac = '5c353bef6101')
+    modem.timestamp = datetime(2017, 1, 2, 3, 4, 5)
+    modem.state = 'partial'
+    modem.hfc_mac = '5c353bef6101'
+    (modem.uptime, modem.wan_ul, modem.wan_dl) = (3600, 1000, 2000)
+    modem.polled_groups = ['counters']
+    return modem
+
+def test_partial_line():
+    modem = partial_modem()
+    line = '20170102-030405;1000000;5c353bef6101;10.0.0.1;partial' + ';' * 14 + '3600;1000;0;2000;0'
+    assert modem.get_csv_line() == line
+    assert modem.get_legacy_csv_line() == line
+
+def test_partial_line_restored_groups():
+    modem = partial_modem()
+    modem.ds_power = modem.ds_snr = [('1', 12)]
+    modem.us_power = [('1', 450)]
+    modem.restored_groups = ['signals']
+    fields = modem.get_csv_line().split(';')
+    assert fields[4:15] == ['partial', '', '', '1', '1.2', '1', '1.2', '1', '45.0', '1-1', '']
+    assert modem.get_legacy_csv_line() == ';'.join(fields)
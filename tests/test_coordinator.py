@@ -0,0 +1,47 @@
+# vim: set fileencoding=utf-8
+# (c) © 2016-2017 Xavier Lüthi xavier@luthi.eu
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See LICENSE.txt for the full license text.
+
+import time
+
+from conftest import read_lines, sweep_statistics
+from poller import failed_modem
+from workqueue import workqueue
+
+def test_deadline_without_node(simulator):
+    sim = simulator(modems = 20)
+    started = time.time()
+    result = sim.run('--coordinator', 'queue.db', '--batch-size', '5', '--deadline', '3', '--output', 'out.txt')
+    assert result.returncode == 0, result.stderr
+    assert time.time() - started < 10
+    lines = read_lines(sim.path('out.txt'))
+    assert sorted(line[3] for line in lines) == sorted(sim.ips)
+    assert all(line[4] == 'timeout' for line in lines)
+    assert sweep_statistics(result.stderr)['cut'] == 20
+
+def test_workqueue_results(tmp_path):
+    queue = workqueue(file_name = str(tmp_path / 'queue.db'))
+    entities = [{'ip': '10.0.0.{}'.format(i), 'mac': '', 'bpid': str(i), 'read_community': 'public'}
+                for i in range(3)]
+    queue.create_sweep('sweep', entities, batch_size = 2)
+    (batch_id, batch) = queue.lease('node')
+    modems = [failed_modem(entity) for entity in batch]
+    modems[0].state = 'completed'
+    modems[0].ds_power = [('1', 120), ('2', -35)]
+    modems[0].polled_groups = ['signals']
+    assert queue.complete(batch_id, 'node', modems)
+    [(state, results)] = queue.fetch_results('sweep')
+    assert state == 'done'
+    assert [modem.get_csv_line() for modem in results] == [modem.get_csv_line() for modem in modems]
+    assert results[0].timestamp == modems[0].timestamp
+    assert results[0].polled_groups == ['signals']
@@ -0,0 +1,32 @@
+# vim: set fileencoding=utf-8
+# (c) © 2016-2017 Xavier Lüthi xavier@luthi.eu
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See LICENSE.txt for the full license text.
+
+import time
+
+from conftest import read_lines, sweep_statistics
+
+def test_hybrid_deadline(simulator):
+    sim = simulator(modems = 200, delay = 0.5)
+    started = time.time()
+    result = sim.run('--engine', 'hybrid', '-p', '2', '--concurrency', '5', '--deadline', '5', '--output', 'out.txt')
+    assert result.returncode == 0, result.stderr
+    # The processes still querying modems are stopped at the deadline.
+    assert time.time() - started < 8
+    lines = read_lines(sim.path('out.txt'))
+    assert sorted(line[3] for line in lines) == sorted(sim.ips)
+    # The modems polled before the deadline are written, even if their batch
+    # is not complete.
+    stats = sweep_statistics(result.stderr)
+    assert 0 < stats['cut'] < len(sim.ips)
+    assert len([line for line in lines if line[4] != 'timeout']) == len(sim.ips) - stats['cut']
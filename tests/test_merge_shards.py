@@ -0,0 +1,56 @@
+# vim: set fileencoding=utf-8
+# (c) © 2016-2017 Xavier Lüthi xavier@luthi.eu
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See LICENSE.txt for the full license text.
+
+import os
+import sqlite3
+import subprocess
+import sys
+
+from conftest import BIN_DIR, read_lines
+from merge_shards import merge_outputs
+
+def test_timeouts_kept_by_ip(tmp_path):
+    shard0 = tmp_path / 'shard0.txt'
+    shard1 = tmp_path / 'shard1.txt'
+    shard0.write_text('1;1000000;;10.0.0.1;timeout;;;;;;;;;;;;;;;\n'
+                      '1;1000001;;10.0.0.2;timeout;;;;;;;;;;;;;;;\n')
+    shard1.write_text('1;1000002;;10.0.0.3;timeout;;;;;;;;;;;;;;;\n'
+                      '1;1000001;;10.0.0.2;timeout;;;;;;;;;;;;;;;\n')
+    merged = str(tmp_path / 'merged.txt')
+    assert merge_outputs(merged, [str(shard0), str(shard1)]) == (3, 1)
+    assert [line[3] for line in read_lines(merged)] == ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+
+def test_sharded_sweep(simulator):
+    sim = simulator(modems = 60)
+    for shard in range(2):
+        result = sim.run('--engine', 'hybrid', '-p', '2', '--shard', '{}/2'.format(shard),
+                         '--cachedb', 'cache{}.db'.format(shard), '--output', 'out{}.txt'.format(shard), usage = True)
+        assert result.returncode == 0, result.stderr
+    result = subprocess.run([sys.executable, os.path.join(BIN_DIR, 'merge_shards.py'),
+                             '--output', 'merged.txt', '--cachedb', 'merged.db',
+                             '--shard-cachedb', 'cache0.db', '--shard-cachedb', 'cache1.db',
+                             'out0.txt', 'out1.txt'],
+                            cwd = sim.directory, stderr = subprocess.PIPE, universal_newlines = True)
+    assert result.returncode == 0, result.stderr
+
+    shard_ips = [set(line[3] for line in read_lines(sim.path('out{}.txt'.format(shard)))) for shard in range(2)]
+    assert shard_ips[0] and shard_ips[1] and not shard_ips[0] & shard_ips[1]
+    lines = read_lines(sim.path('merged.txt'))
+    assert sorted(line[3] for line in lines) == sorted(sim.ips)
+    assert all(line[4] != 'timeout' for line in lines)
+
+    connections = [sqlite3.connect(sim.path(name)) for name in ('cache0.db', 'cache1.db', 'merged.db')]
+    macs = [set(row[0] for row in c.execute('SELECT hfc_mac FROM modems')) for c in connections]
+    assert macs[2] == macs[0] | macs[1]
+    assert len(macs[2]) == len(sim.ips)
@@ -0,0 +1,48 @@
+# vim: set fileencoding=utf-8
+# (c) © 2016-2017 Xavier Lüthi xavier@luthi.eu
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See LICENSE.txt for the full license text.
+
+import os
+import signal
+import time
+
+from conftest import read_lines, sweep_statistics
+
+def test_resume_after_kill(simulator):
+    sim = simulator(modems = 150, delay = 0.1)
+    options = ('--engine', 'hybrid', '-p', '2', '--concurrency', '5', '--resume', '--output', 'out.txt')
+    process = sim.run(*options, wait = False)
+    ongoing = sim.path('out.txt.ongoing')
+    deadline = time.time() + 60
+    while time.time() < deadline and process.poll() is None:
+        if os.path.exists(ongoing) and os.path.getsize(ongoing) > 0 and len(read_lines(ongoing)) >= 30:
+            break
+        time.sleep(0.1)
+    assert process.poll() is None, "sweep ended before the kill"
+    os.kill(process.pid, signal.SIGKILL)
+    process.communicate()
+    with open(ongoing) as f:
+        data = f.read()
+    written = data[:data.rfind('\n') + 1].splitlines()
+    assert 30 <= len(written) < len(sim.ips)
+
+    result = sim.run(*options)
+    assert result.returncode == 0, result.stderr
+    lines = read_lines(sim.path('out.txt'))
+    # No modem lost nor polled twice, and the lines of the killed sweep kept
+    assert sorted(line[3] for line in lines) == sorted(sim.ips)
+    assert [';'.join(line) for line in lines[:len(written)]] == written
+    stats = sweep_statistics(result.stderr)
+    assert stats['resumed'] == len(written)
+    assert stats['completed'] == len(sim.ips) - len(written)
+    assert not os.path.exists(sim.path('out.txt.checkpoint'))
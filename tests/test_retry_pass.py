@@ -0,0 +1,30 @@
+# vim: set fileencoding=utf-8
+# (c) © 2016-2017 Xavier Lüthi xavier@luthi.eu
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See LICENSE.txt for the full license text.
+
+from conftest import read_lines, sweep_statistics
+
+def test_retry_pass(simulator):
+    sim = simulator(modems = 100, loss = 0.1)
+    result = sim.run('--engine', 'hybrid', '-p', '2', '--retries', '0', '--retry-pass', '1', '--output', 'out.txt')
+    assert result.returncode == 0, result.stderr
+    lines = read_lines(sim.path('out.txt'))
+    # One single line per modem, with the latest result
+    assert sorted(line[3] for line in lines) == sorted(sim.ips)
+    stats = sweep_statistics(result.stderr)
+    assert 'Second chance for {} modems'.format(stats['retried']) in result.stderr
+    assert 0 < stats['recovered'] <= stats['retried']
+    states = [line[4] if line[4] in ('timeout', 'partial') else 'completed' for line in lines]
+    assert states.count('completed') == stats['completed']
+    assert states.count('timeout') == stats.get('timeout', 0)
+    assert states.count('partial') == stats.get('partial', 0)